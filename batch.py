@@ -0,0 +1,4 @@
+import src.batch as batch
+
+if __name__ == '__main__':
+    batch.main()
@@ -0,0 +1,45 @@
+import argparse, contextlib, io, multiprocessing, os, tempfile, time, src.config as config
+from concurrent.futures import ProcessPoolExecutor
+from benchmarks.generate import generate_replays
+from src.analyze_replays import analyze_replay_data
+from src.utils.memory import get_peak_memory
+from src.utils.parquet_utils import write_partitioned
+
+def _write_files(rows: int, directory: str) -> list[str]:
+    replays_df = generate_replays(rows)
+    files = [os.path.join(directory, 'replay_data' + config.FileTypes.CSV), os.path.join(directory, 'replay_data' + config.FileTypes.PARQUET)]
+    replays_df.write_csv(files[0])
+    write_partitioned(replays_df, files[1], 0)
+    print(f'{replays_df.height:,} replays')
+    return files
+
+def _run(function, *args):
+    # A new process every time, peak memory is inherited by child processes on Linux so the one benchmarking has to
+    # stay small
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return executor.submit(function, *args).result()
+
+def _analyze(file_path: str) -> tuple[float, int | None]:
+    # Cached results would be loaded instead of measuring the analysis
+    config.RESULTS_CACHE = False
+    start_time = time.perf_counter()
+    # The results are printed by the analysis, they are not what is being measured here
+    with contextlib.redirect_stdout(io.StringIO()):
+        analyze_replay_data(file_path)
+    return time.perf_counter() - start_time, get_peak_memory()
+
+def main():
+    parser = argparse.ArgumentParser(description='Time analyze_replay_data and measure its peak memory on synthetic CSV and Parquet replay files')
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--csv', help='Analyze an existing CSV file instead of generating one')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        files = [args.csv] if args.csv else _run(_write_files, args.rows, directory)
+        for file_path in files:
+            elapsed, peak_memory = _run(_analyze, file_path)
+            memory = f'{peak_memory / 2**20:7,.0f} MiB peak' if peak_memory else ''
+            print(f'{os.path.basename(file_path):<22} {elapsed:7.2f}s {memory}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+import argparse, json
+
+def _load(file_name: str) -> tuple[dict, dict]:
+    with open(file_name, encoding='utf8') as file:
+        run = json.load(file)
+    return run, {(result['benchmark'], result['file_type'], result['rows']): result for result in run['results']}
+
+def _change(before: float | None, after: float | None) -> str:
+    return f'{after / before - 1:+8.1%}' if before and after else f'{"":>8}'
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the timings of two runs of benchmarks.suite')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Slowdown from before to after that counts as a regression')
+    args = parser.parse_args()
+
+    before_run, before = _load(args.before)
+    after_run, after = _load(args.after)
+    print(f'{before_run["commit"]} -> {after_run["commit"]}')
+    regressions = 0
+    for key in sorted(before.keys() & after.keys(), key=str):
+        benchmark, file_type, rows = key
+        seconds = before[key]['seconds'], after[key]['seconds']
+        regression = seconds[1] > seconds[0] * (1 + args.threshold)
+        regressions += regression
+        print(
+            f'{benchmark:<20} {file_type or "":<9} {rows:>12,} {seconds[0]:8.2f}s {seconds[1]:8.2f}s {_change(*seconds)} time'
+            f' {_change(before[key]["peak_memory"], after[key]["peak_memory"])} memory{"  REGRESSION" if regression else ""}'
+        )
+    for key in sorted(before.keys() ^ after.keys(), key=str):
+        print(f'{" ".join(str(part) for part in key if part)} is only in {args.before if key in before else args.after}')
+    print(f'{regressions} regression(s) over {args.threshold:.0%}')
+
+if __name__ == '__main__':
+    main()
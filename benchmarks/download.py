@@ -0,0 +1,61 @@
+import argparse, time, requests, src.config as config, src.get_replays as get_replays
+from contextlib import closing
+from benchmarks.mock_api import MockApi
+from src.utils.http_utils import close_session
+from src.utils.rate_limiter import TokenBucket
+from src.utils.telemetry import DownloadTelemetry
+
+START = 1_756_684_800
+
+def _sequential_loop(befores: list[int], rate: float):
+    # Mirrors the old download loop, one blocking request without a session at a time and then sleeping out the rest of the tick
+    replays = 0
+    for before in befores:
+        start_time = time.perf_counter()
+        try:
+            replays += len(requests.get(f'{config.API_URL}?before={before}').json())
+        except Exception:
+            pass
+        elapsed_time = time.perf_counter() - start_time
+        if elapsed_time < 1 / rate:
+            time.sleep(1 / rate - elapsed_time)
+    return replays
+
+def _windowed(befores: list[int], rate: float, workers: int):
+    replays = 0
+    telemetry = DownloadTelemetry()
+    with closing(get_replays._download_windows(befores, TokenBucket(rate), workers, telemetry)) as windows:
+        for _, downloaded in windows:
+            replays += len(downloaded or [])
+    close_session()
+    telemetry.report()
+    return replays
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the sequential download loop against the windowed downloader using a local mock API')
+    parser.add_argument('--windows', type=int, default=60)
+    parser.add_argument('--rate', type=float, default=10, help='Requests per second allowed, scaled up from the real 1/s so runs are short')
+    parser.add_argument('--latency', type=float, default=0.15, help='Seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.1)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    server = MockApi(latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate).start()
+    config.API_URL = server.url
+    befores = get_replays._get_windows(START, START + args.windows * config.REPLAY_WINDOW_SECONDS)
+    ideal = len(befores) / args.rate
+    print(f'{len(befores)} windows at {args.rate}/s, latency {args.latency}s + up to {args.jitter}s jitter, {args.failure_rate:.0%} failures, ideal {ideal:.2f}s')
+    try:
+        runs = [('sequential loop', lambda: _sequential_loop(befores, args.rate))]
+        runs += [(f'windowed, {workers} worker(s)', lambda workers=workers: _windowed(befores, args.rate, workers)) for workers in args.workers]
+        for name, run in runs:
+            start_time = time.perf_counter()
+            replays = run()
+            elapsed = time.perf_counter() - start_time
+            print(f'{name:<25} {elapsed:7.2f}s {len(befores) / elapsed:7.2f} windows/s {ideal / elapsed:6.1%} of budget {replays:,} replays')
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+import argparse, contextlib, io, math, os, time, polars as pl, src.config as config, src.get_replays as get_replays
+from src.enums import BattleTypes, Characters, Ranks, Regions, Stages
+from src.models import REPLAY_DATA_SCHEMA
+
+START = 1_756_684_800
+PLAYERS = 200_000
+# About how often replays are played on the real ladder, a window of the API holds around 1,000 of them
+SECONDS_PER_REPLAY = 0.7
+# A new game version comes out about every month
+SECONDS_PER_VERSION = 30 * 86400
+TIE_RATE = 0.01
+# Rows generated and saved at a time, about what a download saves at once
+CHUNK_ROWS = 1_000_000
+
+CHARACTERS = [chara.value for chara in Characters if chara != Characters.Unknown]
+# Pick rates fall off from the most to the least played character, the order is fixed rather than by id
+CHARACTER_WEIGHTS = [1 / (place + 4) for place in range(len(CHARACTERS))]
+RANKS = [rank.value for rank in Ranks]
+STAGES = [stage.value for stage in Stages]
+REGIONS = [region.value for region in Regions]
+BATTLE_TYPES = [battle_type.value for battle_type in BattleTypes]
+
+def _uniform(row: pl.Expr, seed: int, field: int) -> pl.Expr:
+    # A float in [0, 1) from the hash of the row, the same row, seed and field always give the same number
+    return (row.hash(seed * 1_000_003 + field) // (1 << 11)).cast(pl.Float64) / float(1 << 53)
+
+def _choose(u: pl.Expr, values: list[int], weights: list[float] | None=None) -> pl.Expr:
+    # Picks from values with the given weights by where u falls in their cumulative weights
+    weights = weights or [1.0] * len(values)
+    cumulative = pl.Series([sum(weights[:index + 1]) / sum(weights) for index in range(len(weights))])
+    return _pick(pl.lit(cumulative).search_sorted(u, side='right').clip(upper_bound=len(values) - 1), values)
+
+def _pick(index: pl.Expr, values: list[int]) -> pl.Expr:
+    return index.replace_strict(dict(enumerate(values)), return_dtype=pl.Int64)
+
+def _player(row: pl.Expr, seed: int, side: int, start: int, players: int) -> list[pl.Expr]:
+    field = side * 100
+    # Player activity follows a power law, a few players play far more matches than the rest like on the real ladder
+    player_id = (players * _uniform(row, seed, field).pow(3)).floor().cast(pl.Int64)
+    # Every player has a main character and a rank they hover around, most players are in the middle ranks. Both only
+    # depend on the player so they are the same in every replay of theirs
+    main_chara = _choose(_uniform(player_id, seed, 1), CHARACTERS, CHARACTER_WEIGHTS)
+    base_rank = (len(RANKS) * (_uniform(player_id, seed, 2) + _uniform(player_id, seed, 3) + _uniform(player_id, seed, 4)) / 3)
+    rank = (base_rank + 2 * _uniform(row, seed, field + 1) - 1).floor().clip(0, len(RANKS) - 1)
+    chara = pl.when(_uniform(row, seed, field + 2) < 0.8).then(main_chara).otherwise(
+        _choose(_uniform(row, seed, field + 3), CHARACTERS, CHARACTER_WEIGHTS)
+    )
+    prefix = f'p{side}'
+    return [
+        _choose(_uniform(player_id, seed, 5), REGIONS).alias(f'{prefix}_area_id'),
+        chara.alias(f'{prefix}_chara_id'),
+        pl.lit('en').alias(f'{prefix}_lang'),
+        pl.format('Player{}', player_id).alias(f'{prefix}_name'),
+        player_id.cast(pl.String).str.zfill(12).alias(f'{prefix}_polaris_id'),
+        (rank * 30_000 + 30_000 * _uniform(row, seed, field + 4)).cast(pl.Int64).alias(f'{prefix}_power'),
+        _pick(rank.cast(pl.Int64), RANKS).alias(f'{prefix}_rank'),
+        (500 + rank * 60 + 60 * _uniform(row, seed, field + 5)).cast(pl.Int64).alias(f'{prefix}_rating_before'),
+        (60 * _uniform(row, seed, field + 6) - 30).cast(pl.Int64).alias(f'{prefix}_rating_change'),
+        _choose(_uniform(player_id, seed, 5), REGIONS).alias(f'{prefix}_region_id'),
+        (4 * _uniform(row, seed, field + 7)).cast(pl.Int64).alias(f'{prefix}_rounds'),
+        player_id.alias(f'{prefix}_user_id')
+    ]
+
+def generate_replays(rows: int, seed: int=0, offset: int=0, start: int=START, players: int=PLAYERS) -> pl.DataFrame:
+    # Replays offset to offset + rows of a seeded set, every column is worked out from the row number so any slice of
+    # the set can be generated on its own and generating it in chunks gives the same replays as all at once
+    row = pl.col('row')
+    battle_at = (start + row * SECONDS_PER_REPLAY).cast(pl.Int64)
+    winner = _uniform(row, seed, 6)
+    return pl.select(pl.int_range(offset, offset + rows, dtype=pl.Int64).alias('row')).select([
+        battle_at.alias('battle_at'),
+        pl.format('{}-{}', pl.lit(seed), row).alias('battle_id'),
+        _choose(_uniform(row, seed, 7), BATTLE_TYPES).alias('battle_type'),
+        (20_000 + (battle_at - start) // SECONDS_PER_VERSION).alias('game_version'),
+        *_player(row, seed, 1, start, players),
+        *_player(row, seed, 2, start, players),
+        _choose(_uniform(row, seed, 8), STAGES).alias('stage_id'),
+        pl.when(winner < TIE_RATE).then(3).when(winner < (1 + TIE_RATE) / 2).then(1).otherwise(2).cast(pl.Int64).alias('winner')
+    ]).select(REPLAY_DATA_SCHEMA.names()).cast(REPLAY_DATA_SCHEMA)
+
+def write_replays(file_name: str, file_type: str, rows: int, seed: int=0) -> tuple[float, float]:
+    # Saves the replays a chunk at a time through the same sink a download does, so the file gets its rollups and
+    # player states too. Returns the seconds spent generating and the seconds spent saving
+    generating = saving = 0.0
+    player_states = get_replays._open_player_states(file_name, file_type)
+    # The save path logs every save, only the time it takes is wanted here
+    with contextlib.redirect_stdout(io.StringIO()):
+        if file_type == config.FileTypes.SQLITE:
+            get_replays._prepare_database(file_name)
+            get_replays._drop_indexes(file_name)
+        for offset in range(0, rows, CHUNK_ROWS):
+            start_time = time.perf_counter()
+            replays_df = generate_replays(min(CHUNK_ROWS, rows - offset), seed, offset)
+            generating += time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            if not get_replays._save_and_roll_up(replays_df, file_name, file_type, player_states):
+                raise RuntimeError(f'Failed to save replays to {file_name}')
+            saving += time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        if file_type == config.FileTypes.SQLITE:
+            get_replays._create_indexes(file_name)
+        get_replays._save_player_states(player_states, file_name, file_type)
+        saving += time.perf_counter() - start_time
+    return generating, saving
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a seeded synthetic replay file of any supported type')
+    parser.add_argument('file_name', help='File to save the replays to, its extension picks the file type')
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    file_type = os.path.splitext(args.file_name)[1]
+    if file_type not in (config.FileTypes.CSV, config.FileTypes.SQLITE, config.FileTypes.PARQUET):
+        parser.error(f'Unknown file type "{file_type}"')
+    if os.path.exists(args.file_name):
+        parser.error(f'{args.file_name} already exists')
+    generating, saving = write_replays(args.file_name, file_type, args.rows, args.seed)
+    days = math.ceil(args.rows * SECONDS_PER_REPLAY / 86400)
+    print(f'{args.rows:,} replays over {days} day(s) generated in {generating:.2f}s and saved in {saving:.2f}s')
+
+if __name__ == '__main__':
+    main()
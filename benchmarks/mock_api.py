@@ -0,0 +1,144 @@
+import argparse, gzip, json, random, threading, time
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from src.enums import BattleTypes, Characters, Ranks, Regions, Stages
+from src.models import ReplayData
+
+CHARACTERS = [chara.value for chara in Characters if chara != Characters.Unknown]
+RANKS = [rank.value for rank in Ranks]
+STAGES = [stage.value for stage in Stages]
+REGIONS = [region.value for region in Regions]
+BATTLE_TYPES = [battle_type.value for battle_type in BattleTypes]
+
+PLAYERS = 50_000
+
+@lru_cache(maxsize=None)
+def _profile(player_id: int) -> tuple[int, int]:
+    # Every player has a main character and a rank they hover around
+    rng = random.Random(player_id)
+    return rng.choice(CHARACTERS), rng.randrange(len(RANKS))
+
+def _player(rng: random.Random, prefix: str) -> dict:
+    # A few players play far more matches than the rest, like on the real ladder
+    player_id = min(int(rng.expovariate(5 / PLAYERS)), PLAYERS - 1)
+    main_chara, rank_index = _profile(player_id)
+    chara = main_chara if rng.random() < 0.8 else rng.choice(CHARACTERS)
+    rank = RANKS[min(max(rank_index + rng.choice([-1, 0, 0, 0, 1]), 0), len(RANKS) - 1)]
+    return {
+        f'{prefix}_area_id': rng.choice(REGIONS),
+        f'{prefix}_chara_id': chara,
+        f'{prefix}_lang': 'en',
+        f'{prefix}_name': f'Player{player_id}',
+        f'{prefix}_polaris_id': f'{player_id:012x}',
+        f'{prefix}_power': rng.randrange(1_000_000),
+        f'{prefix}_rank': rank,
+        f'{prefix}_rating_before': rng.randrange(500, 2500),
+        f'{prefix}_rating_change': rng.randrange(-30, 31),
+        f'{prefix}_region_id': rng.choice(REGIONS),
+        f'{prefix}_rounds': rng.randrange(4),
+        f'{prefix}_user_id': player_id,
+    }
+
+def generate_window(before: int, replays: int, seed: int=0) -> list[ReplayData]:
+    # Same before value and seed always gives back the same replays, like the real API would
+    rng = random.Random(seed * 1_000_003 + before)
+    window = []
+    for i in range(replays):
+        window.append({
+            'battle_at': before - 700 + rng.randrange(700),
+            'battle_id': f'{before:x}{i:06x}',
+            'battle_type': rng.choice(BATTLE_TYPES),
+            'game_version': 20000,
+            **_player(rng, 'p1'),
+            **_player(rng, 'p2'),
+            'stage_id': rng.choice(STAGES),
+            'winner': rng.choices([1, 2, 3], [0.495, 0.495, 0.01])[0],
+        })
+    return window
+
+class MockApi(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port: int=0, latency: float=0.0, jitter: float=0.0, failure_rate: float=0.0, replays: int=100, seed: int=0):
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.replays = replays
+        self.seed = seed
+        self.requests = 0
+        self.failures = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}/api/replays'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def _next_request(self) -> tuple[float, bool]:
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._rng.uniform(0, self.jitter)
+            fail = self._rng.random() < self.failure_rate
+            if fail:
+                self.failures += 1
+            return delay, fail
+
+class _Handler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep connections alive like they can with the real API
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    server: MockApi
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        delay, fail = self.server._next_request()
+        time.sleep(delay)
+        if url.path != '/api/replays':
+            self.send_error(404)
+            return
+        if fail:
+            self.send_error(503, 'Injected failure')
+            return
+        try:
+            before = int(parse_qs(url.query)['before'][0])
+        except (KeyError, ValueError):
+            self.send_error(400, 'Missing or invalid before value')
+            return
+        body = json.dumps(generate_window(before, self.server.replays, self.server.seed)).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, compresslevel=6)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the Wavu Wank replay API')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra seconds added on top of latency')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of requests answered with a 503')
+    parser.add_argument('--replays', type=int, default=100, help='Replays returned per window')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    server = MockApi(args.port, args.latency, args.jitter, args.failure_rate, args.replays, args.seed)
+    print(f'Serving mock replay API on {server.url}, point config.API_URL at it')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
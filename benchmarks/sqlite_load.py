@@ -0,0 +1,45 @@
+import argparse, os, tempfile, time, polars as pl, src.config as config
+from benchmarks.generate import generate_replays
+from src.utils.sql_utils import bulk_insert, create_indexes, create_tables, drop_indexes, finish_bulk_load
+
+def _write_database(database_file: str, batches: list[pl.DataFrame]):
+    # The old save path, every batch appended through write_database into a table that already has its indexes
+    create_indexes(database_file)
+    for batch_df in batches:
+        batch_df.write_database(table_name=config.Tables.ReplayData, connection=config.SQLITE_URI + database_file, if_table_exists='append')
+
+def _bulk_insert(database_file: str, batches: list[pl.DataFrame]):
+    drop_indexes(database_file)
+    for batch_df in batches:
+        _, e = bulk_insert(database_file, batch_df)
+        if e:
+            raise e
+    create_indexes(database_file)
+    finish_bulk_load(database_file)
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare saving replays with write_database against the bulk loader with deferred indexes')
+    parser.add_argument('--rows', type=int, default=500_000)
+    parser.add_argument('--batches', type=int, default=5, help='Number of saves the rows are split across, like flushes during a download')
+    args = parser.parse_args()
+
+    replays_df = generate_replays(args.rows)
+    batch_size = -(-replays_df.height // args.batches)
+    batches = [replays_df.slice(offset, batch_size) for offset in range(0, replays_df.height, batch_size)]
+    print(f'{replays_df.height:,} replays in {len(batches)} saves')
+    runs = [('write_database', _write_database), ('bulk insert', _bulk_insert)]
+    with tempfile.TemporaryDirectory() as directory:
+        for name, run in runs:
+            database_file = os.path.join(directory, f'{name.replace(" ", "_")}.db')
+            create_tables(database_file)
+            start_time = time.perf_counter()
+            try:
+                run(database_file, batches)
+            except ImportError as e:
+                print(f'{name:<15} skipped, {e}')
+                continue
+            elapsed = time.perf_counter() - start_time
+            print(f'{name:<15} {elapsed:7.2f}s {replays_df.height / elapsed:12,.0f} rows/s {os.path.getsize(database_file) / 2**20:8.1f} MiB')
+
+if __name__ == '__main__':
+    main()
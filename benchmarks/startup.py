@@ -0,0 +1,55 @@
+import argparse, statistics, subprocess, sys, time
+
+# Modules that are slow to import and only needed once an action is chosen, none of them should be loaded before the
+# first menu comes up
+HEAVY_MODULES = ['polars', 'requests', 'xlsxwriter', 'tqdm', 'src.get_replays', 'src.analyze_replays', 'src.utils.file_utils']
+# Everything the tool does before drawing the first menu, run in a new interpreter so nothing is imported already
+STARTUP = f'''
+import sys, time
+start_time = time.perf_counter()
+import main
+main.prompt.list_replay_files()
+elapsed = time.perf_counter() - start_time
+print(elapsed, *(module for module in {HEAVY_MODULES!r} if module in sys.modules))
+'''
+
+def time_startup(runs: int) -> tuple[list[float], list[float], list[str]]:
+    # Returns the seconds every run took from starting the process and from its first import, and the heavy modules
+    # that were loaded anyway
+    process_times, import_times, loaded = [], [], []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        output = subprocess.run([sys.executable, '-c', STARTUP], capture_output=True, text=True, check=True).stdout.split()
+        process_times.append(time.perf_counter() - start_time)
+        import_times.append(float(output[0]))
+        loaded = output[1:]
+    return process_times, import_times, loaded
+
+def _slowest_imports(count: int) -> list[tuple[int, str]]:
+    # -X importtime writes every import with the microseconds it took including the ones it imported in turn
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], capture_output=True, text=True, check=True).stderr
+    imports = []
+    for line in stderr.splitlines():
+        if line.startswith('import time:'):
+            _, cumulative, name = line.split('|')
+            # The first line is the header
+            if cumulative.strip().isdigit():
+                imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+def main():
+    parser = argparse.ArgumentParser(description='Time how long the tool takes to start up to its first menu')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--imports', type=int, default=0, help='Also list this many of the slowest imports')
+    args = parser.parse_args()
+
+    process_times, import_times, loaded = time_startup(args.runs)
+    print(f'Process start to menu {statistics.median(process_times):.3f}s median, {min(process_times):.3f}s best of {args.runs}')
+    print(f'Imports to menu       {statistics.median(import_times):.3f}s median, {min(import_times):.3f}s best of {args.runs}')
+    if loaded:
+        print(f'Loaded before the menu: {", ".join(loaded)}')
+    for microseconds, name in _slowest_imports(args.imports):
+        print(f'{microseconds / 1e6:7.3f}s {name}')
+
+if __name__ == '__main__':
+    main()
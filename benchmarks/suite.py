@@ -0,0 +1,140 @@
+import argparse, contextlib, datetime, io, json, os, platform, statistics, subprocess, tempfile, time, polars as pl, src.config as config
+from benchmarks.analyze import _run
+from benchmarks.download import START, _windowed
+from benchmarks.generate import write_replays
+from benchmarks.mock_api import MockApi
+from benchmarks.startup import time_startup
+import src.get_replays as get_replays
+from src.analyze_replays import analyze_rating_trajectories, analyze_replay_data, analyze_replays_approximately, get_matchup_matrices
+from src.utils.file_utils import write_results
+from src.utils.memory import get_peak_memory
+
+FILE_TYPES = [config.FileTypes.CSV, config.FileTypes.PARQUET, config.FileTypes.SQLITE]
+# Every analysis is timed with these settings on top of the defaults, so what each one reads from is fixed
+ANALYSES = {
+    'analyze': {},
+    'analyze replays': {'DAILY_ROLLUPS': False, 'PLAYER_STATES': False},
+    'analyze streamed': {'DAILY_ROLLUPS': False, 'PLAYER_STATES': False, 'STREAM_ANALYSIS': True},
+    'rating trajectories': {},
+    'approximate': {}
+}
+EXPORTS = {
+    'excel export': config.ResultsFormats.XLSX,
+    'parquet export': config.ResultsFormats.PARQUET,
+    'ipc export': config.ResultsFormats.IPC,
+    'csv export': config.ResultsFormats.CSV
+}
+
+def _configure(overrides: dict):
+    # Cached results would be loaded instead of measuring anything
+    config.RESULTS_CACHE = False
+    for name, value in overrides.items():
+        setattr(config, name, value)
+
+def _write(file_name: str, file_type: str, rows: int, seed: int) -> tuple[float, float, int | None]:
+    return *write_replays(file_name, file_type, rows, seed), get_peak_memory()
+
+def _analyze(name: str, file_name: str) -> tuple[float, int | None]:
+    _configure(ANALYSES[name])
+    start_time = time.perf_counter()
+    # The results are printed by the analysis, they are not what is being measured here
+    with contextlib.redirect_stdout(io.StringIO()):
+        if name == 'rating trajectories':
+            analyze_rating_trajectories(file_name)
+        elif name == 'approximate':
+            analyze_replays_approximately([file_name])
+        else:
+            analyze_replay_data(file_name)
+    return time.perf_counter() - start_time, get_peak_memory()
+
+def _export(name: str, file_name: str, directory: str) -> tuple[float, int | None]:
+    # Only the export is timed, the analysis before it is what gets exported
+    _configure({'XLSX_FILE_BASE_NAME': directory + '/', 'RESULTS_FORMATS': [EXPORTS[name]]})
+    with contextlib.redirect_stdout(io.StringIO()):
+        win_rates, player_stats, rank_percentiles_and_distribution, win_rates_by_rank, matchups = analyze_replay_data(file_name)
+        start_time = time.perf_counter()
+        write_results(file_name, [
+            (win_rates, 'Character Stats (CS)',),
+            (player_stats, 'Player Stats',),
+            (rank_percentiles_and_distribution, 'Rank Percentiles & Distribution',),
+            (matchups, 'Matchups',)
+        ] + [(df, f'CS {rank}') for rank, df in win_rates_by_rank.items()] + get_matchup_matrices(matchups))
+    return time.perf_counter() - start_time, get_peak_memory()
+
+def _download(windows: int) -> tuple[float, int | None]:
+    # As fast as the mock API can answer, so the time is all spent in the download loop itself
+    server = MockApi().start()
+    config.API_URL = server.url
+    try:
+        befores = get_replays._get_windows(START, START + windows * config.REPLAY_WINDOW_SECONDS)
+        start_time = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            _windowed(befores, 1_000_000, config.DOWNLOAD_WORKERS)
+        return time.perf_counter() - start_time, get_peak_memory()
+    finally:
+        server.stop()
+
+def _get_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+def _record(results: list[dict], benchmark: str, file_type: str | None, rows: int, seconds: float, peak_memory: int | None):
+    results.append({'benchmark': benchmark, 'file_type': file_type, 'rows': rows, 'seconds': seconds, 'peak_memory': peak_memory})
+    memory = f'{peak_memory / 2**20:7,.0f} MiB peak' if peak_memory else ''
+    print(f'{benchmark:<20} {file_type or "":<9} {rows:>12,} {seconds:8.2f}s {memory}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Time starting up, generating, saving, analyzing, exporting and downloading synthetic replays and save the timings as JSON')
+    parser.add_argument('--rows', type=int, nargs='+', default=[1_000_000], help='Sizes of the replay files, for example 1000000 10000000 50000000')
+    parser.add_argument('--file-types', nargs='+', default=FILE_TYPES, choices=FILE_TYPES)
+    parser.add_argument('--benchmarks', nargs='+', default=list(ANALYSES) + ['excel export'], choices=list(ANALYSES) + list(EXPORTS))
+    parser.add_argument('--windows', type=int, default=200, help='Windows downloaded from the mock API, 0 to skip the download')
+    parser.add_argument('--startup-runs', type=int, default=10, help='Times the tool is started up to its first menu, 0 to skip timing the startup')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', help='Keep the generated files here and reuse them in later runs instead of generating them again')
+    parser.add_argument('--output', help='JSON file to save the timings to, by default one named after the time and commit in benchmarks/results')
+    args = parser.parse_args()
+
+    commit = _get_commit()
+    started = datetime.datetime.now(datetime.timezone.utc)
+    output = args.output or os.path.join('benchmarks', 'results', f'{started:%Y%m%dT%H%M%S}_{commit or "unknown"}.json')
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        data_dir = args.data_dir or directory
+        os.makedirs(data_dir, exist_ok=True)
+        if args.startup_runs:
+            _record(results, 'startup', None, args.startup_runs, statistics.median(time_startup(args.startup_runs)[0]), None)
+        if args.windows:
+            _record(results, 'download', None, args.windows, *_run(_download, args.windows))
+        for rows in args.rows:
+            for file_type in args.file_types:
+                file_name = os.path.join(data_dir, f'replay_data_{args.seed}_{rows}{file_type}')
+                # Reused files were saved by an earlier run, so there is no save to time
+                if not os.path.exists(file_name):
+                    generating, saving, peak_memory = _run(_write, file_name, file_type, rows, args.seed)
+                    _record(results, 'generate', file_type, rows, generating, None)
+                    _record(results, 'save', file_type, rows, saving, peak_memory)
+                for benchmark in args.benchmarks:
+                    if benchmark in EXPORTS:
+                        _record(results, benchmark, file_type, rows, *_run(_export, benchmark, file_name, directory))
+                    else:
+                        _record(results, benchmark, file_type, rows, *_run(_analyze, benchmark, file_name))
+
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf8') as file:
+        json.dump({
+            'commit': commit,
+            'started': started.isoformat(),
+            'python': platform.python_version(),
+            'polars': pl.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'seed': args.seed,
+            'results': results
+        }, file, indent=2)
+    print(f'Saved the timings to {output}')
+
+if __name__ == '__main__':
+    main()
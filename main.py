@@ -1,7 +1,13 @@
-import src.prompt as prompt
+import src.config as config, src.prompt as prompt
 
 def main():
-    while prompt.prompt(): pass
+    # Every action gets a trace of its own when tracing is on. Tracing needs polars, so it is only imported when it is on
+    while prompt.prompt():
+        if config.TRACE:
+            import src.utils.logger as logger
+            from src.utils.tracing import write_trace
+            if trace_file := write_trace():
+                logger.io(f'Saved a trace of where the time went to {trace_file}')
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,160 +1,252 @@
-import sqlite3, src.config as config, polars as pl, src.utils.logger as logger
+import datetime, sqlite3, src.config as config, polars as pl, src.utils.logger as logger
 from pathlib import Path
+from typing import Iterable
+from src.utils.parquet_utils import scan_dataset
+from src.models import ANALYSIS_SCHEMA
+from src.utils.sql_utils import create_indexes, get_chara_counts, iter_replays
+from src.utils.counts import (
+    COUNT_DTYPES, count_charas, count_matchups, count_players, merge_chara_counts, merge_matchup_counts, merge_player_counts,
+    narrow_counts, unpivot_players
+)
+from src.utils.bootstrap import bootstrap_rates
+from src.utils.memory import get_peak_memory
+from src.utils.rollups import DailyRollups
+from src.utils.sketches import (
+    HLL_ERROR, POWER_ERROR, TOP_PLAYERS, estimate_distinct_players, estimate_power_percentiles, merge_distinct_players,
+    merge_powers, merge_top_players, sketch_distinct_players, sketch_powers, sketch_top_players
+)
+from src.utils.player_states import STATES_SUFFIX, PlayerStates, is_valid, scan_states
+from src.utils.results_cache import get_cache_key, load_results, save_results
+from src.get_replays import get_sink_offset
 from src.utils.timer import Timer
+from src.utils.tracing import collect_all, iter_spans, span, traced
 from src.enums import *
 
+COLUMNS = ['battle_at', 'game_version', 'p1_polaris_id', 'p1_chara_id', 'p1_name', 'p1_rank', 'p2_polaris_id', 'p2_chara_id', 'p2_name', 'p2_rank', 'winner']
+SCHEMA = pl.Schema({column: ANALYSIS_SCHEMA[column] for column in COLUMNS})
+# Powers are only sketched, for the rollups and approximate analysis
+SKETCH_COLUMNS = COLUMNS + ['p1_power', 'p2_power']
+POWER_PERCENTILES = [0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99]
+# Roughly what a match takes up once the columns above are read, measured on synthetic replays
+BYTES_PER_MATCH = 100
+# Outcome of a count for the player it counts
+_WIN, _LOSS, _TIE = 0, 1, 2
+
 def _get_data_from_table(file_path, table, columns=['*']):
     with sqlite3.connect(file_path) as connection:
         return pl.read_database(f'select {', '.join(columns)} from {table}', connection)
 
-def _calculate_character_win_rate(replay_df: pl.DataFrame):
-    chara_lookup = pl.DataFrame({
-        'chara_id': [chara.value for chara in Characters],
+def _get_chara_lookup():
+    return pl.LazyFrame({
+        'chara_id': pl.Series([chara.value for chara in Characters], dtype=COUNT_DTYPES['chara_id']),
         'chara_name': [chara.name.replace('_', ' ') for chara in Characters]
     })
-    characters_df = (
-        replay_df
-        .join(chara_lookup.rename({"chara_id": "p1_chara_id", "chara_name": "p1_chara"}), on="p1_chara_id", how="left")
-        .join(chara_lookup.rename({"chara_id": "p2_chara_id", "chara_name": "p2_chara"}), on="p2_chara_id", how="left")
+
+def _with_outcomes(chara_counts: pl.LazyFrame, p2_ties_split: bool=False):
+    # Whether every count adds to its character's wins, losses and ties. The outcome of every count is coded as a small
+    # integer so nothing is compared as a string. With p2_ties_split a tie also counts as a win and a loss for player 2,
+    # like the overall win rates always have
+    outcome = (
+        pl.when(pl.col('winner') == pl.col('side')).then(pl.lit(_WIN, pl.Int8))
+          .when(pl.col('winner') == 3).then(pl.lit(_TIE, pl.Int8))
+          .otherwise(pl.lit(_LOSS, pl.Int8))
     )
-    characters_df = characters_df.with_columns([
-        pl
-        .when(pl.col('winner') == 1)
-        .then(pl.col('p1_chara'))
-        .otherwise(pl.col('p2_chara'))
-        .alias('Winner'),
-        pl
-        .when(pl.col('winner') == 2)
-        .then(pl.col('p1_chara'))
-        .otherwise(pl.col('p2_chara'))
-        .alias('Loser'),
-        pl
-        .when(pl.col('winner') == 3)
-        .then(pl.col('p1_chara'))
-        .otherwise(None)
-        .alias('Tie1'),
-        pl
-        .when(pl.col('winner') == 3)
-        .then(pl.col('p2_chara'))
-        .otherwise(None)
-        .alias('Tie2')
+    split_tie = (pl.col('side') == 2) & (pl.col('Outcome') == _TIE) if p2_ties_split else pl.lit(False)
+    return chara_counts.with_columns(outcome.alias('Outcome')).with_columns([
+        ((pl.col('Outcome') == _WIN) | split_tie).alias('win'),
+        ((pl.col('Outcome') == _LOSS) | split_tie).alias('loss'),
+        (pl.col('Outcome') == _TIE).alias('tie')
     ])
-    wins = (
-        characters_df
-        .group_by('Winner')
-        .agg(pl.count().alias('Wins'))
-        .rename({'Winner': 'Character'})
-        .select('Character', 'Wins')
-    )
-    losses = (
-        characters_df
-        .group_by('Loser')
-        .agg(pl.count().alias('Losses'))
-        .rename({'Loser': 'Character'})
-        .select('Character', 'Losses')
-    )
-    ties = (
-        characters_df
-        .select(['Tie1', 'Tie2'])
-        .unpivot(variable_name='Slot', value_name='Character')
-        .drop_nulls()
-        .group_by('Character')
-        .agg(pl.count().alias('Ties'))
-        .select('Character', 'Ties')
-    )
-    picks = (
-        wins
-        .join(losses, on='Character', how='inner', coalesce=True)
-        .join(ties, on='Character', how='full', coalesce=True)
-    )
-    total_picks = picks.select(pl.col('Wins') + pl.col('Losses') + pl.col('Ties')).sum().to_series(0)[0]
 
-    stats = (
-        wins
-        .join(losses, on='Character', how='full', coalesce=True)
-        .join(ties, on='Character', how='full', coalesce=True)
-        .join(picks, on='Character', how='full', coalesce=True)
-        .fill_null(0)
+def _count_outcomes(chara_counts: pl.LazyFrame, by: list[str], p2_ties_split: bool=False):
+    # Wins, losses, ties and games for any grouping of the character counts in a single group by, names are only
+    # attached once it is counted
+    return (
+        _with_outcomes(chara_counts, p2_ties_split)
+        .group_by(by)
+        .agg([
+            pl.col('games').filter('win').sum().alias('Wins'),
+            pl.col('games').filter('loss').sum().alias('Losses'),
+            pl.col('games').filter('tie').sum().alias('Ties')
+        ])
         .with_columns([
             (pl.col('Wins') + pl.col('Losses') + pl.col('Ties')).alias('TotalGames'),
-            (pl.col('Wins') / (pl.col('Wins') + pl.col('Losses'))).alias('RawWinRate'),
-            ((pl.col('Wins') + pl.col('Losses') + pl.col('Ties')) / total_picks).alias('PickRate')
+            (pl.col('Wins') / (pl.col('Wins') + pl.col('Losses'))).alias('RawWinRate')
         ])
+        .join(_get_chara_lookup().rename({'chara_name': 'Character'}), on='chara_id', how='left')
     )
 
-    return stats.select(
+def _with_bayesian_win_rate(rates: pl.LazyFrame, by: list[str]):
+    # Every character's win rate with as many games again as the average character has played, won at the average win
+    # rate, so characters with few games are pulled toward the average the most. Only worked out when asked for
+    if not config.BAYESIAN_WIN_RATES:
+        return rates
+    over = lambda expr: expr.over(by) if by else expr
+    prior_games = over(2 * pl.col('Wins').mean())
+    return rates.with_columns(
+        ((pl.col('Wins') + prior_games * over(pl.col('RawWinRate').mean())) / (pl.col('Wins') + pl.col('Losses') + prior_games)).alias('BayesianWinRate')
+    )
+
+def _get_outcome_counts(chara_counts: pl.LazyFrame, by: list[str], p2_ties_split: bool=False):
+    # Games per character and outcome, the confidence intervals are resampled from these
+    return _with_outcomes(chara_counts, p2_ties_split).group_by(by + ['chara_id', 'win', 'loss', 'tie']).agg(pl.sum('games'))
+
+def _with_confidence_intervals(rates: pl.DataFrame, outcome_counts: pl.DataFrame, by: list[str]):
+    # Percentile bootstrap intervals go right after the rates they are for
+    intervals = bootstrap_rates(outcome_counts, by, config.BOOTSTRAP_RESAMPLES, config.CONFIDENCE_LEVEL).join(
+        _get_chara_lookup().rename({'chara_name': 'Character'}).collect(), on='chara_id', how='left'
+    ).drop('chara_id').rename({'rank': 'Rank'} if by else {})
+    columns = []
+    for column in rates.columns:
+        columns += [column] + {
+            'RawWinRate': ['WinRateLow', 'WinRateHigh'],
+            'PickRate': ['PickRateLow', 'PickRateHigh']
+        }.get(column, [])
+    return rates.join(intervals, on=['Rank', 'Character'] if by else ['Character'], how='left', maintain_order='left').select(columns)
+
+def _calculate_character_win_rate_from_counts(chara_counts: pl.LazyFrame):
+    # Total picks is summed in the plan rather than collected up front so it doesn't need a pass of its own
+    return _count_outcomes(chara_counts, ['chara_id'], p2_ties_split=True).with_columns(
+        (pl.col('TotalGames') / pl.sum('TotalGames')).alias('PickRate')
+    ).pipe(_with_bayesian_win_rate, []).select(
         'Character',
         'Wins',
         'Losses',
         'Ties',
         'TotalGames',
         'RawWinRate',
+        *(['BayesianWinRate'] if config.BAYESIAN_WIN_RATES else []),
         'PickRate'
     ).sort('RawWinRate', descending=True)
 
-def _get_unique_players_stats(replay_df: pl.DataFrame):
-    # Data to get from players:
-    # wins, losses, total games, most played character, most played character games, win rate, highest rank, average rank
-    # Step 1: Normalize players into one row per player per match
-    players_df = pl.DataFrame({
-        "battle_at": pl.concat([replay_df["battle_at"]] * 2),
-        "PolarisId": pl.concat([replay_df["p1_polaris_id"], replay_df["p2_polaris_id"]]),
-        "PlayerName": pl.concat([replay_df["p1_name"], replay_df["p2_name"]]),
-        "CharaId": pl.concat([replay_df["p1_chara_id"], replay_df["p2_chara_id"]]),
-        "Rank": pl.concat([replay_df["p1_rank"], replay_df["p2_rank"]]),
-        "IsWin": pl.concat([
-            (replay_df["winner"] == 1).cast(pl.Int8),
-            (replay_df["winner"] == 2).cast(pl.Int8)
-        ]),
-        "IsTie": pl.concat([
-            ((replay_df["winner"].is_null()) | (replay_df["winner"] == 3)).cast(pl.Int8),
-            ((replay_df["winner"].is_null()) | (replay_df["winner"] == 3)).cast(pl.Int8)
-        ]),
-    })
+def _calculate_matchups_from_counts(matchup_counts: pl.LazyFrame):
+    # Every character against every other one from the side of the first, so each pair shows up once for each of them.
+    # Split by game version and rank only when asked for, every split gets a matrix sheet of its own when exported
+    splits = (['game_version'] if config.MATCHUPS_BY_GAME_VERSION else []) + (['rank'] if config.MATCHUPS_BY_RANK else [])
+    opponent_lookup = _get_chara_lookup().rename({'chara_id': 'opponent_chara_id', 'chara_name': 'Opponent'})
+    return _count_outcomes(matchup_counts, splits + ['chara_id', 'opponent_chara_id']).join(
+        opponent_lookup, on='opponent_chara_id', how='left'
+    ).sort(splits + ['chara_id', 'opponent_chara_id']).select(
+        *[pl.col(split).alias(name) for split, name in (('game_version', 'GameVersion'), ('rank', 'Rank')) if split in splits],
+        'Character',
+        'Opponent',
+        'Wins',
+        'Losses',
+        'Ties',
+        'TotalGames',
+        'RawWinRate'
+    )
+
+def get_matchup_matrices(matchups: pl.DataFrame) -> list[tuple[pl.DataFrame, str]]:
+    # Win rate of every character in a row against every character in a column, with the sheet name of each matrix
+    splits = [split for split in ('GameVersion', 'Rank') if split in matchups.columns]
+    charas = [chara.name.replace('_', ' ') for chara in Characters]
+    parts = matchups.partition_by(splits, as_dict=True, maintain_order=True).items() if splits else [((), matchups)]
+    matrices = []
+    for keys, matchups_df in parts:
+        matrix = matchups_df.pivot('Opponent', index='Character', values='RawWinRate', sort_columns=False)
+        opponents = [chara for chara in charas if chara in matrix.columns]
+        names = dict(zip(splits, keys))
+        sheet = ' '.join(['MU'] + (
+            [f'v{names['GameVersion']}'] if 'GameVersion' in names else []
+        ) + (
+            [Ranks(names['Rank']).name.replace('_', ' ')] if 'Rank' in names else []
+        ))
+        # Excel sheet names can't be longer than 31 characters
+        matrices.append((matrix.select(['Character'] + opponents), sheet[:31]))
+    return matrices
+
+def get_result_sheets(results: tuple, rating_trajectories: tuple[pl.DataFrame, pl.DataFrame] | None=None) -> list[tuple[pl.DataFrame, str]]:
+    # Every sheet the results of analyze_replay_data are exported as, with the rating trajectories when they were asked for
+    win_rates, player_stats, rank_percentiles_and_distribution, win_rates_by_rank, matchups = results
+    return [
+        (win_rates, 'Character Stats (CS)',),
+        (player_stats, 'Player Stats',),
+        (rank_percentiles_and_distribution, 'Rank Percentiles & Distribution',)
+    ] + [
+        (df, 'CS ' + Ranks(rank).name.replace('_', ' ')) for rank, df in win_rates_by_rank.items()
+    ] + [
+        (matchups, 'Matchups',)
+    ] + get_matchup_matrices(matchups) + ([
+        (rating_trajectories[0], 'Rating Trajectories',),
+        (rating_trajectories[1], 'Character Rating Trends',)
+    ] if rating_trajectories else [])
 
-    # Step 2: Get the most recent player name per player
-    latest_player_info = (
-        players_df
-        .sort('battle_at', descending=True)
+def _get_unique_players_stats_from_counts(player_counts: pl.LazyFrame):
+    # Player counts are already grouped by character and rank, so everything per player comes from summing those
+    player_counts = player_counts.rename({'polaris_id': 'PolarisId'})
+    totals = (
+        player_counts
         .group_by('PolarisId')
         .agg([
-            pl.first('PlayerName'),
-            #pl.first('Rank').alias('MostRecentRank')
+            pl.sum('games'),
+            pl.sum('wins'),
+            pl.sum('ties'),
+            pl.col('name').get(pl.col('battle_at').arg_max())
         ])
     )
+    ranks = player_counts.group_by(['PolarisId', 'rank']).agg(pl.sum('games'))
+    charas = player_counts.group_by(['PolarisId', 'chara_id']).agg(pl.sum('games'))
+    return _get_unique_players_stats_from_histograms(totals, ranks, charas)
 
-    # Step 3: Aggregate stats per player
-    stats = (
-        players_df
+def _get_unique_players_stats_from_states(player_states: pl.LazyFrame):
+    # The saved player states already hold the totals and histograms per player, so this reads one row per player
+    # Games are cast to the type the counts have so the results are the same whichever they came from
+    games = {'games': pl.UInt32, 'wins': pl.UInt32, 'ties': pl.UInt32}
+    totals = narrow_counts(player_states.select(['polaris_id', 'games', 'wins', 'ties', 'name'])).cast(games)
+    ranks = narrow_counts(player_states.select(['polaris_id', 'ranks']).explode('ranks').unnest('ranks'))
+    charas = narrow_counts(player_states.select(['polaris_id', 'charas']).explode('charas').unnest('charas')).cast({'games': pl.UInt32})
+    totals, ranks, charas = (histogram.rename({'polaris_id': 'PolarisId'}) for histogram in (totals, ranks, charas))
+    return _get_unique_players_stats_from_histograms(totals, ranks, charas)
+
+def _get_unique_players_stats_from_histograms(totals: pl.LazyFrame, ranks: pl.LazyFrame, charas: pl.LazyFrame):
+    latest_player_info = totals.select(['PolarisId', pl.col('name').alias('PlayerName')])
+
+    # Median and mode come from each player's games per rank, the median is the average of the middle 2 games when
+    # there is an even number of them
+    ranks = (
+        ranks
+        .sort(['PolarisId', 'rank'])
+        .with_columns([
+            pl.col('games').cum_sum().over('PolarisId').alias('CumulativeGames'),
+            pl.col('games').sum().over('PolarisId').alias('PlayerGames')
+        ])
         .group_by('PolarisId')
         .agg([
-            pl.count().alias('TotalGames'),
-            pl.sum('IsWin').cast(pl.Int64).alias('Wins'),
-            (pl.count() - pl.sum('IsWin') - pl.sum('IsTie')).cast(pl.Int64).alias('Losses'),
-            pl.sum('IsTie').cast(pl.Int64).alias('Ties'),
-            (pl.mean('IsWin')).alias('WinRate'),
-            pl.max('Rank').alias('HighestRank'),
-            pl.col('Rank').median().cast(pl.Int64).alias('MedianRank'),
-            pl.col('Rank').mode().first().alias('ModeRank')
+            pl.max('rank').alias('HighestRank'),
+            (
+                (
+                    pl.col('rank').filter(pl.col('CumulativeGames') > (pl.col('PlayerGames') - 1) // 2).first()
+                    + pl.col('rank').filter(pl.col('CumulativeGames') > pl.col('PlayerGames') // 2).first()
+                ) / 2
+            ).cast(pl.Int64).alias('MedianRank'),
+            pl.col('rank').sort_by('games', descending=True, maintain_order=True).first().alias('ModeRank')
         ])
     )
-
-    # Step 4: Most played character per player (with count)
-    chara_counts = (
-        players_df
-        .group_by(['PolarisId', 'CharaId'])
-        .agg(pl.count().alias('GamesPlayed'))
+    stats = (
+        totals
+        .select([
+            'PolarisId',
+            pl.col('games').alias('TotalGames'),
+            pl.col('wins').alias('Wins'),
+            (pl.col('games') - pl.col('wins') - pl.col('ties')).alias('Losses'),
+            pl.col('ties').alias('Ties'),
+            (pl.col('wins') / pl.col('games')).alias('WinRate')
+        ])
+        .join(ranks, on='PolarisId')
     )
 
-    # Get top character per player
+    # Ties for the most played character go to the lowest chara_id so counts and states always agree
     most_played_chara = (
-        chara_counts
-        .sort(['PolarisId', 'GamesPlayed'], descending=[False, True])
+        charas
+        .sort(['PolarisId', 'games', 'chara_id'], descending=[False, True, False])
         .unique(subset='PolarisId', keep='first')
-        .select(['PolarisId', 'CharaId', 'GamesPlayed'])
-        .rename({'CharaId': 'MostPlayedChara', 'GamesPlayed': 'MostPlayedCharaGames'})
+        .select(['PolarisId', 'chara_id', 'games'])
+        .rename({'chara_id': 'MostPlayedChara', 'games': 'MostPlayedCharaGames'})
     )
+    return _summarize_players_stats(stats, latest_player_info, most_played_chara)
 
+def _summarize_players_stats(stats: pl.LazyFrame, latest_player_info: pl.LazyFrame, most_played_chara: pl.LazyFrame):
     chara_id_to_name = {chara.value: chara.name.replace('_', ' ') for chara in Characters}
     rank_id_to_name = {rank.value: rank.name.replace('_', ' ') for rank in Ranks}
 
@@ -172,8 +264,9 @@ def _get_unique_players_stats(replay_df: pl.DataFrame):
         ])
     )
 
+    # Polaris ids are decoded from the dictionary they were counted with
     return player_stats.select([
-        'PolarisId',
+        pl.col('PolarisId').cast(pl.String),
         'PlayerName',
         'Wins',
         'Losses',
@@ -187,11 +280,12 @@ def _get_unique_players_stats(replay_df: pl.DataFrame):
         'MostPlayedCharaGames',
     ]).sort('TotalGames', descending=True)
 
-def _get_rank_percentiles_and_distribution(player_stats_df: pl.DataFrame):
+def _get_rank_percentiles_and_distribution(player_stats_df: pl.LazyFrame):
     rank_counts = player_stats_df.group_by(['ModeRank', 'ModeRankName']).agg(
-        [pl.count().alias('Players')]
+        [pl.len().alias('Players')]
     ).sort('ModeRank')
-    total_players = player_stats_df.height
+    # Every player is counted in exactly one mode rank so the total comes from the counts
+    total_players = pl.sum('Players')
     rank_distribution = rank_counts.with_columns(
         (pl.col('Players') / total_players).alias('ModeRankDistribution')
     )
@@ -201,7 +295,7 @@ def _get_rank_percentiles_and_distribution(player_stats_df: pl.DataFrame):
     rank_percentiles = rank_percentiles.with_columns(
         (pl.col('CumulativePlayers') / total_players).alias('ModeRankPercentile')
     )
-    return rank_percentiles.join(rank_distribution, 'ModeRank').select([
+    return rank_percentiles.join(rank_distribution.select(['ModeRank', 'ModeRankDistribution']), 'ModeRank').select([
         'ModeRank',
         'ModeRankName',
         'ModeRankPercentile',
@@ -209,70 +303,27 @@ def _get_rank_percentiles_and_distribution(player_stats_df: pl.DataFrame):
         'Players'
     ])
 
-def _calculate_character_win_rate_by_rank(replay_df: pl.DataFrame):
-    # Split all matches into 2 rows, one for winner and one for loser
-    # The columns should be chara, rank, winner
-    chara_lookup = pl.DataFrame({
-        'chara_id': [chara.value for chara in Characters],
-        'chara_name': [chara.name.replace('_', ' ') for chara in Characters]
-    })
-    characters_df = (
-        replay_df
-        .join(chara_lookup.rename({"chara_id": "p1_chara_id", "chara_name": "p1_chara"}), on="p1_chara_id", how="left")
-        .join(chara_lookup.rename({"chara_id": "p2_chara_id", "chara_name": "p2_chara"}), on="p2_chara_id", how="left")
-    )
-    # The selects here treat ties as losses, so not quite accurate but should be fine
-    characters_df = (
-        pl.concat([
-            characters_df.select([
-                pl.col('p1_chara').alias('Character'),
-                pl.col('p1_rank').alias('Rank'),
-                pl.when(pl.col('winner') == 1).then(pl.lit('win'))
-                  .when(pl.col('winner') == 3).then(pl.lit('tie'))
-                  .otherwise(pl.lit('loss'))
-                .alias('Outcome')
-            ]),
-            characters_df.select([
-                pl.col('p2_chara').alias('Character'),
-                pl.col('p2_rank').alias('Rank'),
-                pl.when(pl.col('winner') == 2).then(pl.lit('win'))
-                  .when(pl.col('winner') == 3).then(pl.lit('tie'))
-                  .otherwise(pl.lit('loss'))
-                .alias('Outcome')
-            ])
-        ])
-        .group_by(['Character', 'Rank'])
-        .agg([
-            (pl.col('Outcome') == 'win').sum().alias('Wins'),
-            (pl.col('Outcome') == 'loss').sum().alias('Losses'),
-            (pl.col('Outcome') == 'tie').sum().alias('Ties'),
-            pl.len().alias('TotalGames')
-        ])
-        .with_columns(
-            (pl.col('Wins') / (pl.col('Wins') + pl.col('Losses'))).alias('RawWinRate')
-        )
-    )
-    # To get pick rate, doesn't work when done in the with_columns above so have to do it explicitly like this
-    rank_totals = (
-        characters_df
-        .group_by('Rank')
-        .agg(
-            pl.sum('TotalGames').alias('RankTotalGames')
-        )
-    )
-    characters_df = (
-        characters_df
-        .join(rank_totals, on='Rank')
-        .with_columns(
-            (pl.col('TotalGames') / pl.col('RankTotalGames')).alias('PickRate')
-        )
+def _calculate_character_win_rate_by_rank_from_counts(chara_counts: pl.LazyFrame):
+    return _count_outcomes(chara_counts, ['chara_id', 'rank']).with_columns(
+        (pl.col('TotalGames') / pl.col('TotalGames').sum().over('rank')).alias('PickRate')
+    ).pipe(_with_bayesian_win_rate, ['rank']).select(
+        pl.col('rank').alias('Rank'),
+        'Character',
+        'Wins',
+        'Losses',
+        'Ties',
+        'TotalGames',
+        'RawWinRate',
+        *(['BayesianWinRate'] if config.BAYESIAN_WIN_RATES else []),
+        'PickRate'
     )
 
+def _split_by_rank(characters_df: pl.DataFrame):
     return dict(sorted({
         rank[0]: (
             df
             .sort('RawWinRate', descending=True)
-            .drop('Rank', 'RankTotalGames')
+            .drop('Rank')
         )
         for rank, df in characters_df.partition_by(
             'Rank',
@@ -281,41 +332,579 @@ def _calculate_character_win_rate_by_rank(replay_df: pl.DataFrame):
         ).items()
     }.items()))
 
-def analyze_replay_data(file_path: str):
+def _scan_replays(file_path: str, file_type: str, columns: list[str]=COLUMNS) -> pl.LazyFrame:
+    # Read as the narrow analysis types straight away so the replays take up as little memory as possible
+    schema = pl.Schema({column: ANALYSIS_SCHEMA[column] for column in columns})
+    if file_type == config.FileTypes.SQLITE:
+        return _get_data_from_table(file_path, config.Tables.ReplayData, columns).lazy().cast(schema)
+    if file_type == config.FileTypes.PARQUET:
+        return scan_dataset(file_path).select(columns).cast(schema)
+    return pl.scan_csv(file_path, schema_overrides=schema).select(columns)
+
+def _get_batch_size():
+    # Unpivoting and counting a batch takes several times the memory the batch itself does
+    return max(config.ANALYSIS_MEMORY_BUDGET // 8 // BYTES_PER_MATCH, 10_000)
+
+def _iter_batches(file_path: str, file_type: str, columns: list[str]=COLUMNS) -> Iterable[pl.DataFrame]:
+    if file_type == config.FileTypes.SQLITE:
+        return iter_replays(file_path, columns, pl.Schema({column: ANALYSIS_SCHEMA[column] for column in columns}), _get_batch_size())
+    return _scan_replays(file_path, file_type, columns).collect_batches(chunk_size=_get_batch_size())
+
+def _count_in_batches(
+    batches: Iterable[pl.DataFrame],
+    with_charas: bool=True,
+    with_players: bool=True,
+    with_matchups: bool=True
+):
+    # Counts from every batch are combined once the ones added since the last time take up a quarter of the budget, so
+    # only the combined counts grow with the size of the file
+    chara_counts, player_counts, matchup_counts = [], [], []
+    unmerged_bytes = 0
+    for replay_df in iter_spans(batches, 'read batch', 'read'):
+        with span('count batch', 'aggregate', rows=replay_df.height):
+            players_df = unpivot_players(replay_df)
+            if with_charas:
+                chara_counts.append(count_charas(players_df))
+            if with_matchups:
+                matchup_counts.append(count_matchups(replay_df))
+                unmerged_bytes += matchup_counts[-1].estimated_size()
+            if with_players:
+                player_counts.append(count_players(players_df))
+                unmerged_bytes += player_counts[-1].estimated_size()
+        if unmerged_bytes > config.ANALYSIS_MEMORY_BUDGET // 4:
+            with span('merge counts', 'aggregate', bytes=unmerged_bytes):
+                player_counts = [merge_player_counts(player_counts)] if with_players else []
+                matchup_counts = [merge_matchup_counts(matchup_counts)] if with_matchups else []
+            unmerged_bytes = 0
+    with span('merge counts', 'aggregate'):
+        return (
+            merge_chara_counts(chara_counts) if with_charas else None,
+            merge_player_counts(player_counts) if with_players else None,
+            merge_matchup_counts(matchup_counts) if with_matchups else None
+        )
+
+def _analyze_counts(
+    chara_counts: pl.LazyFrame,
+    player_counts: pl.LazyFrame | None,
+    matchup_counts: pl.LazyFrame,
+    player_states: pl.LazyFrame | None=None
+):
+    # Every result is one plan over the same counts and collected together, so anything they share is only worked out
+    # once and the independent parts run in parallel
+    # The counts are marked as cached since the optimizer doesn't spot that every result below is built from them.
+    # Counts read from rollups or a database are narrowed to the types counting uses, so the results are the same
+    # types whatever they were worked out from
+    chara_counts = narrow_counts(chara_counts).cache()
+    if player_states is not None:
+        player_stats = _get_unique_players_stats_from_states(player_states).cache()
+    else:
+        player_stats = _get_unique_players_stats_from_counts(narrow_counts(player_counts).cache()).cache()
+    win_rates, player_stats, rank_percentiles_and_distribution, win_rates_by_rank, matchups, *outcome_counts = collect_all([
+        _calculate_character_win_rate_from_counts(chara_counts),
+        player_stats,
+        _get_rank_percentiles_and_distribution(player_stats),
+        _calculate_character_win_rate_by_rank_from_counts(chara_counts),
+        _calculate_matchups_from_counts(narrow_counts(matchup_counts))
+    ] + ([
+        _get_outcome_counts(chara_counts, [], p2_ties_split=True),
+        _get_outcome_counts(chara_counts, ['rank'])
+    ] if config.CONFIDENCE_INTERVALS else []), 'aggregate')
+    if outcome_counts:
+        timer = Timer()
+        timer.start()
+        logger.io('Attempting to bootstrap confidence intervals for the win and pick rates')
+        try:
+            with span('bootstrap', 'aggregate', resamples=config.BOOTSTRAP_RESAMPLES):
+                win_rates = _with_confidence_intervals(win_rates, outcome_counts[0], [])
+                win_rates_by_rank = _with_confidence_intervals(win_rates_by_rank, outcome_counts[1], ['rank'])
+            logger.io('Succesfully bootstrapped confidence intervals for the win and pick rates', timer.stop_get_elapsed_reset())
+        except ImportError as e:
+            logger.io_error('Failed to bootstrap confidence intervals, numpy needs to be installed for them with uv sync --extra intervals', e)
+    return win_rates, player_stats, rank_percentiles_and_distribution, _split_by_rank(win_rates_by_rank), matchups
+
+def _print_results(
+    win_rates: pl.DataFrame,
+    player_stats: pl.DataFrame,
+    rank_percentiles_and_distribution: pl.DataFrame,
+    win_rates_by_rank: dict[int, pl.DataFrame],
+    matchups: pl.DataFrame
+):
+    print(win_rates)
+    print(player_stats)
+    print(rank_percentiles_and_distribution)
+    # The lowest rank played, there are none at all when nothing was played in the dates analyzed
+    if win_rates_by_rank:
+        print(next(iter(win_rates_by_rank.values())))
+    print(matchups)
+
+def _analyze_counts_in_database(file_path: str, player_states: pl.LazyFrame | None):
+    # The database counts the characters so only a few thousand rows are read out of it for those, and players are
+    # counted a batch at a time so every match is never held in memory at once
     timer = Timer()
 
-    # Get replay data
+    # Databases from older versions don't have the indexes the character counts are read from yet
     timer.start()
-    is_sql = Path(file_path).suffix == '.db'
-    logger.io('Attempting to get game stats from file')
-    if is_sql:
-        replay_df = _get_data_from_table(file_path, config.Tables.ReplayData, ['battle_at', 'p1_polaris_id', 'p1_chara_id', 'p1_name', 'p1_rank', 'p2_polaris_id', 'p2_chara_id', 'p2_name', 'p2_rank', 'winner'])
-    else:
-        replay_df = pl.read_csv(file_path, columns=['battle_at', 'p1_polaris_id', 'p1_chara_id', 'p1_name', 'p1_rank', 'p2_polaris_id', 'p2_chara_id', 'p2_name', 'p2_rank', 'winner'])
-    logger.io('Succesfully got all game stats from file', timer.stop_get_elapsed_reset())
+    if e := create_indexes(file_path):
+        logger.io_error('Failed to create indexes, counting will be slower', e, timer.stop_get_elapsed_reset())
+    timer.reset()
 
     timer.start()
-    logger.io('Attempting to calculate win rates')
-    win_rates = _calculate_character_win_rate(replay_df)
-    logger.io('Succesfully calculated win rates', timer.stop_get_elapsed_reset())
-    print(win_rates)
+    logger.io('Attempting to count character stats in database')
+    with span('count in database', 'read') as count_span:
+        chara_counts = get_chara_counts(file_path)
+        count_span.set(rows=chara_counts.height)
+    logger.io(f'Succesfully counted character stats in database ({chara_counts.height:,} rows)', timer.stop_get_elapsed_reset())
 
+    # SQLite can only group by sorting, which is slower than reading the players and matchups out in batches and counting
+    # each batch
     timer.start()
-    logger.io('Attempting to consolidate player stats')
-    player_stats = _get_unique_players_stats(replay_df)
-    logger.io('Succesfully consolidated player stats', timer.stop_get_elapsed_reset())
-    print(player_stats)
+    logger.io('Attempting to count player and matchup stats from database')
+    _, player_counts, matchup_counts = _count_in_batches(
+        _iter_batches(file_path, config.FileTypes.SQLITE),
+        with_charas=False,
+        with_players=player_states is None
+    )
+    logger.io(f'Succesfully counted player and matchup stats from database ({matchup_counts.height:,} matchup rows)', timer.stop_get_elapsed_reset())
 
     timer.start()
-    logger.io('Attempting to calculate rank percentiles and distribution')
-    rank_percentiles_and_distribution = _get_rank_percentiles_and_distribution(player_stats)
-    logger.io('Succesfully calculated rank percentiles and distribution', timer.stop_get_elapsed_reset())
-    print(rank_percentiles_and_distribution)
+    logger.io('Attempting to calculate stats')
+    results = _analyze_counts(chara_counts.lazy(), player_counts.lazy() if player_counts is not None else None, matchup_counts.lazy(), player_states)
+    logger.io('Succesfully calculated stats', timer.stop_get_elapsed_reset())
+
+    return results
+
+def _analyze_in_batches(file_path: str, file_type: str, player_states: pl.LazyFrame | None):
+    timer = Timer()
+
+    timer.start()
+    logger.io(f'Attempting to count stats from file {_get_batch_size():,} matches at a time')
+    chara_counts, player_counts, matchup_counts = _count_in_batches(_iter_batches(file_path, file_type), with_players=player_states is None)
+    logger.io(f'Succesfully counted stats from file ({chara_counts.height:,} character rows)', timer.stop_get_elapsed_reset())
+
+    timer.start()
+    logger.io('Attempting to calculate stats')
+    results = _analyze_counts(chara_counts.lazy(), player_counts.lazy() if player_counts is not None else None, matchup_counts.lazy(), player_states)
+    logger.io('Succesfully calculated stats', timer.stop_get_elapsed_reset())
+
+    return results
+
+@traced('read rollups', 'read')
+def _get_rollups(file_path: str, file_type: str) -> DailyRollups | None:
+    timer = Timer()
+    rollups = DailyRollups(file_path)
+    offset = get_sink_offset(file_path, file_type)
+    if not offset:
+        return None
+    if rollups.is_valid(offset):
+        timer.start()
+        try:
+            rollups.compact()
+        except Exception as e:
+            logger.io_error('Failed to compact the daily rollups', e, timer.stop_get_elapsed_reset())
+        timer.reset()
+        return rollups
+
+    # Files saved before rollups existed, or ones that changed since, are counted once and the rollups saved for next time
+    timer.start()
+    logger.io('Attempting to build the daily rollups from file')
+    try:
+        rollups.rebuild(_iter_batches(file_path, file_type, SKETCH_COLUMNS), offset, config.ANALYSIS_MEMORY_BUDGET // 4)
+    except Exception as e:
+        logger.io_error('Failed to build the daily rollups, analyzing the whole file instead', e, timer.stop_get_elapsed_reset())
+        return None
+    logger.io('Succesfully built the daily rollups from file', timer.stop_get_elapsed_reset())
+    return rollups
+
+def _analyze_rollups(rollups: DailyRollups, start_date: datetime.date | None, end_date: datetime.date | None, player_states: pl.LazyFrame | None):
+    timer = Timer()
+
+    timer.start()
+    logger.io('Attempting to calculate stats from the daily rollups')
+    results = _analyze_counts(*rollups.get_counts(start_date, end_date), player_states)
+    logger.io('Succesfully calculated stats from the daily rollups', timer.stop_get_elapsed_reset())
+
+    return results
+
+def _analyze_file(file_path: str, file_type: str, player_states: pl.LazyFrame | None):
+    timer = Timer()
+
+    # Nothing is read until the plan is collected, the replays are shared by every set of counts and only the columns
+    # the analysis needs are read from the file
+    timer.start()
+    logger.io('Attempting to calculate stats from file')
+    replay_df = _scan_replays(file_path, file_type).cache()
+    players_df = unpivot_players(replay_df)
+    results = _analyze_counts(count_charas(players_df), count_players(players_df), count_matchups(replay_df), player_states)
+    logger.io('Succesfully calculated stats from file', timer.stop_get_elapsed_reset())
+
+    return results
+
+@traced('read player states', 'read')
+def _get_player_states(file_path: str, file_type: str, rollups: DailyRollups | None) -> pl.LazyFrame | None:
+    timer = Timer()
+    states_file = file_path + STATES_SUFFIX
+    offset = get_sink_offset(file_path, file_type)
+    if not offset:
+        return None
+    if is_valid(states_file, offset):
+        return scan_states(states_file)
+
+    # Files saved before player states existed, or ones that changed since, are counted once and the states saved for
+    # next time, summing the daily rollups when there are some is far quicker than reading every replay again
+    source = 'the daily rollups' if rollups else 'file'
+    timer.start()
+    logger.io(f'Attempting to build the player states from {source}')
+    try:
+        states = PlayerStates()
+        if rollups:
+            states.add_counts(rollups.get_counts()[1].collect())
+        else:
+            states.add_counts(_count_in_batches(_iter_batches(file_path, file_type), with_charas=False, with_matchups=False)[1])
+        states.save(states_file, offset)
+    except Exception as e:
+        logger.io_error('Failed to build the player states, counting players from the replays instead', e, timer.stop_get_elapsed_reset())
+        return None
+    logger.io(f'Succesfully built the player states for {len(states):,} players from {source}', timer.stop_get_elapsed_reset())
+    return scan_states(states_file)
+
+def _load_cached_results(cache_key: str):
+    timer = Timer()
+    timer.start()
+    try:
+        results = load_results(cache_key)
+    except Exception as e:
+        logger.io_error('Failed to load cached results, analyzing the file instead', e, timer.stop_get_elapsed_reset())
+        return None
+    if results:
+        logger.io('Succesfully loaded results from the cache, the file has not changed since it was last analyzed', timer.stop_get_elapsed_reset())
+    return results
+
+def _save_cached_results(cache_key: str, results):
+    timer = Timer()
+    timer.start()
+    try:
+        save_results(cache_key, results)
+    except Exception as e:
+        logger.io_error('Failed to save results to the cache', e, timer.stop_get_elapsed_reset())
+
+@traced('analyze', 'analyze')
+def analyze_replay_data(file_path: str, start_date: datetime.date | None=None, end_date: datetime.date | None=None):
+    cache_key = get_cache_key(file_path, start_date, end_date) if config.RESULTS_CACHE else None
+    if cache_key and (results := _load_cached_results(cache_key)):
+        _print_results(*results)
+        return results
+
+    # Only the daily rollups can be limited to a date range, every other way of analyzing reads the whole file
+    file_type = Path(file_path).suffix
+    rollups = _get_rollups(file_path, file_type) if config.DAILY_ROLLUPS else None
+    if not rollups and (start_date or end_date):
+        logger.io('Dates can only be analyzed with the daily rollups, analyzing every date in the file instead')
+        start_date = end_date = None
+    # The player states always cover the whole file, a date range has its players counted from the rollups
+    player_states = None
+    if config.PLAYER_STATES and not (start_date or end_date):
+        player_states = _get_player_states(file_path, file_type, rollups)
+    if rollups:
+        results = _analyze_rollups(rollups, start_date, end_date, player_states)
+    elif file_type == config.FileTypes.SQLITE and config.SQLITE_PUSHDOWN:
+        results = _analyze_counts_in_database(file_path, player_states)
+    elif config.STREAM_ANALYSIS:
+        results = _analyze_in_batches(file_path, file_type, player_states)
+    else:
+        results = _analyze_file(file_path, file_type, player_states)
+    _print_results(*results)
+    # Results without the confidence intervals asked for, when numpy isn't installed, would keep being loaded from the
+    # cache after it is
+    if cache_key and not (config.CONFIDENCE_INTERVALS and 'WinRateLow' not in results[0].columns):
+        _save_cached_results(cache_key, results)
+
+    # For the whole run of the program, not just this analysis
+    if peak_memory := get_peak_memory():
+        logger.io(f'Peak memory used so far {peak_memory / 2**20:,.0f} MiB')
+
+    return results
+
+def _with_error(players: pl.Expr):
+    # One standard error of the unique player estimates
+    return [players, (players * HLL_ERROR).round().cast(pl.Int64).alias('PlayersError')]
+
+def _estimate_players_per_character(distinct_players: pl.LazyFrame):
+    return estimate_distinct_players(distinct_players, ['chara_id']).join(
+        _get_chara_lookup().rename({'chara_name': 'Character'}), on='chara_id', how='left'
+    ).select(['Character', *_with_error(pl.col('Players'))]).sort('Players', descending=True)
+
+def _estimate_players_per_character_and_rank(distinct_players: pl.LazyFrame):
+    rank_id_to_name = {rank.value: rank.name.replace('_', ' ') for rank in Ranks}
+    return estimate_distinct_players(distinct_players, ['chara_id', 'rank']).join(
+        _get_chara_lookup().rename({'chara_name': 'Character'}), on='chara_id', how='left'
+    ).sort(['chara_id', 'rank']).select([
+        'Character',
+        pl.col('rank').alias('Rank'),
+        pl.col('rank').cast(pl.Utf8).replace(rank_id_to_name).alias('RankName'),
+        *_with_error(pl.col('Players'))
+    ])
+
+def _estimate_players_per_rank(chara_counts: pl.LazyFrame, distinct_players: pl.LazyFrame):
+    # Games per rank are exact, a player who played at several ranks is counted at every one of them
+    rank_id_to_name = {rank.value: rank.name.replace('_', ' ') for rank in Ranks}
+    games = chara_counts.group_by('rank').agg(pl.sum('games').alias('Games'))
+    return estimate_distinct_players(distinct_players, ['rank']).join(games, on='rank', how='full', coalesce=True).sort('rank').select([
+        pl.col('rank').alias('Rank'),
+        pl.col('rank').cast(pl.Utf8).replace(rank_id_to_name).alias('RankName'),
+        *_with_error(pl.col('Players').fill_null(0)),
+        pl.col('Games').fill_null(0),
+        (pl.col('Games').fill_null(0).cum_sum().shift().fill_null(0) / pl.col('Games').sum()).alias('GamesPercentile'),
+        (pl.col('Games').fill_null(0) / pl.col('Games').sum()).alias('GamesDistribution')
+    ])
+
+def _estimate_power_percentiles(powers: pl.LazyFrame):
+    return estimate_power_percentiles(powers, POWER_PERCENTILES).with_columns(
+        (pl.col('Power') * POWER_ERROR).round().cast(pl.Int64).alias('PowerError')
+    )
+
+def _estimate_top_players(top_players: pl.LazyFrame):
+    # Every player's games are somewhere between the bounds
+    return top_players.sort(['games_lower', 'games_upper'], descending=True).select([
+        pl.col('polaris_id').cast(pl.String).alias('PolarisId'),
+        pl.col('name').alias('PlayerName'),
+        pl.col('games_lower').alias('GamesLowerBound'),
+        pl.col('games_upper').alias('GamesUpperBound')
+    ])
+
+def _sketch_in_batches(batches: Iterable[pl.DataFrame], start_date: datetime.date | None, end_date: datetime.date | None):
+    # Only the character counts and the sketches are kept, each merged into the ones before it as every batch is read,
+    # so memory stays the same however many players the file has
+    days = pl.lit(True)
+    if start_date:
+        days &= pl.from_epoch('battle_at').dt.date() >= start_date
+    if end_date:
+        days &= pl.from_epoch('battle_at').dt.date() <= end_date
+    chara_counts = distinct_players = powers = top_players = None
+    for batch, replay_df in enumerate(iter_spans(batches, 'read batch', 'read')):
+        replay_df = replay_df.filter(days)
+        players_df = unpivot_players(replay_df)
+        player_counts = count_players(players_df)
+        batch_top_players = sketch_top_players(player_counts).with_columns(pl.lit(batch).alias('batch'))
+        if chara_counts is None:
+            chara_counts, distinct_players, powers = count_charas(players_df), sketch_distinct_players(player_counts), sketch_powers(replay_df)
+            top_players = merge_top_players(batch_top_players, [], ['batch'])
+            continue
+        chara_counts = merge_chara_counts([chara_counts, count_charas(players_df)])
+        distinct_players = merge_distinct_players([distinct_players, sketch_distinct_players(player_counts)])
+        powers = merge_powers([powers, sketch_powers(replay_df)])
+        top_players = merge_top_players(pl.concat([
+            top_players.with_columns(pl.lit(-1).alias('batch')),
+            batch_top_players
+        ]), [], ['batch'])
+    return chara_counts, distinct_players, powers, top_players
+
+def _get_sketches(file_path: str, start_date: datetime.date | None, end_date: datetime.date | None):
+    timer = Timer()
+    file_type = Path(file_path).suffix
+    rollups = _get_rollups(file_path, file_type) if config.DAILY_ROLLUPS else None
+    if rollups:
+        # Read back as the types they were sketched as, so they can be merged with the sketches of other files
+        return tuple(narrow_counts(counts) for counts in (rollups.get_counts(start_date, end_date)[0], *rollups.get_sketches(start_date, end_date)))
+
+    timer.start()
+    logger.io(f'Attempting to sketch {file_path} {_get_batch_size():,} matches at a time')
+    chara_counts, distinct_players, powers, top_players = _sketch_in_batches(
+        _iter_batches(file_path, file_type, SKETCH_COLUMNS), start_date, end_date
+    )
+    logger.io(f'Succesfully sketched {file_path}', timer.stop_get_elapsed_reset())
+    return chara_counts.lazy(), distinct_players.lazy(), powers.lazy(), top_players.lazy()
+
+@traced('analyze approximately', 'analyze')
+def analyze_replays_approximately(file_paths: list[str], start_date: datetime.date | None=None, end_date: datetime.date | None=None):
+    # Unique players, power percentiles and the players with the most games are estimated from sketches, which take the
+    # same memory however many players or days there are and are merged across every file. Win rates and games per rank
+    # are still exact. Replays in more than one of the files are counted once for every file they are in
+    timer = Timer()
+    sketches = [_get_sketches(file_path, start_date, end_date) for file_path in file_paths]
+
+    timer.start()
+    logger.io('Attempting to estimate stats from the sketches')
+    chara_counts = narrow_counts(merge_chara_counts([sketch[0] for sketch in sketches])).cache()
+    distinct_players = narrow_counts(merge_distinct_players([sketch[1] for sketch in sketches])).cache()
+    powers = merge_powers([sketch[2] for sketch in sketches])
+    top_players = merge_top_players(pl.concat([
+        sketch[3].with_columns(pl.lit(file).alias('file')) for file, sketch in enumerate(sketches)
+    ]), [], ['file'])
+    results = collect_all([
+        _calculate_character_win_rate_from_counts(chara_counts),
+        _estimate_players_per_character(distinct_players),
+        _estimate_players_per_rank(chara_counts, distinct_players),
+        _estimate_players_per_character_and_rank(distinct_players),
+        _estimate_power_percentiles(powers),
+        _estimate_top_players(top_players)
+    ], 'aggregate')
+    logger.io('Succesfully estimated stats from the sketches', timer.stop_get_elapsed_reset())
+
+    for result in results:
+        print(result)
+    logger.io(
+        f'Unique players are within {HLL_ERROR:.1%} 2 times out of 3, powers within {POWER_ERROR:.0%} and games of the '
+        f'top {TOP_PLAYERS:,} players between their bounds'
+    )
+    return results
+
+RATING_COLUMNS = ['battle_at'] + [
+    f'p{side}_{column}' for side in (1, 2) for column in ('polaris_id', 'name', 'chara_id', 'rank', 'rating_before', 'rating_change')
+]
+
+def _unpivot_ratings(replay_df: pl.LazyFrame):
+    # One row per player per match, matches without a rating are left out
+    return pl.concat([
+        replay_df.select([
+            'battle_at',
+            pl.col(f'p{side}_polaris_id').cast(COUNT_DTYPES['polaris_id']).alias('polaris_id'),
+            pl.col(f'p{side}_name').alias('name'),
+            pl.col(f'p{side}_chara_id').alias('chara_id'),
+            pl.col(f'p{side}_rank').alias('rank'),
+            pl.col(f'p{side}_rating_before').cast(pl.Int32).alias('rating_before'),
+            pl.col(f'p{side}_rating_change').cast(pl.Int32).alias('rating_change')
+        ])
+        for side in (1, 2)
+    ]).filter(pl.col('rating_before').is_not_null() & pl.col('rating_change').is_not_null())
+
+def _get_player_trajectories(ratings: pl.LazyFrame):
+    # Ratings are sorted by player, character and time, so every player's matches and every day they played are runs of
+    # rows. Runs are numbered in order and grouped by that number, which takes a fraction of the time hashing the
+    # player and day would, and everything about the match before is a shift away instead of a window per player.
+    # Time to a promotion is from the first match at a rank to the first one at a higher rank
+    day = pl.col('battle_at') // 86400
+    first_match = (
+        (pl.col('polaris_id').to_physical() != pl.col('polaris_id').to_physical().shift())
+        | (pl.col('chara_id') != pl.col('chara_id').shift())
+    ).fill_null(True)
+    first_of_day = first_match | (day != day.shift())
+    rank_changed = first_match | (pl.col('rank') != pl.col('rank').shift())
+    ratings = ratings.with_columns([
+        first_match.cum_sum().set_sorted().alias('Run'),
+        first_of_day.cum_sum().set_sorted().alias('DayRun'),
+        (~first_match & (pl.col('rank') > pl.col('rank').shift())).alias('Promoted'),
+        (pl.col('rating_before') + pl.col('rating_change')).alias('rating_after'),
+        pl.when(rank_changed).then('battle_at').forward_fill().alias('RankStartAt'),
+        pl.when(rank_changed).then(pl.int_range(pl.len())).forward_fill().alias('RankStartMatch')
+    ]).with_columns([
+        pl.when('Promoted').then((pl.col('battle_at') - pl.col('RankStartAt').shift()) / 3600).alias('HoursToPromotion'),
+        pl.when('Promoted').then(pl.int_range(pl.len()) - pl.col('RankStartMatch').shift()).alias('GamesToPromotion')
+    ])
+
+    # Only a few matches are promotions, so they are grouped on their own instead of taking medians of mostly nulls
+    promotions = (
+        ratings
+        .filter('Promoted')
+        .group_by('Run')
+        .agg([
+            pl.len().alias('Promotions'),
+            pl.median('HoursToPromotion').alias('MedianHoursToPromotion'),
+            pl.median('GamesToPromotion').alias('MedianGamesToPromotion')
+        ])
+    )
+    daily = (
+        ratings
+        .group_by('DayRun')
+        .agg([pl.first('Run'), pl.sum('rating_change').alias('DailyChange')])
+        .group_by('Run')
+        .agg([
+            pl.len().alias('DaysPlayed'),
+            pl.mean('DailyChange').alias('MeanDailyChange'),
+            pl.max('DailyChange').alias('BestDailyChange'),
+            pl.min('DailyChange').alias('WorstDailyChange')
+        ])
+    )
+    return (
+        ratings
+        .group_by('Run')
+        .agg([
+            pl.first('polaris_id'),
+            pl.first('chara_id'),
+            pl.col('name').last().alias('PlayerName'),
+            pl.len().alias('Games'),
+            pl.col('rating_before').first().alias('FirstRating'),
+            pl.col('rating_after').last().alias('LatestRating'),
+            pl.col('rating_after').max().alias('PeakRating'),
+            pl.col('battle_at').first().alias('FirstMatchAt'),
+            pl.col('battle_at').last().alias('LatestMatchAt')
+        ])
+        .join(daily, on='Run')
+        .join(promotions, on='Run', how='left')
+        .join(_get_chara_lookup().rename({'chara_name': 'Character'}), on='chara_id', how='left')
+        .select([
+            pl.col('polaris_id').cast(pl.String).alias('PolarisId'),
+            'PlayerName',
+            'Character',
+            'Games',
+            'FirstRating',
+            'LatestRating',
+            'PeakRating',
+            (pl.col('LatestRating') - pl.col('FirstRating')).alias('RatingChange'),
+            'DaysPlayed',
+            'MeanDailyChange',
+            'BestDailyChange',
+            'WorstDailyChange',
+            pl.col('Promotions').fill_null(0),
+            'MedianHoursToPromotion',
+            'MedianGamesToPromotion',
+            pl.from_epoch('FirstMatchAt'),
+            pl.from_epoch('LatestMatchAt')
+        ])
+        .sort('LatestRating', descending=True)
+    )
+
+def _get_character_rating_trends(ratings: pl.LazyFrame):
+    # Rating changes of every character per UTC day, with the change over the 7 days up to each day so quiet days don't
+    # swing it as much
+    return (
+        ratings
+        .group_by(['chara_id', pl.from_epoch(pl.col('battle_at') // 86400, time_unit='d').alias('Date')])
+        .agg([
+            pl.len().alias('Games'),
+            pl.col('polaris_id').n_unique().alias('Players'),
+            pl.mean('rating_before').alias('MeanRating'),
+            pl.sum('rating_change').alias('RatingChange')
+        ])
+        .sort(['chara_id', 'Date'])
+        .with_columns([
+            (pl.col('RatingChange') / pl.col('Games')).alias('MeanRatingChange'),
+            (
+                pl.col('RatingChange').rolling_sum_by('Date', '7d') / pl.col('Games').rolling_sum_by('Date', '7d')
+            ).over('chara_id').alias('MeanRatingChange7d')
+        ])
+        .join(_get_chara_lookup().rename({'chara_name': 'Character'}), on='chara_id', how='left')
+        .select([
+            'Date',
+            'Character',
+            'Games',
+            'Players',
+            'MeanRating',
+            'MeanRatingChange',
+            'MeanRatingChange7d'
+        ])
+    )
+
+@traced('analyze rating trajectories', 'analyze')
+def analyze_rating_trajectories(file_path: str, start_date: datetime.date | None=None, end_date: datetime.date | None=None):
+    # Ratings are worked out from every match rather than from counts, so they are always read from the replays
+    timer = Timer()
+    file_type = Path(file_path).suffix
 
     timer.start()
-    logger.io('Attempting to calculate win rates by rank')
-    win_rates_by_rank = _calculate_character_win_rate_by_rank(replay_df)
-    logger.io('Succesfully calculated win rates by rank', timer.stop_get_elapsed_reset())
-    print(win_rates_by_rank[0])
+    logger.io('Attempting to calculate rating trajectories from file')
+    replay_df = _scan_replays(file_path, file_type, RATING_COLUMNS)
+    # Days are UTC like the daily rollups
+    if start_date:
+        replay_df = replay_df.filter(pl.from_epoch('battle_at').dt.date() >= start_date)
+    if end_date:
+        replay_df = replay_df.filter(pl.from_epoch('battle_at').dt.date() <= end_date)
+    ratings = _unpivot_ratings(replay_df).sort([pl.col('polaris_id').to_physical(), 'chara_id', 'battle_at']).cache()
+    player_trajectories, character_rating_trends = collect_all([
+        _get_player_trajectories(ratings),
+        _get_character_rating_trends(ratings)
+    ], 'aggregate')
+    logger.io(f'Succesfully calculated rating trajectories for {player_trajectories.height:,} players and characters', timer.stop_get_elapsed_reset())
 
-    return win_rates, player_stats, rank_percentiles_and_distribution, win_rates_by_rank
\ No newline at end of file
+    print(player_trajectories)
+    print(character_rating_trends)
+    return player_trajectories, character_rating_trends
@@ -0,0 +1,216 @@
+import argparse, contextlib, datetime, json, multiprocessing, os, sys, time, src.config as config, src.utils.logger as logger
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from typing import Callable
+from src.utils.rate_limiter import TokenBucket
+
+# Runs the same downloads, extends and analyses as the menu from a JSON list of jobs. Analyses run in a pool of processes
+# that import polars themselves, so nothing polars is imported at the top of this module and every process can be
+# told how many threads to use before polars starts its thread pool
+DOWNLOAD_JOBS = ('download', 'extend')
+JOB_FIELDS = {
+    'download': {'start', 'end', 'file_type', 'resume', 'overwrite'},
+    'extend': {'file'},
+    'analyze': {'file', 'start', 'end', 'rating_trajectories', 'export', 'config'}
+}
+REQUIRED_FIELDS = {
+    'download': {'start', 'end', 'file_type'},
+    'extend': {'file'},
+    'analyze': {'file'}
+}
+
+def _parse_date(date: str) -> datetime.datetime:
+    return datetime.datetime.strptime(date, '%Y-%m-%d')
+
+def check_job(job: dict):
+    # Raises a ValueError saying what is wrong with the job, so a mistake anywhere in a batch is found before it starts
+    if job.get('type') not in JOB_FIELDS:
+        raise ValueError(f'Unknown job type "{job.get("type")}", expected one of {", ".join(JOB_FIELDS)}')
+    fields = set(job) - {'type'}
+    if unknown := fields - JOB_FIELDS[job['type']]:
+        raise ValueError(f'Unknown field(s) {", ".join(sorted(unknown))} for a {job["type"]} job')
+    if missing := REQUIRED_FIELDS[job['type']] - fields:
+        raise ValueError(f'Missing field(s) {", ".join(sorted(missing))} for a {job["type"]} job')
+    for field in ('start', 'end'):
+        if job.get(field) is not None:
+            _parse_date(job[field])
+    if job['type'] == 'analyze' and (job.get('start') is None) != (job.get('end') is None):
+        raise ValueError('An analyze job needs both a start and an end date or neither')
+    if job['type'] == 'download' and job['file_type'] not in config.REPLAY_FILE_SUFFIXES:
+        raise ValueError(f'Unknown file type "{job["file_type"]}", expected one of {", ".join(config.REPLAY_FILE_SUFFIXES)}')
+    for name in job.get('config', {}):
+        if not name.isupper() or not hasattr(config, name):
+            raise ValueError(f'Unknown config setting "{name}"')
+
+def _get_replay_file(job: dict) -> str:
+    # Files are named like in the menu, relative to the replay directory
+    if job['type'] == 'download':
+        from src.get_replays import get_replay_file_name
+        return get_replay_file_name(_parse_date(job['start']), _parse_date(job['end']), job['file_type'])
+    return os.path.join(config.REPLAY_DIR, job['file'])
+
+def _write_trace():
+    if config.TRACE:
+        from src.utils.tracing import write_trace
+        write_trace()
+
+def _download(job: dict, rate_limiter: TokenBucket) -> dict:
+    from src.get_replays import extend_replay_data, get_replay_data
+
+    file_name = _get_replay_file(job)
+    if job['type'] == 'download':
+        replays = get_replay_data(
+            _parse_date(job['start']),
+            _parse_date(job['end']),
+            job['file_type'],
+            job.get('resume', True),
+            job.get('overwrite', False),
+            rate_limiter
+        )
+    else:
+        # Extended files are renamed to end today, the summary has where the file is now
+        replays, file_name = extend_replay_data(file_name, rate_limiter)
+    return {'file': file_name, 'replays': replays}
+
+def _analyze(job: dict, log_file: str) -> dict:
+    # Runs in a process of its own, everything it would print goes to the log file instead of between the downloads
+    for name, value in job.get('config', {}).items():
+        setattr(config, name, value)
+    with open(log_file, 'w', encoding='utf8') as log, contextlib.redirect_stdout(log):
+        from src.analyze_replays import analyze_rating_trajectories, analyze_replay_data, get_result_sheets
+        from src.utils.file_utils import write_results
+        from src.utils.memory import get_peak_memory
+        from src.utils.results_cache import get_cache_key
+
+        file_path = _get_replay_file(job)
+        start_date = _parse_date(job['start']).date() if job.get('start') else None
+        end_date = _parse_date(job['end']).date() if job.get('end') else None
+        start_time = time.perf_counter()
+        results = analyze_replay_data(file_path, start_date, end_date)
+        rating_trajectories = analyze_rating_trajectories(file_path, start_date, end_date) if job.get('rating_trajectories') else None
+        sheets = get_result_sheets(results, rating_trajectories)
+        summary = {
+            'file': file_path,
+            'players': results[1].height,
+            'rows': {sheet: df.height for df, sheet in sheets},
+            'analysis_seconds': time.perf_counter() - start_time
+        }
+        if job.get('export', True):
+            start_time = time.perf_counter()
+            cache_key = get_cache_key(file_path, start_date, end_date) if config.RESULTS_CACHE and not rating_trajectories else None
+            # Named the same as exports from the menu
+            results_file = f'replay_data_{start_date}_{end_date}' if start_date else file_path
+            summary['results_files'] = write_results(results_file, sheets, cache_key)
+            summary['export_seconds'] = time.perf_counter() - start_time
+        _write_trace()
+    return summary | {'peak_memory': get_peak_memory()}
+
+def _run_job(number: int, job: dict, run: Callable[..., dict], *args) -> dict:
+    # A failed job is recorded in its summary rather than stopping the jobs after it
+    started = datetime.datetime.now(datetime.timezone.utc)
+    start_time = time.perf_counter()
+    try:
+        result = {'status': 'succeeded'} | run(job, *args)
+    except Exception as e:
+        result = {'status': 'failed', 'error': f'{type(e).__name__}: {e}'}
+    return {'job': number, 'type': job['type'], 'spec': job, 'started': started.isoformat(), 'seconds': time.perf_counter() - start_time} | result
+
+def _limit_threads(threads: int):
+    os.environ['POLARS_MAX_THREADS'] = str(threads)
+
+def _save_summary(summary_dir: str, summary: dict) -> dict:
+    summary_file = os.path.join(summary_dir, f'job_{summary["job"]:02d}_{summary["type"]}.json')
+    with open(summary_file, mode='w', encoding='utf8') as out:
+        json.dump(summary, out, indent=2)
+    if summary['status'] == 'failed':
+        logger.io_error(f'Job {summary["job"]} ({summary["type"]}) failed, its summary was saved to {summary_file}', summary['error'])
+    else:
+        logger.io(f'Job {summary["job"]} ({summary["type"]}) finished, its summary was saved to {summary_file}', summary['seconds'])
+    return summary
+
+def run_batch(jobs: list[dict], workers: int=config.BATCH_WORKERS) -> list[dict]:
+    # Returns the summary of every job in the order they were given
+    cores = os.cpu_count() or 1
+    workers = workers or cores
+    started = datetime.datetime.now()
+    summary_dir = os.path.join(config.SUMMARY_DIR, f'batch_{started:%Y%m%dT%H%M%S}')
+    os.makedirs(summary_dir, exist_ok=True)
+    downloads = [(number, job) for number, job in enumerate(jobs, 1) if job['type'] in DOWNLOAD_JOBS]
+    analyses = [(number, job) for number, job in enumerate(jobs, 1) if job['type'] == 'analyze']
+    # Analyses of files that a download in the batch writes to, or that don't exist until one does, wait until every
+    # download is done. The rest start straight away alongside the downloads
+    written = {os.path.normpath(_get_replay_file(job)) for _, job in downloads}
+    waiting = [
+        (number, job) for number, job in analyses
+        if os.path.normpath(_get_replay_file(job)) in written or not os.path.exists(_get_replay_file(job))
+    ]
+    ready = [analysis for analysis in analyses if analysis not in waiting]
+
+    summaries = []
+    # The cores are split between the processes that actually run, fewer analyses than workers get more threads each
+    pool = min(workers, max(len(analyses), 1))
+    logger.io(f'Starting {len(downloads):,} download(s) and {len(analyses):,} analyses, up to {pool:,} at a time')
+    # A new process for every job so the peak memory in its summary is its own
+    with ProcessPoolExecutor(
+        pool,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_limit_threads,
+        initargs=(max(1, cores // pool),),
+        max_tasks_per_child=1
+    ) as executor:
+        futures: dict[Future, tuple[int, dict]] = {}
+
+        def submit(number: int, job: dict):
+            log_file = os.path.join(summary_dir, f'job_{number:02d}_{job["type"]}.log')
+            futures[executor.submit(_run_job, number, job, _analyze, log_file)] = (number, job)
+
+        for number, job in ready:
+            submit(number, job)
+        # The API budget is what limits downloads, running them at once would only split it between them. They run one
+        # after another through the same rate limiter so none of them starts with a fresh budget
+        rate_limiter = TokenBucket(config.REQUESTS_PER_SECOND)
+        renamed = {}
+        for number, job in downloads:
+            summary = _save_summary(summary_dir, _run_job(number, job, _download, rate_limiter))
+            summaries.append(summary)
+            if summary['status'] == 'succeeded' and os.path.normpath(summary['file']) != os.path.normpath(_get_replay_file(job)):
+                renamed[os.path.normpath(_get_replay_file(job))] = summary['file']
+        _write_trace()
+        for number, job in waiting:
+            # Analyses of an extended file follow it to its new name
+            if new_file := renamed.get(os.path.normpath(_get_replay_file(job))):
+                job = job | {'file': os.path.relpath(new_file, config.REPLAY_DIR)}
+            submit(number, job)
+        for future in as_completed(futures):
+            number, job = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                # The process itself died, for example when it ran out of memory
+                summary = {'job': number, 'type': job['type'], 'spec': job, 'status': 'failed', 'error': f'{type(e).__name__}: {e}'}
+            summaries.append(_save_summary(summary_dir, summary))
+    return sorted(summaries, key=lambda summary: summary['job'])
+
+def main():
+    parser = argparse.ArgumentParser(description='Download, extend and analyze replays from a JSON list of jobs without the menu')
+    parser.add_argument('jobs', help='JSON file with a list of jobs')
+    parser.add_argument('--workers', type=int, default=config.BATCH_WORKERS, help='Analysis jobs to run at once, by default one per core')
+    args = parser.parse_args()
+
+    with open(args.jobs, encoding='utf8') as file:
+        jobs = json.load(file)
+    if not isinstance(jobs, list):
+        parser.error(f'{args.jobs} should hold a list of jobs')
+    for number, job in enumerate(jobs, 1):
+        try:
+            check_job(job)
+        except ValueError as e:
+            parser.error(f'Job {number}: {e}')
+
+    summaries = run_batch(jobs, args.workers)
+    for summary in summaries:
+        replays = f'{summary["replays"]:>12,} replays' if 'replays' in summary else ''
+        print(f'{summary["job"]:>3} {summary["type"]:<9} {summary["status"]:<10} {summary.get("seconds", 0):8.2f}s {replays}')
+    sys.exit(1 if any(summary['status'] == 'failed' for summary in summaries) else 0)
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,92 @@
-MAX_REPLAY_THRESHOLD = 1_000_000
+# Downloaded replays are saved once they take up this much memory, a save runs in the background while the next
+# batch is downloaded so up to about 3 times this can be in use at once
+MAX_BUFFER_BYTES = 256 * 1024 * 1024
 MAX_RETRIES = 5
+API_URL = 'https://wank.wavu.wiki/api/replays'
+# The API returns 700 seconds worth of replays per request and asks for at most 1 request per second
+REPLAY_WINDOW_SECONDS = 700
+REQUESTS_PER_SECOND = 1 / 1.005
+# Windows kept in flight at once, only helps when a request takes longer than the rate limit allows for
+DOWNLOAD_WORKERS = 4
+# Seconds to wait for a connection to open and for the API to send data before giving up on a request
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 30
+ACCEPT_ENCODING = 'gzip, deflate'
 REPLAY_DIR = 'downloaded_replays'
 RESULTS_DIR = 'results'
-CSV_FILE_BASE_NAME = DB_FILE_BASE_NAME = REPLAY_DIR + '/replay_data'
+SUMMARY_DIR = 'summaries'
+REPLAY_FILE_BASE_NAME = CSV_FILE_BASE_NAME = DB_FILE_BASE_NAME = REPLAY_DIR + '/replay_data'
 XLSX_FILE_BASE_NAME = RESULTS_DIR + '/'
+# Formats the results are saved in, any of '.xlsx', '.parquet', '.arrow' (Arrow IPC) and '.csv'. Excel sheets are limited
+# to 1,048,576 rows so bigger results are split over numbered sheets. The other formats save every result to a file of its
+# own in a directory named like the excel file with their suffix, and are written at the same time as it
+RESULTS_FORMATS = ['.xlsx']
+# Results of every analysis are kept until the cache takes up this much space, an unchanged file analyzed again loads
+# them instead of analyzing it again
+RESULTS_CACHE = True
+RESULTS_CACHE_DIR = 'results_cache'
+RESULTS_CACHE_BYTES = 1024 * 1024 * 1024
+# Record where the time goes while downloading, saving, analyzing and exporting as nested spans with their rows, bytes
+# and memory, saved to TRACE_DIR after every action as a Chrome trace event file ('chrome') or nested spans ('json').
+# TRACE_QUERY_PLANS times every node of the analysis queries and TRACE_PYTHON_MEMORY traces memory python allocates,
+# both slow the analysis down
+TRACE = False
+TRACE_FORMAT = 'chrome'
+TRACE_DIR = 'traces'
+TRACE_QUERY_PLANS = False
+TRACE_PYTHON_MEMORY = False
+PARQUET_COMPRESSION_LEVEL = 10
+PARQUET_ROW_GROUP_SIZE = 250_000
 
 USE_SQLITE = True
 QUERY_FOLDER_PATH = 'queries/'
 # I think this is what you need to use for relative file paths
 SQLITE_URI = 'sqlite:///'
+# Rows written to or read from a database at a time and the page cache used while loading, indexing and counting
+SQLITE_BATCH_SIZE = 50_000
+SQLITE_CACHE_KIB = 256 * 1024
+# Analyze databases by grouping inside SQLite and only reading the counts out, instead of reading every match
+SQLITE_PUSHDOWN = True
+# Keep counts per day next to every replay file as replays are saved, analysis sums them instead of reading every
+# replay and they are what makes analyzing part of a file's date range possible
+DAILY_ROLLUPS = True
+# Keep every player's games, wins, ties, latest name and games per rank and character next to every replay file as
+# replays are saved, analyzing a whole file reads one row per player instead of counting every match again
+PLAYER_STATES = True
+# Matchups are counted over every rank and game version together, turning these on splits them so every rank or game
+# version gets a matchup matrix sheet of its own when exported
+MATCHUPS_BY_RANK = False
+MATCHUPS_BY_GAME_VERSION = False
+# Add percentile bootstrap confidence intervals to every win and pick rate, resampled from the counts so thousands of
+# resamples take seconds. Needs numpy, which isn't installed by default
+CONFIDENCE_INTERVALS = False
+CONFIDENCE_LEVEL = 0.95
+BOOTSTRAP_RESAMPLES = 2000
+# Add a win rate that pulls characters with few games toward the average win rate
+BAYESIAN_WIN_RATES = False
+# Read replays a batch at a time and only keep counts while analyzing, so files far bigger than memory can be analyzed.
+# Databases analyzed with SQLITE_PUSHDOWN are always read this way
+STREAM_ANALYSIS = False
+# Memory the batches and counts are sized to stay under, the counts per player can still outgrow it when a file has
+# more players than fit in it
+ANALYSIS_MEMORY_BUDGET = 1024 * 1024 * 1024
+# Analyze several files at once from sketches that take the same memory however many players there are, unique players,
+# power percentiles and the players with the most games are estimated instead of counted exactly
+APPROXIMATE_ANALYSIS = False
+# Analysis jobs of a batch run in this many processes at once, 0 for one per core. The cores are split between them so
+# polars in every process doesn't try to use all of them
+BATCH_WORKERS = 0
 
 # Prompt configuration
 DOWNLOAD = 'Download Replays'
+EXTEND = 'Extend Replays to Now'
+MERGE = 'Merge Replays'
 ANALYZE = 'Analyze Replays'
 HELP = 'Help'
 QUIT = 'Quit'
 SQLITE = 'SQLite Database'
 CSV = 'CSV'
+PARQUET = 'Parquet'
 BACK = '← Back'
 
 class Tables:
@@ -25,4 +95,20 @@ class Tables:
     Characters = 'Characters'
     Regions = 'Regions'
     Ranks = 'Ranks'
-    Stages = 'Stages'
\ No newline at end of file
+    Stages = 'Stages'
+
+class FileTypes:
+    CSV = '.csv'
+    SQLITE = '.db'
+    # Parquet datasets are directories of part files partitioned by day
+    PARQUET = '.parquet'
+
+REPLAY_FILE_SUFFIXES = (FileTypes.CSV, FileTypes.SQLITE, FileTypes.PARQUET)
+
+class ResultsFormats:
+    XLSX = '.xlsx'
+    PARQUET = '.parquet'
+    IPC = '.arrow'
+    CSV = '.csv'
+
+RESULTS_FORMAT_SUFFIXES = (ResultsFormats.XLSX, ResultsFormats.PARQUET, ResultsFormats.IPC, ResultsFormats.CSV)
\ No newline at end of file
@@ -1,26 +1,138 @@
-import time, datetime, math, os, polars as pl, gc, src.config as config, questionary as q, requests, src.utils.logger as logger
+import time, datetime, math, os, re, json, polars as pl, src.config as config, questionary as q, src.utils.logger as logger
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+from typing import Iterator
 from tqdm import tqdm
-from src.models import ReplayData
-from src.utils.sql_utils import create_tables, create_indexes, populate_lookup_tables
+import src.utils.parquet_utils as parquet_utils, src.utils.sql_utils as sql_utils
+from src.models import REPLAY_DATA_SCHEMA, ReplayData
+from src.utils.dedupe import INDEX_SUFFIX, BattleIdIndex
+from src.utils.parquet_utils import delete_dataset, delete_parts_from, get_next_sequence, scan_dataset, write_partitioned
+from src.utils.sql_utils import bulk_insert, create_tables, create_indexes, delete_rows_after, drop_indexes, finish_bulk_load, get_max_rowid, populate_lookup_tables
 from src.utils.timer import Timer
-from src.utils.file_utils import create_replay_dir
+from src.utils.file_utils import create_replay_dir, get_file_size, get_summary_file, truncate_file, write_run_summary
+from src.utils.journal import DownloadJournal, JournalState
+from src.utils.rollups import DailyRollups
+from src.utils.player_states import STATES_SUFFIX, PlayerStates
+from src.utils.ingest_buffer import BackgroundWriter, ReplayBuffer
+from src.utils.http_utils import close_session, get_session, take_connect_time
+from src.utils.rate_limiter import TokenBucket
+from src.utils.telemetry import DownloadTelemetry
+from src.utils.tracing import span, traced
 
 START_DATE = datetime.datetime(2025, 9, 1).replace(tzinfo=datetime.timezone.utc)
 END_DATE = datetime.datetime(2025, 9, 2).replace(tzinfo=datetime.timezone.utc)
 
-first_save: bool = True
-
-def _download_replays(before: int) -> list[ReplayData]:
-    request = f'https://wank.wavu.wiki/api/replays?before={before}'
-    replay_data = requests.get(request).json()
+def _download_replays(before: int, telemetry: DownloadTelemetry | None=None) -> list[ReplayData]:
+    request = f'{config.API_URL}?before={before}'
+    take_connect_time()
+    start_time = time.perf_counter()
+    # Streamed so the time until the headers arrive can be told apart from the time spent reading the body
+    with (
+        span('request', 'download', before=before) as request_span,
+        get_session().get(request, timeout=(config.CONNECT_TIMEOUT, config.READ_TIMEOUT), stream=True) as response
+    ):
+        headers_time = time.perf_counter()
+        response.raise_for_status()
+        content = response.content
+        body_time = time.perf_counter()
+        wire_bytes = response.raw.tell()
+        request_span.set(bytes=wire_bytes)
+    with span('decode', 'download', bytes=len(content)) as decode_span:
+        replay_data = json.loads(content)
+        decode_span.set(rows=len(replay_data))
+    if telemetry:
+        connect = take_connect_time()
+        telemetry.record(
+            connect=connect,
+            ttfb=headers_time - start_time - connect,
+            body=body_time - headers_time,
+            decode=time.perf_counter() - body_time,
+            wire_bytes=wire_bytes,
+            body_bytes=len(content)
+        )
     return replay_data
 
-def get_replay_data(start_date: datetime.datetime, end_date: datetime.datetime, use_sql: bool):
+def _download_window(
+    before: int,
+    window: int,
+    windows: int,
+    rate_limiter: TokenBucket,
+    telemetry: DownloadTelemetry | None=None
+) -> list[ReplayData] | None:
+    rate_limiter.acquire()
+    try:
+        return _download_replays(before, telemetry)
+    except Exception as e:
+        if telemetry:
+            telemetry.record_failure()
+        logger.download_error_tqdm(f'Encountered an error while attempting to download set {window:,} of {windows:,}, retrying', e)
+
+    attempts = 0
+    while attempts < config.MAX_RETRIES:
+        time.sleep((attempts + 1) * 1.005)
+        rate_limiter.acquire()
+        try:
+            downloaded = _download_replays(before, telemetry)
+            logger.download_tqdm(f'Retry {attempts + 1} succeeded, set {window:,} of {windows:,} was succesfully downloaded')
+            return downloaded
+        except Exception as e:
+            if telemetry:
+                telemetry.record_failure()
+            attempts += 1
+            logger.download_error_tqdm(f'Retry {attempts} of set {window:,} failed, waiting {(attempts + 1) * 1.005:.2f} second(s) and trying again', e)
+    logger.download_error_tqdm(f'All retry attempts failed for set {window:,} of {windows:,} with before value {before}, and will not be included in the final output')
+    return None
+
+def _download_windows(
+    befores: list[int],
+    rate_limiter: TokenBucket,
+    workers: int=config.DOWNLOAD_WORKERS,
+    telemetry: DownloadTelemetry | None=None
+) -> Iterator[tuple[int, list[ReplayData] | None]]:
+    # Keeps several windows in flight at once but always yields them back in window order, the rate limiter is what
+    # actually paces the requests so adding workers never goes over the API budget
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='download')
+    pending = iter(enumerate(befores, 1))
+    in_flight: deque[tuple[int, Future]] = deque()
+
+    def submit_next():
+        if (item := next(pending, None)) is not None:
+            window, before = item
+            in_flight.append((before, executor.submit(_download_window, before, window, len(befores), rate_limiter, telemetry)))
+
+    try:
+        for _ in range(workers * 2):
+            submit_next()
+        while in_flight:
+            before, future = in_flight.popleft()
+            downloaded = future.result()
+            submit_next()
+            yield before, downloaded
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def _get_windows(start: int, end: int) -> list[int]:
+    # Each window is identified by the before value sent to the API, stepping forward from start until end is covered
+    loops_required = math.ceil((end - start) / config.REPLAY_WINDOW_SECONDS)
+    return [start + config.REPLAY_WINDOW_SECONDS * loop for loop in range(1, loops_required + 1)]
+
+def get_replay_file_name(start_date: datetime.datetime, end_date: datetime.datetime, file_type: str) -> str:
+    return config.REPLAY_FILE_BASE_NAME + f'_{start_date.date()}_{end_date.date()}{file_type}'
+
+def get_replay_data(
+    start_date: datetime.datetime,
+    end_date: datetime.datetime,
+    file_type: str,
+    resume: bool | None=None,
+    delete_duplicate: bool | None=None,
+    rate_limiter: TokenBucket | None=None
+):
+    # resume and delete_duplicate are asked about when they are None, rate_limiter lets several downloads share one
+    # API budget
     overall_timer = Timer()
     overall_timer.start()
-    timer = Timer()
-    total_replays: int = 0
-    replays: list[ReplayData] = []
 
     # Get local time zone
     local_offset_hours = time.localtime().tm_gmtoff // 3600
@@ -37,152 +149,495 @@ def get_replay_data(start_date: datetime.datetime, end_date: datetime.datetime,
     if end > now:
         print('[Download] | End date has not happened or is not over, setting to the current time.')
         end = now
-    before = start
 
-    if use_sql:
-        timer.start()
-        file_name = config.DB_FILE_BASE_NAME + f'_{start_date.date()}_{end_date.date()}.db'
+    file_name = get_replay_file_name(start_date, end_date, file_type)
+
+    journal = DownloadJournal(file_name)
+    state: JournalState | None = None
+    if journal.exists() and os.path.exists(file_name):
+        if resume is None:
+            resume = q.confirm('Unfinished download of these dates found, would you like to resume it?').ask()
+        if resume:
+            state = journal.load()
+            if state is None or state.start != start:
+                logger.download('The unfinished download does not start on the same date and cannot be resumed')
+                state = None
+
+    if state:
+        _truncate_to_journal(file_name, file_type, state.offset)
+    else:
         if os.path.exists(file_name):
-            if q.confirm('Duplicate database file found, would you like to delete it?').ask():
-                logger.io('Attempting to delete duplicate database file')
-                try:
-                    os.remove(file_name)
-                except Exception as e:
-                    logger.io_error('Failed to  delete duplicate database file', e, timer.stop_get_elapsed_reset())
-                else:
-                    logger.io('Succesfully deleted duplicate database file', timer.stop_get_elapsed_reset())
-        timer.start()
-        logger.io('Attempting to create tables with primary and foreign keys')
-        if e := create_tables(file_name):
-            logger.io_error('Failed to create tables', e, timer.stop_get_elapsed_reset())
-        else:
-            logger.io('Sucessfully created tables', timer.stop_get_elapsed_reset())
+            _delete_duplicate_file(file_name, file_type, delete_duplicate)
+        if file_type == config.FileTypes.SQLITE:
+            _prepare_database(file_name)
+
+    return _download_to_file(file_name, file_type, start, end, journal, state, overall_timer, rate_limiter)
+
+def _prepare_database(file_name: str):
+    timer = Timer()
+    timer.start()
+    logger.io('Attempting to create tables with primary and foreign keys')
+    if e := create_tables(file_name):
+        logger.io_error('Failed to create tables', e, timer.stop_get_elapsed_reset())
+    else:
+        logger.io('Sucessfully created tables', timer.stop_get_elapsed_reset())
+    timer.start()
+    logger.io('Attempting to populate lookup tables')
+    if e := populate_lookup_tables(file_name):
+        logger.io_error('Failed to populate lookup tables', e, timer.stop_get_elapsed_reset())
+    else:
+        logger.io('Sucessfully populated lookup tables', timer.stop_get_elapsed_reset())
+
+_FILE_TYPE_NAMES = {
+    config.FileTypes.CSV: 'CSV file',
+    config.FileTypes.SQLITE: 'database file',
+    config.FileTypes.PARQUET: 'Parquet dataset'
+}
+
+def _delete_duplicate_file(file_name: str, file_type: str, delete: bool | None=None):
+    timer = Timer()
+    name = _FILE_TYPE_NAMES[file_type]
+    if delete is None:
+        delete = q.confirm(f'Duplicate {name} found, would you like to delete it?').ask()
+    if delete:
         timer.start()
-        logger.io('Attempting to populate lookup tables')
-        if e := populate_lookup_tables(file_name):
-            logger.io_error('Failed to populate lookup tables', e, timer.stop_get_elapsed_reset())
+        logger.io(f'Attempting to delete duplicate {name}')
+        try:
+            if file_type == config.FileTypes.PARQUET:
+                delete_dataset(file_name)
+            else:
+                os.remove(file_name)
+            for sidecar_file in (file_name + INDEX_SUFFIX, file_name + STATES_SUFFIX):
+                if os.path.exists(sidecar_file):
+                    os.remove(sidecar_file)
+            DailyRollups(file_name).delete()
+        except Exception as e:
+            logger.io_error(f'Failed to  delete duplicate {name}', e, timer.stop_get_elapsed_reset())
         else:
-            logger.io('Sucessfully populated lookup tables', timer.stop_get_elapsed_reset())
+            logger.io(f'Succesfully deleted duplicate {name}', timer.stop_get_elapsed_reset())
+
+@traced('download', 'download')
+def _download_to_file(
+    file_name: str,
+    file_type: str,
+    start: int,
+    end: int,
+    journal: DownloadJournal,
+    state: JournalState | None,
+    overall_timer: Timer,
+    rate_limiter: TokenBucket | None=None
+) -> int:
+    total_replays: int = 0
+    before = start
+
+    befores = _get_windows(start, end)
+    skipped_windows = 0
+    if state:
+        skipped_windows = len(befores)
+        befores = [window for window in befores if window not in state.windows]
+        skipped_windows -= len(befores)
+        journal.resume(end)
+        logger.download(f'Resuming download, skipping {skipped_windows:,} sets of replays that were already saved ({state.rows:,} replays)')
     else:
-        file_name = config.CSV_FILE_BASE_NAME + f'_{start_date.date()}_{end_date.date()}.csv'
-        if os.path.exists(file_name):
-            if q.confirm('Duplicate CSV file found, would you like to delete it?').ask():
-                timer.start()
-                logger.io('Attempting to delete duplicate CSV file')
-                try:
-                    os.remove(file_name)
-                except Exception as e:
-                    logger.io_error('Failed to  delete duplicate CSV file', e, timer.stop_get_elapsed_reset())
-                else:
-                    logger.io('Succesfully deleted duplicate CSV file', timer.stop_get_elapsed_reset())
+        create_replay_dir()
+        journal.start(start, end, get_sink_offset(file_name, file_type))
+    logger.download(f'Beginning download of {len(befores):,} sets of replays')
+
+    rate_limiter = rate_limiter or TokenBucket(config.REQUESTS_PER_SECOND)
+    telemetry = DownloadTelemetry()
+    index = _open_index(file_name, file_type)
+    player_states = _open_player_states(file_name, file_type)
+    if file_type == config.FileTypes.SQLITE:
+        _drop_indexes(file_name)
+    buffer = ReplayBuffer(config.MAX_BUFFER_BYTES, index)
+    failed_windows = 0
+    failed_saves = 0
 
-    loops_required = math.ceil((end - start) / 700)
-    loops = 0
-    logger.download(f'Beginning download of {loops_required :,} sets of replays')
-    
+    def save(replays_df: pl.DataFrame | None, windows: list[int], final: bool):
+        nonlocal failed_saves
+        if not _flush(replays_df, windows, file_name, file_type, journal, player_states):
+            failed_saves += 1
+        if final:
+            if file_type == config.FileTypes.SQLITE:
+                _create_indexes(file_name)
+            # Nothing is being downloaded anymore so the index matches what was saved, unless a save failed
+            _save_index(index, file_name, file_type, failed_saves == 0)
+            _save_player_states(player_states, file_name, file_type)
+
+    writer = BackgroundWriter(save)
     try:
-        with tqdm(
-            total=loops_required,
-            ncols=75,
-            bar_format='[Download] | {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]',
-            mininterval=0.2
-        ) as progress:
-            while before < end:
-                start_time = time.perf_counter()
-
-                before += 700
-
-                try:
-                    downloaded = _download_replays(before)
-                except Exception as e:
-                    logger.download_error_tqdm(f'Encountered an error while attempting to download set {loops + 1} of {loops_required:,}, retrying', e)
-                    attempts = 0
-                    sleep_time = (attempts + 1) * 1.005
-                    while attempts < config.MAX_RETRIES:
-                        downloaded = None
-                        try:
-                            time.sleep(sleep_time)
-                            downloaded = _download_replays(before)
-                            logger.download_error_tqdm(f'Retry {attempts + 1} succeeded, the set was succesfully downloaded, resuming normal operation')
-                            break
-                        except Exception as e:
-                            attempts += 1
-                            sleep_time = (attempts + 1) * 1.005
-                            logger.download_error_tqdm(f'Retry {attempts} failed, waiting {sleep_time} second(s) and trying again')
-                    else:
-                        logger.download_error_tqdm(f'All retry attempts failed for set {loops + 1} of {loops_required:,} with before value {before}, and will not be included in the final output')                        
-                    
-                    if downloaded:
-                        replays.extend(downloaded)
-                        total_replays += len(downloaded)
-                        del downloaded [:]
-                    loops += 1
-                    time.sleep(1.005)
-                    continue
-                
-                replays.extend(downloaded)
-                total_replays += len(downloaded)
-                del downloaded [:]
-                if len(replays) > config.MAX_REPLAY_THRESHOLD:
-                    _save_replay_data_to_file(replays, file_name, use_sql)
-                    del replays[:]
-                
-                loops += 1
+        with (
+            tqdm(
+                total=len(befores),
+                ncols=75,
+                bar_format='[Download] | {percentage:3.0f}%|{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}]',
+                mininterval=0.2
+            ) as progress,
+            closing(_download_windows(befores, rate_limiter, telemetry=telemetry)) as windows
+        ):
+            for before, downloaded in windows:
+                if downloaded is None:
+                    failed_windows += 1
+                else:
+                    with span('buffer', 'download', rows=len(downloaded)):
+                        total_replays += buffer.append(before, downloaded)
+                if buffer.is_full():
+                    writer.submit(*buffer.take())
                 progress.update(1)
-                elapsed_time = time.perf_counter() - start_time 
-                if elapsed_time - 0.005 < 1:
-                    time.sleep(1 - elapsed_time + 0.005)
-                
-            if replays:
-                _save_replay_data_to_file(replays, file_name, use_sql, True)
+
+            writer.submit(*buffer.take(), final=True)
+            writer.close()
     except KeyboardInterrupt:
         logger.download('Execution interrupted')
-        if replays:
-            _save_replay_data_to_file(replays, file_name, use_sql, True)
-        if downloaded:
-            logger.download(f'Replay set from before value {before} possibly lost')
+        if not writer.closed:
+            writer.submit(*buffer.take(), final=True)
+        writer.close()
+        if before < end:
+            logger.download(f'Replay sets after before value {before} were not downloaded, run the same download again to resume it')
+        _report_download(file_name, start, end, len(befores), skipped_windows, failed_windows, total_replays, index.dropped, overall_timer.stop_get_elapsed_reset(), telemetry, interrupted=True)
         return total_replays
 
-    logger.download(f'Finished gathering {total_replays:,} replays', overall_timer.stop_get_elapsed_reset())
+    if index.dropped:
+        logger.download(f'Dropped {index.dropped:,} duplicate replays')
+    if failed_windows:
+        logger.download(f'{failed_windows:,} sets of replays could not be downloaded, run the same download again to resume it and retry them')
+    else:
+        journal.remove()
+    elapsed = overall_timer.stop_get_elapsed_reset()
+    logger.download(f'Finished gathering {total_replays:,} replays', elapsed)
+    _report_download(file_name, start, end, len(befores), skipped_windows, failed_windows, total_replays, index.dropped, elapsed, telemetry)
     return total_replays
 
-def _save_replay_data_to_file(replay_data: list[ReplayData], file_name: str, use_sql: bool, use_indexes: bool=False):
+def extend_replay_data(file_name: str, rate_limiter: TokenBucket | None=None) -> tuple[int, str]:
+    # Downloads everything newer than the latest replay in an existing file and appends it, leaving what is there alone.
+    # Returns the replays downloaded and where the file is now, it is renamed to end today once it is up to date
+    overall_timer = Timer()
+    overall_timer.start()
     timer = Timer()
-    logger.io_tqdm(f'Attempting to save {len(replay_data):,} replays to file')
+    file_type = Path(file_name).suffix
+
+    journal = DownloadJournal(file_name)
+    if state := journal.load():
+        _truncate_to_journal(file_name, file_type, state.offset)
+
+    timer.start()
+    logger.io('Attempting to find the latest replay in the file')
     try:
+        latest = _get_latest_battle_at(file_name, file_type)
+    except Exception as e:
+        logger.io_error('Failed to find the latest replay in the file', e, timer.stop_get_elapsed_reset())
+        return 0, file_name
+    if latest is None:
+        logger.io('The file has no replays to extend from', timer.stop_get_elapsed_reset())
+        return 0, file_name
+    logger.io(f'The latest replay in the file is from {datetime.datetime.fromtimestamp(latest)}', timer.stop_get_elapsed_reset())
+
+    # Replays at the latest second were all downloaded by the window that covered it
+    start = latest + 1
+    end = math.trunc(datetime.datetime.now().timestamp())
+    if end <= start:
+        logger.download('The file is already up to date')
+        return 0, file_name
+
+    total_replays = _download_to_file(file_name, file_type, start, end, journal, None, overall_timer, rate_limiter)
+    if not journal.exists():
+        file_name = _rename_to_end_date(file_name, datetime.date.today())
+    return total_replays, file_name
+
+@traced('merge', 'save')
+def merge_replay_files(file_names: list[str], file_type: str) -> int:
+    # Combines several replay files of any type into one new file, dropping every replay that is in more than one
+    overall_timer = Timer()
+    overall_timer.start()
+    timer = Timer()
+
+    date_ranges = [match.groups() for file in file_names if (match := _DATE_RANGE.search(Path(file).stem))]
+    if len(date_ranges) != len(file_names):
+        logger.io('Only replay files named with their start and end dates can be merged')
+        return 0
+    file_name = config.REPLAY_FILE_BASE_NAME + f'_{min(start for start, _ in date_ranges)}_{max(end for _, end in date_ranges)}{file_type}'
+    if any(os.path.abspath(file) == os.path.abspath(file_name) for file in file_names):
+        logger.io(f'The merged file would replace {Path(file_name).name}, choose a different file type to merge into')
+        return 0
+
+    if os.path.exists(file_name):
+        _delete_duplicate_file(file_name, file_type)
+    create_replay_dir()
+    if file_type == config.FileTypes.SQLITE:
+        _prepare_database(file_name)
+
+    index = _open_index(file_name, file_type)
+    player_states = _open_player_states(file_name, file_type)
+    if file_type == config.FileTypes.SQLITE:
+        _drop_indexes(file_name)
+    total_replays = 0
+    failed_saves = 0
+    for file in file_names:
         timer.start()
-        replays_df = pl.DataFrame(replay_data)
-        create_replay_dir()
-        if use_sql:
-            connection = config.SQLITE_URI + file_name
-            replays_df.write_database(
-                table_name=config.Tables.ReplayData,
-                connection=connection,
-                if_table_exists='append'
-            )
-            logger.io_tqdm(f'Successfully saved {len(replay_data):,} replays to file', timer.stop_get_elapsed_reset())
-            if use_indexes:
-                timer.start()
-                logger.io_tqdm('Attempting to create indexes')
-                e = create_indexes(file_name)
-                if e:
-                    logger.io_error_tqdm('Failed to create indexes', e, timer.stop_get_elapsed_reset())
-                else:
-                    logger.io_tqdm('Successfully created indexes', timer.stop_get_elapsed_reset())
+        logger.io(f'Attempting to read replays from {Path(file).name}')
+        try:
+            replays_df = _read_replay_file(file, Path(file).suffix).sort('battle_at')
+        except Exception as e:
+            logger.io_error(f'Failed to read replays from {Path(file).name}, it will not be included in the merged file', e, timer.stop_get_elapsed_reset())
+            continue
+        logger.io(f'Successfully read {replays_df.height:,} replays from {Path(file).name}', timer.stop_get_elapsed_reset())
+        replays_df = index.filter(replays_df)
+        if replays_df.height:
+            if _save_and_roll_up(replays_df, file_name, file_type, player_states):
+                total_replays += replays_df.height
+            else:
+                failed_saves += 1
+    if file_type == config.FileTypes.SQLITE:
+        _create_indexes(file_name)
+    _save_index(index, file_name, file_type, failed_saves == 0)
+    _save_player_states(player_states, file_name, file_type)
+
+    logger.io(f'Dropped {index.dropped:,} duplicate replays')
+    logger.io(f'Finished merging {total_replays:,} replays into {Path(file_name).name}', overall_timer.stop_get_elapsed_reset())
+    return total_replays
+
+def _get_latest_battle_at(file_name: str, file_type: str) -> int | None:
+    match file_type:
+        case config.FileTypes.SQLITE:
+            return sql_utils.get_max_battle_at(file_name)
+        case config.FileTypes.PARQUET:
+            return parquet_utils.get_max_battle_at(file_name)
+        case _:
+            return pl.scan_csv(file_name).select(pl.col('battle_at').max()).collect().item()
+
+_DATE_RANGE = re.compile(r'_(\d{4}-\d{2}-\d{2})_(\d{4}-\d{2}-\d{2})$')
+
+def _rename_to_end_date(file_name: str, end_date: datetime.date) -> str:
+    # Keeps the end date in the file name accurate after the file was extended, renaming does not touch the contents
+    path = Path(file_name)
+    match = _DATE_RANGE.search(path.stem)
+    if not match:
+        return file_name
+    new_path = path.with_name(f'{path.stem[:match.start()]}_{match[1]}_{end_date}{path.suffix}')
+    if new_path == path or new_path.exists():
+        return file_name
+    try:
+        os.replace(path, new_path)
+        for suffix in (INDEX_SUFFIX, STATES_SUFFIX):
+            if os.path.exists(sidecar_file := str(path) + suffix):
+                os.replace(sidecar_file, str(new_path) + suffix)
+        DailyRollups(str(path)).rename(str(new_path))
+        if os.path.exists(summary_file := get_summary_file(path)):
+            os.replace(summary_file, get_summary_file(new_path))
+    except Exception as e:
+        logger.io_error(f'Failed to rename {path.name} to {new_path.name}', e)
+        return file_name
+    logger.io(f'Renamed {path.name} to {new_path.name}')
+    return str(new_path)
+
+def get_sink_offset(file_name: str, file_type: str) -> int:
+    # Where the file ends, as bytes for CSV, the last rowid for SQLite and the next part number for Parquet
+    match file_type:
+        case config.FileTypes.SQLITE:
+            return get_max_rowid(file_name) if os.path.exists(file_name) else 0
+        case config.FileTypes.PARQUET:
+            return get_next_sequence(file_name)
+        case _:
+            return get_file_size(file_name)
+
+def _truncate_to_journal(file_name: str, file_type: str, offset: int):
+    # Replays saved after the last journal entry belong to sets that will be downloaded again
+    timer = Timer()
+    timer.start()
+    match file_type:
+        case config.FileTypes.SQLITE:
+            deleted, e = delete_rows_after(file_name, offset)
+            unit = 'replays'
+        case config.FileTypes.PARQUET:
+            deleted, e = delete_parts_from(file_name, offset)
+            unit = 'part files'
+        case _:
+            deleted, e = truncate_file(file_name, offset), None
+            unit = 'bytes'
+    if e:
+        logger.io_error('Failed to remove replays saved after the last journal entry', e, timer.stop_get_elapsed_reset())
+    elif deleted:
+        logger.io(f'Removed {deleted:,} {unit} saved after the last journal entry', timer.stop_get_elapsed_reset())
+    try:
+        DailyRollups(file_name).delete_after(offset)
+    except Exception as e:
+        logger.io_error('Failed to remove daily rollups saved after the last journal entry, they will be rebuilt when analyzing', e)
+
+def _flush(
+    replays_df: pl.DataFrame | None,
+    windows: list[int],
+    file_name: str,
+    file_type: str,
+    journal: DownloadJournal,
+    player_states: PlayerStates | None=None
+) -> bool:
+    saved = True
+    rows = replays_df.height if replays_df is not None else 0
+    if rows:
+        with span('flush', 'save', rows=rows):
+            saved = _save_and_roll_up(replays_df, file_name, file_type, player_states)
+    if saved and windows:
+        try:
+            journal.record_flush(windows, rows, get_sink_offset(file_name, file_type))
+        except Exception as e:
+            logger.io_error_tqdm('Failed to record saved replays in the journal', e)
+    return saved
+
+def _save_and_roll_up(replays_df: pl.DataFrame, file_name: str, file_type: str, player_states: PlayerStates | None=None) -> bool:
+    # The rollups and player states are only added to once the replays are saved, so they never count a replay the
+    # file doesn't have
+    start_offset = get_sink_offset(file_name, file_type)
+    if not _save_replay_data_to_file(replays_df, file_name, file_type):
+        return False
+    if config.DAILY_ROLLUPS:
+        timer = Timer()
+        timer.start()
+        try:
+            with span('roll up', 'save', rows=replays_df.height):
+                DailyRollups(file_name).append(replays_df, start_offset, get_sink_offset(file_name, file_type))
+        except Exception as e:
+            logger.io_error_tqdm('Failed to update the daily rollups, they will be rebuilt when analyzing', e, timer.stop_get_elapsed_reset())
         else:
-            # FIXME: This is really fucked up and there is probably a better way to do this
-            global first_save
-            with open(file_name, mode='a', encoding='utf8') as file:
-                replays_df.write_csv(file, include_header=first_save)
-                first_save = False
-            logger.io_tqdm(f'Successfully saved {len(replay_data):,} replays to file', timer.stop_get_elapsed_reset())
-        
+            logger.io_tqdm('Successfully updated the daily rollups', timer.stop_get_elapsed_reset())
+    if player_states is not None:
+        try:
+            with span('update player states', 'save', rows=replays_df.height):
+                player_states.add(replays_df)
+        except Exception as e:
+            player_states.complete = False
+            logger.io_error_tqdm('Failed to update the player states, they will be rebuilt when analyzing', e)
+    return True
+
+def _read_replay_file(file_name: str, file_type: str, columns: list[str] | None=None) -> pl.DataFrame:
+    columns = columns or list(REPLAY_DATA_SCHEMA.names())
+    schema = {column: REPLAY_DATA_SCHEMA[column] for column in columns}
+    match file_type:
+        case config.FileTypes.SQLITE:
+            with sql_utils.connect(file_name) as connection:
+                replays_df = pl.read_database(f'SELECT {", ".join(columns)} FROM {config.Tables.ReplayData}', connection)
+        case config.FileTypes.PARQUET:
+            replays_df = scan_dataset(file_name).select(columns).collect()
+        case _:
+            replays_df = pl.read_csv(file_name, columns=columns, schema_overrides=schema)
+    return replays_df.select(columns).cast(schema)
+
+def _open_index(file_name: str, file_type: str) -> BattleIdIndex:
+    # The saved index is used as long as the file has not changed since, otherwise it is rebuilt from the file
+    offset = get_sink_offset(file_name, file_type)
+    if (index := BattleIdIndex.load(file_name + INDEX_SUFFIX, offset)) is not None:
+        return index
+    index = BattleIdIndex()
+    if offset:
+        timer = Timer()
+        timer.start()
+        logger.io('Attempting to rebuild the battle id index from the file')
+        try:
+            index.add_existing(_read_replay_file(file_name, file_type, ['battle_id', 'battle_at']))
+        except Exception as e:
+            logger.io_error('Failed to rebuild the battle id index, duplicates already in the file will not be dropped', e, timer.stop_get_elapsed_reset())
+        else:
+            logger.io(f'Successfully rebuilt the battle id index with {len(index):,} replays', timer.stop_get_elapsed_reset())
+    return index
+
+def _save_index(index: BattleIdIndex, file_name: str, file_type: str, valid: bool=True):
+    index_file = file_name + INDEX_SUFFIX
+    try:
+        if valid:
+            index.save(index_file, get_sink_offset(file_name, file_type))
+        elif os.path.exists(index_file):
+            os.remove(index_file)
+    except Exception as e:
+        logger.io_error_tqdm('Failed to save the battle id index, it will be rebuilt from the file next time', e)
+
+def _open_player_states(file_name: str, file_type: str) -> PlayerStates | None:
+    # Only kept up to date while downloading if the saved states match the file, otherwise analysis rebuilds them
+    if not config.PLAYER_STATES:
+        return None
+    offset = get_sink_offset(file_name, file_type)
+    if not offset:
+        return PlayerStates()
+    return PlayerStates.load(file_name + STATES_SUFFIX, offset)
+
+def _save_player_states(player_states: PlayerStates | None, file_name: str, file_type: str):
+    if player_states is None or not player_states.complete:
+        return
+    try:
+        player_states.save(file_name + STATES_SUFFIX, get_sink_offset(file_name, file_type))
+    except Exception as e:
+        logger.io_error_tqdm('Failed to save the player states, they will be rebuilt when analyzing', e)
+
+def _report_download(
+    file_name: str,
+    start: int,
+    end: int,
+    windows: int,
+    skipped_windows: int,
+    failed_windows: int,
+    total_replays: int,
+    duplicates_dropped: int,
+    elapsed: float | None,
+    telemetry: DownloadTelemetry,
+    interrupted: bool=False
+):
+    close_session()
+    telemetry.report()
+    try:
+        summary_file = write_run_summary(file_name, {
+            'file': file_name,
+            'start': start,
+            'end': end,
+            'windows': windows,
+            'skipped_windows': skipped_windows,
+            'failed_windows': failed_windows,
+            'replays': total_replays,
+            'duplicates_dropped': duplicates_dropped,
+            'elapsed_seconds': elapsed,
+            'interrupted': interrupted,
+            'download': telemetry.summary()
+        })
     except Exception as e:
-        logger.io_error_tqdm(f'Failed to save {len(replay_data):,} replays to file, resuming normal execution', e, timer.stop_get_elapsed_reset())
-    
-    # In attempt to reduce memory leaks
+        logger.io_error('Failed to save run summary', e)
+    else:
+        logger.io(f'Saved run summary to {summary_file}')
+
+def _create_indexes(file_name: str):
+    timer = Timer()
+    timer.start()
+    logger.io_tqdm('Attempting to create indexes')
+    with span('create indexes', 'save'):
+        e = create_indexes(file_name)
+    if e:
+        logger.io_error_tqdm('Failed to create indexes', e, timer.stop_get_elapsed_reset())
+    else:
+        logger.io_tqdm('Successfully created indexes', timer.stop_get_elapsed_reset())
+    if e := finish_bulk_load(file_name):
+        logger.io_error_tqdm('Failed to checkpoint the database', e)
+
+def _drop_indexes(file_name: str):
+    # Extending or resuming appends to a database that may already be indexed, the indexes are rebuilt once at the end
+    if e := drop_indexes(file_name):
+        logger.io_error_tqdm('Failed to drop indexes, saving will be slower', e)
+
+def _save_replay_data_to_file(replays_df: pl.DataFrame, file_name: str, file_type: str) -> bool:
+    timer = Timer()
+    logger.io_tqdm(f'Attempting to save {replays_df.height:,} replays to file')
     try:
-        del replays_df
-    except:
-        pass
-    gc.collect()
\ No newline at end of file
+        timer.start()
+        create_replay_dir()
+        with span('save replays', 'save', rows=replays_df.height, bytes=replays_df.estimated_size(), file_type=file_type):
+            if file_type == config.FileTypes.SQLITE:
+                _, e = bulk_insert(file_name, replays_df)
+                if e:
+                    raise e
+            elif file_type == config.FileTypes.PARQUET:
+                write_partitioned(replays_df, file_name, get_next_sequence(file_name))
+            else:
+                # Only the first save to a file writes the header, resumed downloads append to a file that already has one
+                include_header = get_file_size(file_name) == 0
+                with open(file_name, mode='a', encoding='utf8') as file:
+                    replays_df.write_csv(file, include_header=include_header)
+        logger.io_tqdm(f'Successfully saved {replays_df.height:,} replays to file', timer.stop_get_elapsed_reset())
+    except Exception as e:
+        logger.io_error_tqdm(f'Failed to save {replays_df.height:,} replays to file, resuming normal execution', e, timer.stop_get_elapsed_reset())
+        return False
+    return True
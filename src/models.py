@@ -1,4 +1,5 @@
-from typing import TypedDict, Optional
+import polars as pl
+from typing import TypedDict, Optional, get_args, get_type_hints
 
 class ReplayData(TypedDict):
     battle_at: int
@@ -43,4 +44,32 @@ class SimplifiedReplayData(TypedDict):
     p2_power: int
     p2_rank: int
     p2_rank_name: str
-    winner: int
\ No newline at end of file
+    winner: int
+
+_POLARS_TYPES = {int: pl.Int64, str: pl.String}
+
+def _to_polars_schema(model: type) -> pl.Schema:
+    # Optional fields are unwrapped to their inner type, polars columns are always nullable
+    return pl.Schema({
+        name: _POLARS_TYPES[hint] if hint in _POLARS_TYPES else _POLARS_TYPES[get_args(hint)[0]]
+        for name, hint in get_type_hints(model).items()
+    })
+
+# Fixed schema so every save has the same column types even when a batch has a column that is entirely null
+REPLAY_DATA_SCHEMA = _to_polars_schema(ReplayData)
+# Columns that only ever hold small ids, like the ones in src/enums.py and the game version, are analyzed as the
+# narrowest types that fit every id with room for ones added later. Files are still saved with the schema above so old
+# and new files can be read together
+ANALYSIS_SCHEMA = pl.Schema({
+    **REPLAY_DATA_SCHEMA,
+    'battle_type': pl.Int8,
+    'game_version': pl.Int32,
+    'p1_chara_id': pl.Int16,
+    'p1_rank': pl.Int16,
+    'p1_region_id': pl.Int8,
+    'p2_chara_id': pl.Int16,
+    'p2_rank': pl.Int16,
+    'p2_region_id': pl.Int8,
+    'stage_id': pl.Int16,
+    'winner': pl.Int8
+})
@@ -1,8 +1,14 @@
-import src.config as config, questionary as q, datetime, os
-from src.get_replays import get_replay_data
-from src.analyze_replays import analyze_replay_data
-from src.utils.file_utils import write_results_to_excel
-from src.enums import Ranks
+# The downloading, analysis and export modules load polars, requests and xlsxwriter, so they are only imported once an
+# action that needs them is chosen and the menu comes up without them
+import src.config as config, questionary as q, datetime
+from pathlib import Path
+from src.utils.replay_files import list_replay_files
+
+FILE_TYPES = {
+    config.CSV: config.FileTypes.CSV,
+    config.SQLITE: config.FileTypes.SQLITE,
+    config.PARQUET: config.FileTypes.PARQUET
+}
 
 def ask_with_interrupt_check(q: q.Question):
     answer = q.ask()
@@ -10,19 +16,65 @@ def ask_with_interrupt_check(q: q.Question):
         return answer
     raise KeyboardInterrupt
 
+RESULTS_FORMAT_NAMES = {
+    config.ResultsFormats.XLSX: 'an excel file',
+    config.ResultsFormats.PARQUET: 'parquet files',
+    config.ResultsFormats.IPC: 'arrow files',
+    config.ResultsFormats.CSV: 'csv files'
+}
+
+def get_save_question():
+    return f'Would you like to save the results to {" and ".join(RESULTS_FORMAT_NAMES[suffix] for suffix in config.RESULTS_FORMATS)}'
+
 def has_replays():
-    return os.path.exists(config.REPLAY_DIR) and os.listdir(config.REPLAY_DIR)
+    return bool(list_replay_files())
+
+def prompt_approximate_analysis():
+    from src.analyze_replays import analyze_replays_approximately
+    from src.utils.file_utils import write_results
+
+    replay_data_file_paths = ask_with_interrupt_check(q.checkbox(
+        message='What files would you like to analyze',
+        choices=list_replay_files(),
+        validate=lambda files: len(files) >= 1 or 'Choose at least 1 file'
+    ))
+    start_date = end_date = None
+    results_file_path = 'replay_data_approximate'
+    if ask_with_interrupt_check(q.confirm('Would you like to analyze only some of the dates in the files', default=False)):
+        start_date = ask_with_interrupt_check(q.text(message='What is the first date to analyze (YYYY-MM-DD)'))
+        end_date = ask_with_interrupt_check(q.text(message='What is the last date to analyze (YYYY-MM-DD)'))
+        start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d').date()
+        end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d').date()
+        results_file_path = f'replay_data_approximate_{start_date}_{end_date}'
+    win_rates, players_per_character, players_per_rank, players_per_character_and_rank, power_percentiles, top_players = analyze_replays_approximately(
+        [config.REPLAY_DIR + '/' + file for file in replay_data_file_paths], start_date, end_date
+    )
+    # Estimates are never cached, they are already quick to work out from the sketches
+    if ask_with_interrupt_check(q.confirm(get_save_question())):
+        write_results(results_file_path, [
+            (win_rates, 'Character Stats (CS)',),
+            (players_per_character, 'Players per Character',),
+            (players_per_rank, 'Players per Rank',),
+            (players_per_character_and_rank, 'Players per Character & Rank',),
+            (power_percentiles, 'Power Percentiles',),
+            (top_players, 'Top Players',)
+        ])
 
 def prompt():
+    replay_files = list_replay_files()
     choices = [
         config.DOWNLOAD,
-        q.Choice(config.ANALYZE, disabled='No Replays Downloaded' if not has_replays() else None),
+        q.Choice(config.EXTEND, disabled='No Replays Downloaded' if not replay_files else None),
+        q.Choice(config.MERGE, disabled='Not Enough Replays Downloaded' if len(replay_files) < 2 else None),
+        q.Choice(config.ANALYZE, disabled='No Replays Downloaded' if not replay_files else None),
         config.HELP,
         config.QUIT
     ]
 
     match q.select(message='What would you like to do', choices=choices).ask():
         case config.DOWNLOAD:
+            from src.get_replays import get_replay_data
+
             start_date = ask_with_interrupt_check(q.text(
                 message='What is the start date to begin downloading replays from (YYYY-MM-DD)',
                 default=datetime.date.today().replace(day=1).strftime('%Y-%#m-%#d')
@@ -35,35 +87,89 @@ def prompt():
                 message='What file type would you like the results to be saved to',
                 choices=[
                     config.CSV,
-                    config.SQLITE
+                    config.SQLITE,
+                    config.PARQUET
                 ]
             ))
             start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d')
             end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d')
             
-            get_replay_data(start_date, end_date, file_type == config.SQLITE)
+            get_replay_data(start_date, end_date, FILE_TYPES[file_type])
+        case config.EXTEND:
+            from src.get_replays import extend_replay_data
+
+            if not has_replays():
+                print('No replay files found.')
+                return True
+            replay_data_file_path = ask_with_interrupt_check(q.select(
+                message='What file would you like to extend to now',
+                choices=list_replay_files() + [config.BACK]
+            ))
+            if replay_data_file_path == config.BACK:
+                return True
+            extend_replay_data(config.REPLAY_DIR + '/' + replay_data_file_path)
+        case config.MERGE:
+            from src.get_replays import merge_replay_files
+
+            replay_data_file_paths = ask_with_interrupt_check(q.checkbox(
+                message='What files would you like to merge',
+                choices=list_replay_files(),
+                validate=lambda files: len(files) >= 2 or 'Choose at least 2 files'
+            ))
+            file_type = ask_with_interrupt_check(q.select(
+                message='What file type would you like the merged replays to be saved to',
+                choices=[
+                    config.CSV,
+                    config.SQLITE,
+                    config.PARQUET
+                ]
+            ))
+            merge_replay_files(
+                [config.REPLAY_DIR + '/' + file for file in replay_data_file_paths],
+                FILE_TYPES[file_type]
+            )
         case config.ANALYZE:
             # Redundant but just in case
             if not has_replays():
                 print('No replay files found.')
                 return True
+            if config.APPROXIMATE_ANALYSIS:
+                prompt_approximate_analysis()
+                return True
+            from src.analyze_replays import analyze_rating_trajectories, analyze_replay_data, get_result_sheets
+            from src.utils.file_utils import write_results
+            from src.utils.results_cache import get_cache_key
+
             replay_data_file_path = ask_with_interrupt_check(q.select(
                 message='What file would you like to analyze',
-                choices=[ 
-                    file for file in os.listdir(config.REPLAY_DIR)
-                ] + [config.BACK]
+                choices=list_replay_files() + [config.BACK]
             ))
             if replay_data_file_path == config.BACK:
                 return True
-            win_rates, player_stats, rank_percentiles_and_distribution, win_rates_by_rank = analyze_replay_data(config.REPLAY_DIR + '/' + replay_data_file_path)
-            if ask_with_interrupt_check(q.confirm('Would you like to save the results to an excel file')):
-                write_results_to_excel(replay_data_file_path, [
-                        (win_rates, 'Character Stats (CS)',),
-                        (player_stats, 'Player Stats',),
-                        (rank_percentiles_and_distribution, 'Rank Percentiles & Distribution',)
-                ] + [
-                    (df, 'CS ' + Ranks(rank).name.replace('_', ' ')) for rank, df in win_rates_by_rank.items()
-                ])
+            start_date = end_date = None
+            results_file_path = replay_data_file_path
+            if config.DAILY_ROLLUPS and ask_with_interrupt_check(q.confirm('Would you like to analyze only some of the dates in the file', default=False)):
+                # Replay files are named after the first and last dates in them
+                file_start_date, file_end_date = Path(replay_data_file_path).stem.split('_')[-2:]
+                start_date = ask_with_interrupt_check(q.text(
+                    message='What is the first date to analyze (YYYY-MM-DD)',
+                    default=file_start_date
+                ))
+                end_date = ask_with_interrupt_check(q.text(
+                    message='What is the last date to analyze (YYYY-MM-DD)',
+                    default=file_end_date
+                ))
+                start_date = datetime.datetime.strptime(start_date, '%Y-%m-%d').date()
+                end_date = datetime.datetime.strptime(end_date, '%Y-%m-%d').date()
+                results_file_path = f'replay_data_{start_date}_{end_date}'
+            results = analyze_replay_data(config.REPLAY_DIR + '/' + replay_data_file_path, start_date, end_date)
+            # Reads every match in the file, so it is only done when asked for
+            rating_trajectories = None
+            if ask_with_interrupt_check(q.confirm('Would you like to analyze rating trajectories too', default=False)):
+                rating_trajectories = analyze_rating_trajectories(config.REPLAY_DIR + '/' + replay_data_file_path, start_date, end_date)
+            if ask_with_interrupt_check(q.confirm(get_save_question())):
+                cache_key = get_cache_key(config.REPLAY_DIR + '/' + replay_data_file_path, start_date, end_date) if config.RESULTS_CACHE else None
+                write_results(results_file_path, get_result_sheets(results, rating_trajectories), cache_key if not rating_trajectories else None)
         case config.QUIT | None:
             return False
         case config.HELP:
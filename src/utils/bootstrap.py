@@ -0,0 +1,66 @@
+import warnings, polars as pl
+
+# Resamples are drawn from the counts rather than the replays, every resample of a group is one multinomial draw of as
+# many games as the group has over its counts. numpy is only needed when confidence intervals are asked for
+_SEED = 0x7e6b8
+# Resamples are drawn a chunk at a time so the draws never take more than about this many counts at once
+_MAX_DRAWN_COUNTS = 1 << 22
+
+def bootstrap_rates(outcomes: pl.DataFrame, by: list[str], resamples: int, confidence: float) -> pl.DataFrame:
+    # Takes games per group, character and outcome, with 'win', 'loss' and 'tie' saying what every count adds to. Win
+    # rates are wins over wins and losses and pick rates games over every game in the group, the same as the exact rates
+    # they are intervals for. Every group is drawn at once, a group's counts are padded with empty ones to the most any
+    # group has
+    import numpy as np
+
+    # Counts come in whatever order they were aggregated in, they are put in a fixed one so the same seed always draws
+    # the same resamples
+    outcomes = outcomes.sort(outcomes.columns)
+    groups = outcomes.select(by).unique(maintain_order=True).with_row_index('_group') if by else pl.DataFrame({'_group': [0]}, schema={'_group': pl.UInt32})
+    charas = outcomes.select(pl.col('chara_id').unique().sort()).with_row_index('_chara')
+    outcomes = (outcomes.join(groups, on=by) if by else outcomes.with_columns(pl.lit(0, pl.UInt32).alias('_group'))).join(
+        charas, on='chara_id'
+    ).with_columns(pl.int_range(pl.len()).over('_group').alias('_count'))
+    group_index, chara_index, count_index = (outcomes[column].to_numpy() for column in ('_group', '_chara', '_count'))
+    shape = (groups.height, int(count_index.max()) + 1)
+
+    games = np.zeros(shape, np.int64)
+    games[group_index, count_index] = outcomes['games'].to_numpy()
+    totals = games.sum(axis=1)
+    # Which character every count is for, weighted by what it adds to its wins, losses and games
+    weights = {outcome: np.zeros(shape + (charas.height,)) for outcome in ('win', 'loss', 'games')}
+    for outcome in ('win', 'loss'):
+        weights[outcome][group_index, count_index, chara_index] = outcomes[outcome].cast(pl.Float64).to_numpy()
+    weights['games'][group_index, count_index, chara_index] = (
+        outcomes.select(pl.sum_horizontal('win', 'loss', 'tie').cast(pl.Float64)).to_series().to_numpy()
+    )
+
+    rng = np.random.default_rng(_SEED)
+    chunk = max(1, _MAX_DRAWN_COUNTS // games.size)
+    win_rates, pick_rates = [], []
+    for start in range(0, resamples, chunk):
+        # Drawn as (group, resample, count) so the weights apply to every group's resamples in one matrix product
+        draws = rng.multinomial(totals, games / np.maximum(totals, 1)[:, None], size=(min(chunk, resamples - start), groups.height))
+        draws = draws.transpose(1, 0, 2).astype(np.float64)
+        wins, losses, chara_games = (draws @ weights[outcome] for outcome in ('win', 'loss', 'games'))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            win_rates.append(wins / (wins + losses))
+            pick_rates.append(chara_games / chara_games.sum(axis=2, keepdims=True))
+    win_rates, pick_rates = np.concatenate(win_rates, axis=1), np.concatenate(pick_rates, axis=1)
+
+    tails = [(1 - confidence) / 2, (1 + confidence) / 2]
+    # A character with only ties has no win rate in any resample, its interval is left empty like its win rate
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        win_rate_low, win_rate_high = np.nanquantile(win_rates, tails, axis=1)
+        pick_rate_low, pick_rate_high = np.nanquantile(pick_rates, tails, axis=1)
+    present = outcomes.select(['_group', '_chara']).unique()
+    group_index, chara_index = present['_group'].to_numpy(), present['_chara'].to_numpy()
+    return present.with_columns([
+        pl.Series('WinRateLow', win_rate_low[group_index, chara_index]),
+        pl.Series('WinRateHigh', win_rate_high[group_index, chara_index]),
+        pl.Series('PickRateLow', pick_rate_low[group_index, chara_index]),
+        pl.Series('PickRateHigh', pick_rate_high[group_index, chara_index])
+    ]).fill_nan(None).join(groups, on='_group').join(charas, on='_chara').select(by + [
+        'chara_id', 'WinRateLow', 'WinRateHigh', 'PickRateLow', 'PickRateHigh'
+    ])
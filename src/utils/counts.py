@@ -0,0 +1,104 @@
+import polars as pl
+
+# Every analysis result can be worked out from these sets of counts, so they are what gets built from the replays,
+# combined across batches and saved in the daily rollups
+CHARA_COUNT_KEYS = ['side', 'chara_id', 'rank', 'winner']
+PLAYER_COUNT_KEYS = ['polaris_id', 'chara_id', 'rank']
+MATCHUP_COUNT_KEYS = ['side', 'chara_id', 'opponent_chara_id', 'rank', 'game_version', 'winner']
+# Counts are worked out with the keys as small integers, polaris ids are dictionary encoded so every group by compares
+# 32 bit codes instead of strings and every id string is only held once
+COUNT_DTYPES = {
+    'side': pl.Int8,
+    'chara_id': pl.Int16,
+    'opponent_chara_id': pl.Int16,
+    'rank': pl.Int16,
+    'game_version': pl.Int32,
+    'winner': pl.Int8,
+    'polaris_id': pl.Categorical()
+}
+# Counts are saved with wide types, so counts saved before and after the types above change can be read together
+SAVED_COUNT_DTYPES = {
+    'side': pl.Int64,
+    'chara_id': pl.Int64,
+    'opponent_chara_id': pl.Int64,
+    'rank': pl.Int64,
+    'game_version': pl.Int64,
+    'winner': pl.Int64,
+    'polaris_id': pl.String
+}
+
+def _cast_counts(counts: pl.DataFrame | pl.LazyFrame, dtypes: dict):
+    columns = counts.collect_schema().names()
+    return counts.cast({column: dtype for column, dtype in dtypes.items() if column in columns})
+
+def narrow_counts(counts: pl.DataFrame | pl.LazyFrame):
+    # For counts read back from a file or a database
+    return _cast_counts(counts, COUNT_DTYPES)
+
+def widen_counts(counts: pl.DataFrame | pl.LazyFrame):
+    return _cast_counts(counts, SAVED_COUNT_DTYPES)
+
+def unpivot_players(replay_df: pl.DataFrame | pl.LazyFrame):
+    # One row per player per match, every other count is built on top of this
+    return pl.concat([
+        replay_df.select([
+            pl.lit(side, COUNT_DTYPES['side']).alias('side'),
+            'battle_at',
+            pl.col(f'p{side}_polaris_id').cast(COUNT_DTYPES['polaris_id']).alias('polaris_id'),
+            pl.col(f'p{side}_name').alias('name'),
+            pl.col(f'p{side}_chara_id').cast(COUNT_DTYPES['chara_id']).alias('chara_id'),
+            pl.col(f'p{side}_rank').cast(COUNT_DTYPES['rank']).alias('rank'),
+            pl.col('winner').cast(COUNT_DTYPES['winner'])
+        ])
+        for side in (1, 2)
+    ])
+
+def count_charas(players_df: pl.DataFrame | pl.LazyFrame, by: list[str]=[]):
+    # The same counts get_chara_counts reads out of a database
+    return players_df.group_by(by + CHARA_COUNT_KEYS).agg(pl.len().cast(pl.Int64).alias('games'))
+
+def count_players(players_df: pl.DataFrame | pl.LazyFrame, by: list[str]=[]):
+    # Games, wins and ties per player, character and rank, along with the name used in the latest of those games
+    return players_df.group_by(by + PLAYER_COUNT_KEYS).agg([
+        pl.len().alias('games'),
+        (pl.col('winner') == pl.col('side')).sum().alias('wins'),
+        (pl.col('winner') == 3).sum().alias('ties'),
+        pl.col('name').get(pl.col('battle_at').arg_max()),
+        pl.max('battle_at')
+    ])
+
+def count_matchups(replay_df: pl.DataFrame | pl.LazyFrame, by: list[str]=[]):
+    # Matches between every pair of characters from the side of both players, keyed like the character counts so
+    # outcomes are counted from them the same way
+    return pl.concat([
+        replay_df.select(by + [
+            pl.lit(side, COUNT_DTYPES['side']).alias('side'),
+            pl.col(f'p{side}_chara_id').cast(COUNT_DTYPES['chara_id']).alias('chara_id'),
+            pl.col(f'p{3 - side}_chara_id').cast(COUNT_DTYPES['opponent_chara_id']).alias('opponent_chara_id'),
+            pl.col(f'p{side}_rank').cast(COUNT_DTYPES['rank']).alias('rank'),
+            pl.col('game_version').cast(COUNT_DTYPES['game_version']),
+            pl.col('winner').cast(COUNT_DTYPES['winner'])
+        ])
+        for side in (1, 2)
+    ]).group_by(by + MATCHUP_COUNT_KEYS).agg(pl.len().cast(pl.Int64).alias('games'))
+
+def merge_chara_counts(chara_counts: list[pl.DataFrame] | pl.DataFrame | pl.LazyFrame, by: list[str]=[]):
+    if isinstance(chara_counts, list):
+        chara_counts = pl.concat(chara_counts)
+    return chara_counts.group_by(by + CHARA_COUNT_KEYS).agg(pl.sum('games'))
+
+def merge_player_counts(player_counts: list[pl.DataFrame] | pl.DataFrame | pl.LazyFrame, by: list[str]=[]):
+    if isinstance(player_counts, list):
+        player_counts = pl.concat(player_counts)
+    return player_counts.group_by(by + PLAYER_COUNT_KEYS).agg([
+        pl.sum('games'),
+        pl.sum('wins'),
+        pl.sum('ties'),
+        pl.col('name').get(pl.col('battle_at').arg_max()),
+        pl.max('battle_at')
+    ])
+
+def merge_matchup_counts(matchup_counts: list[pl.DataFrame] | pl.DataFrame | pl.LazyFrame, by: list[str]=[]):
+    if isinstance(matchup_counts, list):
+        matchup_counts = pl.concat(matchup_counts)
+    return matchup_counts.group_by(by + MATCHUP_COUNT_KEYS).agg(pl.sum('games'))
@@ -0,0 +1,74 @@
+import os, polars as pl
+
+INDEX_SUFFIX = '.battle_ids'
+_SECONDS_PER_DAY = 86_400
+# The hash polars uses is only stable within a version, an index written by another version is rebuilt
+_VERSION_KEY = 'polars_version'
+_OFFSET_KEY = 'offset'
+
+def _with_keys(replays_df: pl.DataFrame) -> pl.DataFrame:
+    return replays_df.with_columns(
+        pl.col('battle_id').hash(seed=0).alias('_battle_key'),
+        (pl.col('battle_at') // _SECONDS_PER_DAY).cast(pl.Int32).alias('_battle_day')
+    )
+
+# Set of 64 bit battle id hashes split by the day the battle was played on. Duplicates always share a battle_at, so
+# a batch only has to be checked against the days it covers, which keeps every check small however big the set gets.
+class BattleIdIndex:
+    def __init__(self) -> None:
+        self._days: dict[int, pl.Series] = {}
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return sum(keys.len() for keys in self._days.values())
+
+    def _add(self, keyed_df: pl.DataFrame):
+        for (day,), day_df in keyed_df.select('_battle_day', '_battle_key').partition_by('_battle_day', as_dict=True).items():
+            keys = day_df.get_column('_battle_key')
+            if day in self._days:
+                self._days[day].append(keys)
+            else:
+                self._days[day] = keys.clone()
+
+    def filter(self, replays_df: pl.DataFrame) -> pl.DataFrame:
+        # Drops replays that were already seen, including repeats within the batch itself
+        if replays_df.is_empty():
+            return replays_df
+        keyed_df = _with_keys(replays_df).unique(subset='_battle_key', keep='first', maintain_order=True)
+        seen = [self._days[day] for day in keyed_df.get_column('_battle_day').unique() if day in self._days]
+        if seen:
+            keyed_df = keyed_df.filter(~pl.col('_battle_key').is_in(pl.concat(seen)))
+        self._add(keyed_df)
+        self.dropped += replays_df.height - keyed_df.height
+        return keyed_df.drop('_battle_key', '_battle_day')
+
+    def add_existing(self, replays_df: pl.DataFrame):
+        # Only needs the battle_id and battle_at columns of replays that are already saved
+        self._add(_with_keys(replays_df.select('battle_id', 'battle_at')))
+
+    def save(self, path: str, offset: int):
+        # Written with the offset of the file it belongs to, so it is only trusted while the file still ends there
+        index_df = pl.concat([
+            pl.DataFrame({'_battle_day': pl.repeat(day, keys.len(), dtype=pl.Int32, eager=True), '_battle_key': keys})
+            for day, keys in self._days.items()
+        ]) if self._days else pl.DataFrame(schema={'_battle_day': pl.Int32, '_battle_key': pl.UInt64})
+        index_df.write_parquet(
+            path + '.tmp',
+            compression='zstd',
+            metadata={_VERSION_KEY: pl.__version__, _OFFSET_KEY: str(offset)}
+        )
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path: str, offset: int) -> 'BattleIdIndex | None':
+        if not os.path.exists(path):
+            return None
+        try:
+            metadata = pl.read_parquet_metadata(path)
+            if metadata.get(_VERSION_KEY) != pl.__version__ or metadata.get(_OFFSET_KEY) != str(offset):
+                return None
+            index = cls()
+            index._add(pl.read_parquet(path))
+        except Exception:
+            return None
+        return index
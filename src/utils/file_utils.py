@@ -1,8 +1,18 @@
-import os, src.config as config, pathlib, polars as pl, xlsxwriter, src.utils.logger as logger
+import os, json, re, shutil, src.config as config, pathlib, polars as pl, xlsxwriter, src.utils.logger as logger, src.utils.results_cache as results_cache
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+from src.utils.memory import get_peak_memory
 from src.utils.timer import Timer
+from src.utils.tracing import span, traced
 
 DATAFRAME = 0
 WORKSHEET = 1
+# Limits of an excel sheet
+_EXCEL_MAX_ROWS = 1_048_576
+_EXCEL_MAX_SHEET_NAME = 31
+# Rows turned into python values at a time while writing a sheet
+_EXCEL_ROWS_PER_SLICE = 50_000
+_INVALID_FILE_NAME_CHARACTERS = re.compile(r'[<>:"/\\|?*]')
 
 def _create_dir(dir):
     if not os.path.exists(dir):
@@ -14,24 +24,178 @@ def create_replay_dir():
 def create_results_dir():
     _create_dir(config.RESULTS_DIR)
 
+def create_summary_dir():
+    _create_dir(config.SUMMARY_DIR)
+
 def ensure_file_exists(file: str | pathlib.Path): 
     directory = os.path.dirname(file)
     if not os.path.exists(directory):
         os.makedirs(directory)
     with open(file, 'a'): pass
 
-def write_results_to_excel(replay_file, results: list[tuple[pl.DataFrame, str]]):
+def get_file_size(file: str | pathlib.Path) -> int:
+    return os.path.getsize(file) if os.path.exists(file) else 0
+
+def truncate_file(file: str | pathlib.Path, size: int):
+    # Returns how many bytes were cut off the end of the file
+    current_size = get_file_size(file)
+    if current_size <= size:
+        return 0
+    with open(file, mode='r+b') as out:
+        out.truncate(size)
+    return current_size - size
+
+def get_summary_file(file: str | pathlib.Path):
+    # Downloads of the same dates saved as different file types only differ in their suffix
+    return os.path.join(config.SUMMARY_DIR, pathlib.Path(file).name + '.json')
+
+def write_run_summary(file: str | pathlib.Path, summary: dict):
+    # Machine readable record of a run, named after the file the run worked on
+    create_summary_dir()
+    summary_file = get_summary_file(file)
+    with open(summary_file, mode='w', encoding='utf8') as out:
+        json.dump(summary, out, indent=2)
+    return summary_file
+
+def get_results_path(replay_file, suffix: str) -> str:
+    # Results are named after the replay file they came from
+    return config.XLSX_FILE_BASE_NAME + pathlib.Path(replay_file).stem.replace('replay_data', 'results') + suffix
+
+def _get_sheet_parts(df: pl.DataFrame, sheet: str) -> list[tuple[pl.DataFrame, str]]:
+    # Sheets hold at most _EXCEL_MAX_ROWS rows including the header, bigger results are split over sheets numbered from 1
+    # with the numbers kept within the limit on sheet name length
+    rows_per_sheet = _EXCEL_MAX_ROWS - 1
+    if df.height <= rows_per_sheet:
+        return [(df, sheet)]
+    parts = []
+    for part, offset in enumerate(range(0, df.height, rows_per_sheet), 1):
+        suffix = f' ({part})'
+        parts.append((df.slice(offset, rows_per_sheet), sheet[:_EXCEL_MAX_SHEET_NAME - len(suffix)] + suffix))
+    return parts
+
+def _get_cell_writer(worksheet, dtype: pl.DataType) -> Callable:
+    # Cells are written without a format of their own so they take the format of their column
+    if dtype.is_numeric():
+        return worksheet.write_number
+    if dtype == pl.String:
+        return worksheet.write_string
+    if dtype == pl.Boolean:
+        return worksheet.write_boolean
+    if dtype.is_temporal() and dtype != pl.Duration:
+        return worksheet.write_datetime
+    return lambda row, col, value: worksheet.write_string(row, col, str(value))
+
+def _get_column_format(workbook, dtype: pl.DataType):
+    # Same number formats polars uses when writing excel files
+    if dtype.is_integer():
+        return workbook.add_format({'num_format': '#,##0;[Red]-#,##0'})
+    if dtype.is_float() or dtype.is_decimal():
+        return workbook.add_format({'num_format': '#,##0.000;[Red]-#,##0.000'})
+    if dtype == pl.Date:
+        return workbook.add_format({'num_format': 'yyyy-mm-dd;@'})
+    if dtype == pl.Datetime:
+        return workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+    return None
+
+def _write_sheet(workbook, header_format, df: pl.DataFrame, sheet: str):
+    # Constant memory workbooks write every row to disk once the next one is started, so the rows are written in order
+    # and a slice of the results at a time is turned into python values
+    worksheet = workbook.add_worksheet(sheet)
+    for col, (column, dtype) in enumerate(df.schema.items()):
+        worksheet.set_column(col, col, max(len(column) + 2, 10), _get_column_format(workbook, dtype))
+        worksheet.write_string(0, col, column, header_format)
+    worksheet.freeze_panes(1, 0)
+    worksheet.autofilter(0, 0, max(df.height, 1), max(df.width - 1, 0))
+    writers = [_get_cell_writer(worksheet, dtype) for dtype in df.dtypes]
+    row = 1
+    for rows in df.iter_slices(_EXCEL_ROWS_PER_SLICE):
+        for values in rows.iter_rows():
+            for col, value in enumerate(values):
+                if value is not None:
+                    writers[col](row, col, value)
+            row += 1
+
+def write_results_to_excel(replay_file, results: list[tuple[pl.DataFrame, str]], cache_key: str | None=None) -> str:
     timer = Timer()
     create_results_dir()
+    xlsx_file = get_results_path(replay_file, config.ResultsFormats.XLSX)
+    # The same results were already exported before, copying that file is far faster than writing every sheet again
+    if cache_key and (cached_export := results_cache.get_cached_export(cache_key)):
+        timer.start()
+        shutil.copyfile(cached_export, xlsx_file)
+        logger.io('Successfully copied the results from an earlier export of the same results', timer.stop_get_elapsed_reset())
+        return xlsx_file
     logger.io('Attempting to save results to an excel file')
-    with xlsxwriter.Workbook(config.XLSX_FILE_BASE_NAME + pathlib.Path(replay_file).stem.replace('replay_data', 'results') + '.xlsx') as wb:
+    # Rows are written straight to the file instead of being kept in memory until the workbook is closed, NaN and infinite
+    # win rates are written as errors rather than failing the whole sheet
+    with xlsxwriter.Workbook(xlsx_file, {'constant_memory': True, 'nan_inf_to_errors': True, 'remove_timezone': True}) as wb:
+        header_format = wb.add_format({'bold': True})
         for result in results:
-            timer.start()
-            try:
-                result[DATAFRAME].write_excel(wb, worksheet=result[WORKSHEET])
-            except:
-                logger.io(f'Failed to save worksheet {result[WORKSHEET]} to file')
-            logger.io(f'Successfully saved worksheet {result[WORKSHEET]} to file', timer.stop_get_elapsed_reset())
+            for df, sheet in _get_sheet_parts(result[DATAFRAME], result[WORKSHEET]):
+                timer.start()
+                try:
+                    with span('write sheet', 'export', rows=df.height, sheet=sheet):
+                        _write_sheet(wb, header_format, df, sheet)
+                    logger.io(f'Successfully saved worksheet {sheet} to file', timer.stop_get_elapsed_reset())
+                except Exception as e:
+                    logger.io_error(f'Failed to save worksheet {sheet} to file', e, timer.stop_get_elapsed_reset())
         timer.start()
         logger.io('Attempting to write all saved worksheets to file')
-    logger.io(f'Successfully wrote all saved worksheets to file', timer.stop_get_elapsed_reset())
\ No newline at end of file
+    logger.io(f'Successfully wrote all saved worksheets to file', timer.stop_get_elapsed_reset())
+    if cache_key:
+        try:
+            results_cache.save_export(cache_key, xlsx_file)
+        except Exception as e:
+            logger.io_error('Failed to save the excel file to the cache', e)
+    return xlsx_file
+
+def _write_result_file(df: pl.DataFrame, file: str, suffix: str):
+    with span('write file', 'export', rows=df.height, file=file):
+        match suffix:
+            case config.ResultsFormats.PARQUET:
+                df.write_parquet(file)
+            case config.ResultsFormats.IPC:
+                df.write_ipc(file)
+            case config.ResultsFormats.CSV:
+                df.write_csv(file)
+
+def _write_result_files(executor: ThreadPoolExecutor, replay_file, results: list[tuple[pl.DataFrame, str]], suffix: str) -> tuple[str, list[tuple[str, Future]]]:
+    # Every result is saved to a file of its own named after its sheet, in a directory named like the excel file would be.
+    # Files left over from an earlier export are removed first so results that are no longer made don't linger
+    results_dir = get_results_path(replay_file, suffix)
+    if os.path.isdir(results_dir):
+        shutil.rmtree(results_dir)
+    os.makedirs(results_dir)
+    futures = []
+    for df, sheet in results:
+        file = os.path.join(results_dir, _INVALID_FILE_NAME_CHARACTERS.sub('_', sheet) + suffix)
+        futures.append((file, executor.submit(_write_result_file, df, file, suffix)))
+    return results_dir, futures
+
+@traced('export', 'export')
+def write_results(replay_file, results: list[tuple[pl.DataFrame, str]], cache_key: str | None=None) -> list[str]:
+    # Saves the results in every format in RESULTS_FORMATS and returns where they were saved. Polars writes parquet, arrow
+    # and csv files without holding the GIL, so they are written on other threads while the excel file is written on
+    # this one
+    timer = Timer()
+    timer.start()
+    create_results_dir()
+    paths, pending = [], []
+    suffixes = [suffix for suffix in config.RESULTS_FORMATS if suffix != config.ResultsFormats.XLSX]
+    with ThreadPoolExecutor(max_workers=max(len(results), 1), thread_name_prefix='export') as executor:
+        for suffix in suffixes:
+            logger.io(f'Attempting to save results to {suffix} files')
+            results_dir, futures = _write_result_files(executor, replay_file, results, suffix)
+            paths.append(results_dir)
+            pending.extend(futures)
+        if config.ResultsFormats.XLSX in config.RESULTS_FORMATS:
+            paths.insert(0, write_results_to_excel(replay_file, results, cache_key))
+        for file, future in pending:
+            try:
+                future.result()
+            except Exception as e:
+                logger.io_error(f'Failed to save {file}', e)
+    logger.io(f'Successfully saved results to {len(paths):,} place(s)', timer.stop_get_elapsed_reset())
+    if peak_memory := get_peak_memory():
+        logger.io(f'Peak memory used so far {peak_memory / 2**20:,.0f} MiB')
+    return paths
@@ -0,0 +1,75 @@
+import threading, time, requests, src.config as config
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+# Time spent opening connections (TCP + TLS) on the current thread, requests does not expose this on its own
+_connect_time = threading.local()
+
+def take_connect_time() -> float:
+    elapsed = getattr(_connect_time, 'elapsed', 0.0)
+    _connect_time.elapsed = 0.0
+    return elapsed
+
+def _add_connect_time(start: float):
+    _connect_time.elapsed = getattr(_connect_time, 'elapsed', 0.0) + time.perf_counter() - start
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _add_connect_time(start)
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            super().connect()
+        finally:
+            _add_connect_time(start)
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool
+        }
+
+def create_session(pool_size: int=config.DOWNLOAD_WORKERS) -> requests.Session:
+    # Connections are kept alive and reused, one per download worker so none of them wait on the pool
+    session = requests.Session()
+    adapter = _TimedHTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({
+        'Accept': 'application/json',
+        'Accept-Encoding': config.ACCEPT_ENCODING,
+        'Connection': 'keep-alive'
+    })
+    return session
+
+_session: requests.Session | None = None
+_session_lock = threading.Lock()
+
+def get_session() -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
+
+def close_session():
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+            _session = None
@@ -0,0 +1,69 @@
+import queue, threading, polars as pl, src.utils.logger as logger
+from typing import Callable
+from src.models import REPLAY_DATA_SCHEMA, ReplayData
+from src.utils.dedupe import BattleIdIndex
+
+# Holds downloaded replays as small typed frames, one per set of replays, instead of millions of dicts
+class ReplayBuffer:
+    def __init__(self, max_bytes: int, index: BattleIdIndex | None=None) -> None:
+        self.max_bytes = max_bytes
+        self.index = index
+        self._frames: list[pl.DataFrame] = []
+        # Sets of replays currently held, they are only recorded in the journal once they are saved
+        self.windows: list[int] = []
+        self.rows = 0
+        self.bytes = 0
+
+    def append(self, before: int, downloaded: list[ReplayData]) -> int:
+        # Returns how many of the downloaded replays were kept after dropping ones that were already seen
+        kept = 0
+        if downloaded:
+            replays_df = pl.DataFrame(downloaded, schema=REPLAY_DATA_SCHEMA)
+            if self.index is not None:
+                replays_df = self.index.filter(replays_df)
+            self._frames.append(replays_df)
+            kept = replays_df.height
+            self.rows += kept
+            self.bytes += replays_df.estimated_size()
+        self.windows.append(before)
+        return kept
+
+    def is_full(self) -> bool:
+        return self.bytes >= self.max_bytes
+
+    def take(self) -> tuple[pl.DataFrame | None, list[int]]:
+        replays_df = pl.concat(self._frames) if self._frames else None
+        windows = self.windows
+        self._frames = []
+        self.windows = []
+        self.rows = 0
+        self.bytes = 0
+        return replays_df, windows
+
+# Saves taken buffers on its own thread so downloading carries on while a save is running. Only max_pending buffers
+# can wait to be saved, after that taking another one blocks, which keeps memory at a few buffers at most.
+class BackgroundWriter:
+    def __init__(self, write: Callable[[pl.DataFrame | None, list[int], bool], None], max_pending: int=1) -> None:
+        self._write = write
+        self._queue: queue.Queue = queue.Queue(maxsize=max_pending)
+        self.closed = False
+        self._thread = threading.Thread(target=self._run, name='replay-writer')
+        self._thread.start()
+
+    def _run(self):
+        while (item := self._queue.get()) is not None:
+            try:
+                self._write(*item)
+            except Exception as e:
+                # The writer has to keep going or every later submit would block forever
+                logger.io_error_tqdm('Unexpected error while saving replays', e)
+
+    def submit(self, replays_df: pl.DataFrame | None, windows: list[int], final: bool=False):
+        self._queue.put((replays_df, windows, final))
+
+    def close(self):
+        # Waits for every submitted buffer to be saved
+        if not self.closed:
+            self.closed = True
+            self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,68 @@
+import os, json
+from dataclasses import dataclass, field
+
+JOURNAL_SUFFIX = '.journal'
+
+@dataclass
+class JournalState:
+    start: int
+    end: int
+    # Where the output file ended after the last flush that made it into the journal, anything past it is discarded
+    offset: int
+    windows: set[int] = field(default_factory=set)
+    rows: int = 0
+    flushes: int = 0
+
+# Append only record of a download kept next to its output file. A set of replays only counts as done once the flush
+# that wrote it to the file has been recorded, so a crash at any point loses at most the replays that were not saved.
+class DownloadJournal:
+    def __init__(self, file_name: str) -> None:
+        self.path = file_name + JOURNAL_SUFFIX
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def _append(self, record: dict):
+        with open(self.path, mode='a', encoding='utf8') as journal:
+            journal.write(json.dumps(record, separators=(',', ':')) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+
+    def start(self, start: int, end: int, offset: int):
+        # A new download replaces any journal left behind by an earlier one
+        with open(self.path, mode='w', encoding='utf8'):
+            pass
+        self._append({'type': 'start', 'start': start, 'end': end, 'offset': offset})
+
+    def resume(self, end: int):
+        self._append({'type': 'resume', 'end': end})
+
+    def record_flush(self, windows: list[int], rows: int, offset: int):
+        self._append({'type': 'flush', 'windows': windows, 'rows': rows, 'offset': offset})
+
+    def load(self) -> JournalState | None:
+        if not self.exists():
+            return None
+        state = None
+        with open(self.path, mode='r', encoding='utf8') as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Only the last line can be torn by a crash while it was being written
+                    break
+                match record.get('type'):
+                    case 'start':
+                        state = JournalState(record['start'], record['end'], record['offset'])
+                    case 'resume' if state:
+                        state.end = record['end']
+                    case 'flush' if state:
+                        state.windows.update(record['windows'])
+                        state.rows += record['rows']
+                        state.offset = record['offset']
+                        state.flushes += 1
+        return state
+
+    def remove(self):
+        if self.exists():
+            os.remove(self.path)
@@ -0,0 +1,77 @@
+import os, re, shutil, src.config as config, polars as pl
+from src.utils.tracing import span
+
+# Replays are partitioned by the UTC day they were played on, one directory per day in hive style
+PARTITION_COLUMN = 'battle_date'
+_PART_FILE = re.compile(r'^part-(\d+)\.parquet$')
+
+def _partition_dirs(dataset_dir: str) -> list[str]:
+    if not os.path.isdir(dataset_dir):
+        return []
+    return sorted(
+        os.path.join(dataset_dir, partition) for partition in os.listdir(dataset_dir)
+        if partition.startswith(PARTITION_COLUMN + '=')
+    )
+
+def _part_files(dataset_dir: str):
+    for partition_dir in _partition_dirs(dataset_dir):
+        for part in os.listdir(partition_dir):
+            if match := _PART_FILE.match(part):
+                yield os.path.join(partition_dir, part), int(match[1])
+
+def get_next_sequence(dataset_dir: str) -> int:
+    # Every save writes its part files with the same sequence number, one higher than anything already saved
+    return max((sequence for _, sequence in _part_files(dataset_dir)), default=-1) + 1
+
+def delete_parts_from(dataset_dir: str, sequence: int):
+    # Temporary parts left by a crash and days left without any parts go too, so the latest day always has a part in it
+    deleted = 0
+    try:
+        for part, part_sequence in list(_part_files(dataset_dir)):
+            if part_sequence >= sequence:
+                os.remove(part)
+                deleted += 1
+        for partition_dir in _partition_dirs(dataset_dir):
+            for file in os.listdir(partition_dir):
+                if file.endswith('.tmp'):
+                    os.remove(os.path.join(partition_dir, file))
+            if not os.listdir(partition_dir):
+                os.rmdir(partition_dir)
+    except Exception as e:
+        return deleted, e
+    return deleted, None
+
+def delete_dataset(dataset_dir: str):
+    shutil.rmtree(dataset_dir)
+
+def write_partitioned(replays_df: pl.DataFrame, dataset_dir: str, sequence: int):
+    replays_df = replays_df.with_columns(pl.from_epoch('battle_at').dt.date().alias(PARTITION_COLUMN))
+    for (battle_date,), partition_df in replays_df.partition_by(PARTITION_COLUMN, as_dict=True, include_key=False).items():
+        partition_dir = os.path.join(dataset_dir, f'{PARTITION_COLUMN}={battle_date}')
+        os.makedirs(partition_dir, exist_ok=True)
+        part = os.path.join(partition_dir, f'part-{sequence:05d}.parquet')
+        with span('write part', 'save', rows=partition_df.height, day=str(battle_date)) as part_span:
+            # Written under a temporary name first so a crash can never leave a half written part that gets scanned
+            partition_df.sort('battle_at').write_parquet(
+                part + '.tmp',
+                compression='zstd',
+                compression_level=config.PARQUET_COMPRESSION_LEVEL,
+                statistics=True,
+                row_group_size=config.PARQUET_ROW_GROUP_SIZE
+            )
+            os.replace(part + '.tmp', part)
+            part_span.set(bytes=os.path.getsize(part))
+
+def scan_dataset(dataset_dir: str) -> pl.LazyFrame:
+    return pl.scan_parquet(
+        os.path.join(dataset_dir, '**', '*.parquet'),
+        hive_partitioning=True
+    )
+
+def get_max_battle_at(dataset_dir: str) -> int | None:
+    # Only the latest day needs to be read since the partitions are named after the day. Days without a finished part,
+    # like one a crash left only a temporary part in, are skipped
+    for partition_dir in reversed(_partition_dirs(dataset_dir)):
+        if any(_PART_FILE.match(part) for part in os.listdir(partition_dir)):
+            return pl.scan_parquet(os.path.join(partition_dir, '*.parquet')).select(pl.col('battle_at').max()).collect().item()
+    return None
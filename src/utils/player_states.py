@@ -0,0 +1,92 @@
+import os, polars as pl
+from src.utils.counts import COUNT_DTYPES, count_players, narrow_counts, unpivot_players, widen_counts
+
+STATES_SUFFIX = '.players'
+_OFFSET_KEY = 'offset'
+_TOTALS_SCHEMA = pl.Schema({
+    'polaris_id': COUNT_DTYPES['polaris_id'],
+    'name': pl.String,
+    'battle_at': pl.Int64,
+    'games': pl.Int64,
+    'wins': pl.Int64,
+    'ties': pl.Int64
+})
+_RANKS_SCHEMA = pl.Schema({'polaris_id': COUNT_DTYPES['polaris_id'], 'rank': COUNT_DTYPES['rank'], 'games': pl.Int64})
+_CHARAS_SCHEMA = pl.Schema({'polaris_id': COUNT_DTYPES['polaris_id'], 'chara_id': COUNT_DTYPES['chara_id'], 'games': pl.Int64})
+
+def _merge_totals(totals_df: pl.DataFrame) -> pl.DataFrame:
+    return totals_df.group_by('polaris_id').agg([
+        pl.col('name').get(pl.col('battle_at').arg_max()),
+        pl.max('battle_at'),
+        pl.sum('games'),
+        pl.sum('wins'),
+        pl.sum('ties')
+    ]).cast(_TOTALS_SCHEMA)
+
+def _merge_histogram(histogram_df: pl.DataFrame, key: str) -> pl.DataFrame:
+    return histogram_df.group_by(['polaris_id', key]).agg(pl.sum('games'))
+
+# Everything player stats are worked out from, kept per player instead of per match: games, wins and ties, the name
+# from their latest game, and how many games they played at every rank and with every character. Saved as one row per
+# player with the histograms as lists, next to the replay file it was counted from, and only trusted while that file
+# still ends where it did when the states were saved.
+class PlayerStates:
+    def __init__(self) -> None:
+        self._totals = pl.DataFrame(schema=_TOTALS_SCHEMA)
+        self._ranks = pl.DataFrame(schema=_RANKS_SCHEMA)
+        self._charas = pl.DataFrame(schema=_CHARAS_SCHEMA)
+        # Cleared when saved replays could not be added, states missing replays are never saved
+        self.complete = True
+
+    def __len__(self) -> int:
+        return self._totals.height
+
+    def add_counts(self, player_counts: pl.DataFrame):
+        # Takes the counts per player, character and rank from count_players
+        player_counts = narrow_counts(player_counts).cast({'games': pl.Int64, 'wins': pl.Int64, 'ties': pl.Int64})
+        self._totals = _merge_totals(pl.concat([self._totals, player_counts.select(_TOTALS_SCHEMA.names())]))
+        self._ranks = _merge_histogram(pl.concat([self._ranks, player_counts.select(_RANKS_SCHEMA.names())]), 'rank')
+        self._charas = _merge_histogram(pl.concat([self._charas, player_counts.select(_CHARAS_SCHEMA.names())]), 'chara_id')
+
+    def add(self, replays_df: pl.DataFrame):
+        self.add_counts(count_players(unpivot_players(replays_df)))
+
+    def to_frame(self) -> pl.DataFrame:
+        # Histograms are sorted so ties for the most played rank or character always go to the lowest one
+        def implode(histogram_df: pl.DataFrame, key: str, name: str):
+            return histogram_df.sort(['polaris_id', key]).group_by('polaris_id', maintain_order=True).agg(
+                pl.struct(key, 'games').alias(name)
+            )
+        return (
+            widen_counts(self._totals)
+            .join(implode(widen_counts(self._ranks), 'rank', 'ranks'), on='polaris_id', how='left')
+            .join(implode(widen_counts(self._charas), 'chara_id', 'charas'), on='polaris_id', how='left')
+        )
+
+    def save(self, path: str, offset: int):
+        # Written with the offset of the file it belongs to, so it is only trusted while the file still ends there
+        self.to_frame().write_parquet(path + '.tmp', compression='zstd', metadata={_OFFSET_KEY: str(offset)})
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path: str, offset: int) -> 'PlayerStates | None':
+        if not is_valid(path, offset):
+            return None
+        try:
+            states_df = pl.read_parquet(path)
+            states = cls()
+            states._totals = states_df.select(_TOTALS_SCHEMA.names()).cast(_TOTALS_SCHEMA)
+            states._ranks = states_df.select('polaris_id', 'ranks').explode('ranks').unnest('ranks').cast(_RANKS_SCHEMA)
+            states._charas = states_df.select('polaris_id', 'charas').explode('charas').unnest('charas').cast(_CHARAS_SCHEMA)
+        except Exception:
+            return None
+        return states
+
+def is_valid(path: str, offset: int) -> bool:
+    try:
+        return os.path.exists(path) and pl.read_parquet_metadata(path).get(_OFFSET_KEY) == str(offset)
+    except Exception:
+        return False
+
+def scan_states(path: str) -> pl.LazyFrame:
+    return pl.scan_parquet(path)
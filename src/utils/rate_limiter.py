@@ -0,0 +1,32 @@
+import threading, time
+
+# Shared by every download worker so the total request rate stays within the API budget no matter how many
+# requests are in flight. Callers that find the bucket empty reserve a future token and sleep until it is theirs,
+# so tokens are handed out in the order they were asked for.
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float=1) -> None:
+        if rate <= 0:
+            raise ValueError(f'rate must be greater than 0, got {rate}.')
+        if capacity < 1:
+            raise ValueError(f'capacity must be at least 1, got {capacity}.')
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self, tokens: float=1):
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
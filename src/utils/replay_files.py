@@ -0,0 +1,19 @@
+import os, pathlib, src.config as config
+
+# Kept apart from file_utils so listing the replay files for the menu doesn't load polars and the rest of the stack.
+# The listing is cached until the directory changes, adding, removing or renaming a file in it updates its modified time
+_listing: tuple[int, list[str]] | None = None
+
+def list_replay_files() -> list[str]:
+    # Only the replay files themselves, not the journals and other files that are kept next to them
+    global _listing
+    try:
+        modified = os.stat(config.REPLAY_DIR).st_mtime_ns
+    except FileNotFoundError:
+        return []
+    if _listing is None or _listing[0] != modified:
+        _listing = (modified, sorted(
+            file for file in os.listdir(config.REPLAY_DIR)
+            if pathlib.Path(file).suffix in config.REPLAY_FILE_SUFFIXES
+        ))
+    return list(_listing[1])
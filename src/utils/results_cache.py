@@ -0,0 +1,120 @@
+import datetime, hashlib, os, re, shutil, src.config as config, polars as pl
+
+_RESULT_FILES = ['win_rates', 'player_stats', 'rank_percentiles_and_distribution', 'matchups']
+_RANK_FILE = re.compile(r'^rank-(\d+)\.arrow$')
+_EXPORT_FILE = 'results.xlsx'
+# Only the start and end of every file are hashed, hashing all of a file several GiB big would take longer than
+# analyzing it from the rollups. Every save appends to the end of a file so that is where a change would show up.
+_HASHED_BYTES = 64 * 1024
+# Changing any of these can change the results or how they are exported, so they are part of every key
+_SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_ANALYSIS_SOURCES = [
+    'analyze_replays.py',
+    'enums.py',
+    'models.py',
+    os.path.join('utils', 'bootstrap.py'),
+    os.path.join('utils', 'counts.py'),
+    os.path.join('utils', 'parquet_utils.py'),
+    os.path.join('utils', 'rollups.py'),
+    os.path.join('utils', 'sql_utils.py'),
+    os.path.join('utils', 'player_states.py'),
+    os.path.join('utils', 'file_utils.py')
+]
+
+def _hash_file(digest, file: str):
+    stat = os.stat(file)
+    digest.update(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+    with open(file, mode='rb') as data:
+        digest.update(data.read(_HASHED_BYTES))
+        if stat.st_size > _HASHED_BYTES:
+            data.seek(max(stat.st_size - _HASHED_BYTES, _HASHED_BYTES))
+            digest.update(data.read())
+
+def _get_analysis_version() -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for source in _ANALYSIS_SOURCES:
+        with open(os.path.join(_SRC_DIR, source), mode='rb') as data:
+            digest.update(data.read())
+    return digest.hexdigest()
+
+def get_cache_key(file_path: str, start_date: datetime.date | None=None, end_date: datetime.date | None=None) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f'{_get_analysis_version()}:{start_date}:{end_date}'.encode())
+    # How matchups are split changes what they hold
+    digest.update(f'{config.MATCHUPS_BY_RANK}:{config.MATCHUPS_BY_GAME_VERSION}'.encode())
+    # So do the extra rates asked for
+    digest.update(f'{config.CONFIDENCE_INTERVALS}:{config.CONFIDENCE_LEVEL}:{config.BOOTSTRAP_RESAMPLES}:{config.BAYESIAN_WIN_RATES}'.encode())
+    # Parquet datasets are directories of part files, a database can have a WAL that hasn't been checkpointed yet
+    if os.path.isdir(file_path):
+        files = sorted(os.path.join(root, file) for root, _, files in os.walk(file_path) for file in files)
+    else:
+        files = [file for file in (file_path, file_path + '-wal') if os.path.exists(file)]
+    for file in files:
+        digest.update(os.path.relpath(file, file_path).encode())
+        _hash_file(digest, file)
+    return digest.hexdigest()
+
+def _entry_dir(key: str) -> str:
+    return os.path.join(config.RESULTS_CACHE_DIR, key)
+
+def _touch(entry_dir: str):
+    # The modified time of an entry is when it was last used, the least recently used entries are evicted first
+    os.utime(entry_dir)
+
+def load_results(key: str):
+    entry_dir = _entry_dir(key)
+    if not os.path.isdir(entry_dir):
+        return None
+    win_rates, player_stats, rank_percentiles_and_distribution, matchups = (
+        pl.read_ipc(os.path.join(entry_dir, name + '.arrow'), memory_map=False) for name in _RESULT_FILES
+    )
+    win_rates_by_rank = {
+        int(match[1]): pl.read_ipc(os.path.join(entry_dir, file), memory_map=False)
+        for file in os.listdir(entry_dir) if (match := _RANK_FILE.match(file))
+    }
+    _touch(entry_dir)
+    return win_rates, player_stats, rank_percentiles_and_distribution, dict(sorted(win_rates_by_rank.items())), matchups
+
+def save_results(key: str, results: tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame, dict[int, pl.DataFrame], pl.DataFrame]):
+    entry_dir = _entry_dir(key)
+    # Written under a temporary name first so a crash can never leave an entry with only some of the results in it
+    temp_dir = entry_dir + '.tmp'
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    win_rates, player_stats, rank_percentiles_and_distribution, win_rates_by_rank, matchups = results
+    for name, result_df in zip(_RESULT_FILES, (win_rates, player_stats, rank_percentiles_and_distribution, matchups)):
+        result_df.write_ipc(os.path.join(temp_dir, name + '.arrow'), compression='lz4')
+    for rank, result_df in win_rates_by_rank.items():
+        result_df.write_ipc(os.path.join(temp_dir, f'rank-{rank}.arrow'), compression='lz4')
+    shutil.rmtree(entry_dir, ignore_errors=True)
+    os.replace(temp_dir, entry_dir)
+    _evict()
+
+def get_cached_export(key: str) -> str | None:
+    export = os.path.join(_entry_dir(key), _EXPORT_FILE)
+    if not os.path.exists(export):
+        return None
+    _touch(_entry_dir(key))
+    return export
+
+def save_export(key: str, export: str):
+    # Only kept alongside results that are still cached
+    if os.path.isdir(entry_dir := _entry_dir(key)):
+        shutil.copyfile(export, os.path.join(entry_dir, _EXPORT_FILE))
+        _evict()
+
+def _get_dir_size(directory: str) -> int:
+    return sum(os.path.getsize(os.path.join(directory, file)) for file in os.listdir(directory))
+
+def _evict():
+    entries = [
+        entry.path for entry in os.scandir(config.RESULTS_CACHE_DIR)
+        if entry.is_dir() and not entry.name.endswith('.tmp')
+    ]
+    sizes = {entry: _get_dir_size(entry) for entry in entries}
+    total = sum(sizes.values())
+    for entry in sorted(entries, key=os.path.getmtime):
+        if total <= config.RESULTS_CACHE_BYTES:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= sizes[entry]
@@ -0,0 +1,213 @@
+import datetime, os, re, shutil, polars as pl
+from typing import Iterable
+from src.utils.counts import (
+    count_charas, count_matchups, count_players, merge_chara_counts, merge_matchup_counts, merge_player_counts,
+    unpivot_players, widen_counts
+)
+from src.utils.sketches import (
+    HASH_VERSION, merge_distinct_players, merge_powers, merge_top_players, sketch_distinct_players, sketch_powers,
+    sketch_top_players
+)
+
+ROLLUP_SUFFIX = '.rollups'
+DAY_COLUMN = 'battle_date'
+_CHARAS = 'characters'
+_PLAYERS = 'players'
+_MATCHUPS = 'matchups'
+_DISTINCT_PLAYERS = 'distinct_players'
+_POWERS = 'powers'
+_TOP_PLAYERS = 'top_players'
+# The character part is last since it is the one parts are found by
+_KINDS = [_PLAYERS, _MATCHUPS, _DISTINCT_PLAYERS, _POWERS, _TOP_PLAYERS, _CHARAS]
+_PART_FILE = re.compile(r'^' + _CHARAS + r'-(\d+)\.parquet$')
+# The part of the replay file a rollup part was counted from, as offsets like the ones in the journal
+_START_KEY = 'start_offset'
+_END_KEY = 'end_offset'
+_HASH_KEY = 'hash_version'
+# Which part a top player was read from
+_PART_COLUMN = 'part'
+
+def _with_day(players_df: pl.DataFrame | pl.LazyFrame):
+    # Days are UTC like the Parquet partitions
+    return players_df.with_columns(pl.from_epoch('battle_at').dt.date().alias(DAY_COLUMN))
+
+def _get_days(start_date: datetime.date | None, end_date: datetime.date | None) -> pl.Expr:
+    days = pl.lit(True)
+    if start_date:
+        days &= pl.col(DAY_COLUMN) >= start_date
+    if end_date:
+        days &= pl.col(DAY_COLUMN) <= end_date
+    return days
+
+def _count_by_day(replays_df: pl.DataFrame, players_df: pl.DataFrame) -> dict[str, pl.DataFrame]:
+    player_counts = count_players(players_df, [DAY_COLUMN])
+    return {
+        _CHARAS: count_charas(players_df, [DAY_COLUMN]),
+        _PLAYERS: player_counts,
+        _MATCHUPS: count_matchups(replays_df, [DAY_COLUMN]),
+        _DISTINCT_PLAYERS: sketch_distinct_players(player_counts, [DAY_COLUMN]),
+        _POWERS: sketch_powers(replays_df, [DAY_COLUMN]),
+        _TOP_PLAYERS: sketch_top_players(player_counts, [DAY_COLUMN])
+    }
+
+# Counts per day of every character, of every player, character and rank, and of every pair of characters, and the
+# sketches of every day's players, kept in a directory next to the replay file. Every save appends a part with the
+# counts of the replays it saved, so a date range can be analyzed by summing its days instead of reading every replay
+# in it. The parts are only trusted while together they cover the replay file from its start to where it currently
+# ends.
+class DailyRollups:
+    def __init__(self, file_name: str) -> None:
+        self.path = file_name + ROLLUP_SUFFIX
+
+    def _parts(self) -> list[int]:
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(int(match[1]) for part in os.listdir(self.path) if (match := _PART_FILE.match(part)))
+
+    def _part_file(self, kind: str, sequence: int) -> str:
+        return os.path.join(self.path, f'{kind}-{sequence:05d}.parquet')
+
+    def _offsets(self, sequence: int) -> tuple[int, int]:
+        metadata = pl.read_parquet_metadata(self._part_file(_CHARAS, sequence))
+        return int(metadata[_START_KEY]), int(metadata[_END_KEY])
+
+    def _write_part(self, counts: dict[str, pl.DataFrame], start_offset: int, end_offset: int, sequence: int):
+        os.makedirs(self.path, exist_ok=True)
+        metadata = {_START_KEY: str(start_offset), _END_KEY: str(end_offset), _HASH_KEY: HASH_VERSION}
+        # The character part is written last since it is the one parts are found by, so a half written part is never read
+        for kind in _KINDS:
+            counts_df = counts[kind]
+            part = self._part_file(kind, sequence)
+            widen_counts(counts_df).sort(DAY_COLUMN).write_parquet(part + '.tmp', compression='zstd', statistics=True, metadata=metadata)
+            os.replace(part + '.tmp', part)
+
+    def append(self, replays_df: pl.DataFrame, start_offset: int, end_offset: int):
+        # Counts the replays a save just wrote to the replay file between the 2 offsets
+        sequence = max(self._parts(), default=-1) + 1
+        self._write_part(
+            _count_by_day(_with_day(replays_df), _with_day(unpivot_players(replays_df))),
+            start_offset,
+            end_offset,
+            sequence
+        )
+
+    def is_valid(self, offset: int) -> bool:
+        # Every part has to start where the one before it ended, from the start of the file to where it ends now
+        try:
+            expected_start = 0
+            for sequence in self._parts():
+                # Parts saved before matchups or sketches were added don't have them, and sketches hashed by another
+                # version of polars can't be merged with new ones
+                if not all(os.path.exists(self._part_file(kind, sequence)) for kind in _KINDS):
+                    return False
+                if pl.read_parquet_metadata(self._part_file(_DISTINCT_PLAYERS, sequence)).get(_HASH_KEY) != HASH_VERSION:
+                    return False
+                start_offset, end_offset = self._offsets(sequence)
+                if start_offset != expected_start:
+                    return False
+                expected_start = end_offset
+        except Exception:
+            return False
+        return expected_start == offset and offset > 0
+
+    def delete_after(self, offset: int) -> int:
+        # Parts counted from replays past the offset, which a resumed download is about to cut off the replay file
+        deleted = 0
+        for sequence in self._parts():
+            if self._offsets(sequence)[1] > offset:
+                for kind in _KINDS:
+                    if os.path.exists(part := self._part_file(kind, sequence)):
+                        os.remove(part)
+                deleted += 1
+        return deleted
+
+    def delete(self):
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+
+    def rename(self, file_name: str):
+        if os.path.isdir(self.path):
+            os.replace(self.path, file_name + ROLLUP_SUFFIX)
+        self.path = file_name + ROLLUP_SUFFIX
+
+    def rebuild(self, batches: Iterable[pl.DataFrame], offset: int, max_bytes: int):
+        # Counts an existing replay file a batch at a time, combining the counts whenever they take up max_bytes
+        # The top players of every day are only known once the counts of every batch are merged
+        chara_counts, player_counts, matchup_counts, distinct_players, powers = [], [], [], [], []
+        unmerged_bytes = 0
+        for replays_df in batches:
+            replays_df = _with_day(replays_df)
+            players_df = _with_day(unpivot_players(replays_df))
+            chara_counts.append(count_charas(players_df, [DAY_COLUMN]))
+            player_counts.append(count_players(players_df, [DAY_COLUMN]))
+            matchup_counts.append(count_matchups(replays_df, [DAY_COLUMN]))
+            distinct_players.append(sketch_distinct_players(player_counts[-1], [DAY_COLUMN]))
+            powers.append(sketch_powers(replays_df, [DAY_COLUMN]))
+            unmerged_bytes += sum(counts[-1].estimated_size() for counts in (player_counts, matchup_counts, distinct_players))
+            if unmerged_bytes > max_bytes:
+                player_counts = [merge_player_counts(player_counts, [DAY_COLUMN])]
+                matchup_counts = [merge_matchup_counts(matchup_counts, [DAY_COLUMN])]
+                distinct_players = [merge_distinct_players(distinct_players, [DAY_COLUMN])]
+                unmerged_bytes = 0
+        self.delete()
+        player_counts = merge_player_counts(player_counts, [DAY_COLUMN])
+        self._write_part(
+            {
+                _CHARAS: merge_chara_counts(chara_counts, [DAY_COLUMN]),
+                _PLAYERS: player_counts,
+                _MATCHUPS: merge_matchup_counts(matchup_counts, [DAY_COLUMN]),
+                _DISTINCT_PLAYERS: merge_distinct_players(distinct_players, [DAY_COLUMN]),
+                _POWERS: merge_powers(powers, [DAY_COLUMN]),
+                _TOP_PLAYERS: sketch_top_players(player_counts, [DAY_COLUMN])
+            },
+            0,
+            offset,
+            0
+        )
+
+    def compact(self):
+        # Saves append a part each, days that were split across saves are combined into a single part
+        parts = self._parts()
+        if len(parts) < 2:
+            return
+        start_offset, end_offset = self._offsets(parts[0])[0], self._offsets(parts[-1])[1]
+        merged = {
+            _CHARAS: merge_chara_counts(self._scan(_CHARAS), [DAY_COLUMN]),
+            _PLAYERS: merge_player_counts(self._scan(_PLAYERS), [DAY_COLUMN]),
+            _MATCHUPS: merge_matchup_counts(self._scan(_MATCHUPS), [DAY_COLUMN]),
+            _DISTINCT_PLAYERS: merge_distinct_players(self._scan(_DISTINCT_PLAYERS), [DAY_COLUMN]),
+            _POWERS: merge_powers(self._scan(_POWERS), [DAY_COLUMN]),
+            _TOP_PLAYERS: merge_top_players(self._scan(_TOP_PLAYERS), [DAY_COLUMN], [_PART_COLUMN])
+        }
+        sequence = parts[-1] + 1
+        self._write_part(dict(zip(merged, pl.collect_all(merged.values()))), start_offset, end_offset, sequence)
+        for old_sequence in parts:
+            for kind in _KINDS:
+                os.remove(self._part_file(kind, old_sequence))
+
+    def _scan(self, kind: str) -> pl.LazyFrame:
+        # Top players are merged knowing which part every one of them came from
+        if kind == _TOP_PLAYERS:
+            return pl.concat([
+                pl.scan_parquet(self._part_file(kind, sequence)).with_columns(pl.lit(sequence).alias(_PART_COLUMN))
+                for sequence in self._parts()
+            ])
+        return pl.scan_parquet([self._part_file(kind, sequence) for sequence in self._parts()])
+
+    def get_counts(self, start_date: datetime.date | None=None, end_date: datetime.date | None=None) -> tuple[pl.LazyFrame, pl.LazyFrame, pl.LazyFrame]:
+        # The same character, player and matchup counts analysis builds from the replays, summed over the days in the range
+        days = _get_days(start_date, end_date)
+        return (
+            merge_chara_counts(self._scan(_CHARAS).filter(days)),
+            merge_player_counts(self._scan(_PLAYERS).filter(days)),
+            merge_matchup_counts(self._scan(_MATCHUPS).filter(days))
+        )
+
+    def get_sketches(self, start_date: datetime.date | None=None, end_date: datetime.date | None=None) -> tuple[pl.LazyFrame, pl.LazyFrame, pl.LazyFrame]:
+        # Sketches of the players of every day in the range merged into one, however many days there are
+        days = _get_days(start_date, end_date)
+        return (
+            merge_distinct_players(self._scan(_DISTINCT_PLAYERS).filter(days)),
+            merge_powers(self._scan(_POWERS).filter(days)),
+            merge_top_players(self._scan(_TOP_PLAYERS).filter(days), [], [_PART_COLUMN, DAY_COLUMN])
+        )
@@ -0,0 +1,135 @@
+import math, polars as pl
+
+# Sketches summarize the players in a set of replays in the same amount of space however many players there are, and
+# like the counts they are merged across batches, days and files.
+# Unique players are counted with HyperLogLog registers, 2^10 of them per character and rank gives a standard error of
+# about 3.3% on every unique player count
+HLL_PRECISION = 10
+HLL_REGISTERS = 1 << HLL_PRECISION
+HLL_ERROR = 1.04 / math.sqrt(HLL_REGISTERS)
+# Powers are counted in buckets that each grow by the same ratio, so every percentile read from them is within 1% of
+# the true power
+POWER_ERROR = 0.01
+_POWER_GAMMA = (1 + POWER_ERROR) / (1 - POWER_ERROR)
+# The players with the most games in every summary are kept with their games, along with the most games any player
+# left out could have played, which bounds the games of every player from above and below
+TOP_PLAYERS = 1000
+# Hashes are only the same within a version of polars, sketches hashed by another version can't be merged with these
+HASH_VERSION = pl.__version__
+_HASH_SEED = 0x7e6b8
+_ALL = 'all'
+
+def sketch_distinct_players(player_counts: pl.DataFrame | pl.LazyFrame, by: list[str]=[]):
+    # Takes the counts from count_players, which already have every player once per character and rank. The top bits of
+    # a player's hash pick a register and the leading zeros of the rest are the most that register has seen
+    hashed = pl.col('polaris_id').cast(pl.String).hash(_HASH_SEED)
+    rest = hashed % (1 << (64 - HLL_PRECISION))
+    return player_counts.select(by + [
+        'chara_id',
+        'rank',
+        (hashed // (1 << (64 - HLL_PRECISION))).cast(pl.Int16).alias('register'),
+        (rest.bitwise_leading_zeros() - HLL_PRECISION + 1).cast(pl.Int8).alias('rho')
+    ]).group_by(by + ['chara_id', 'rank', 'register']).agg(pl.max('rho'))
+
+def merge_distinct_players(registers: list[pl.DataFrame] | pl.DataFrame | pl.LazyFrame, by: list[str]=[]):
+    if isinstance(registers, list):
+        registers = pl.concat(registers)
+    return registers.group_by(by + ['chara_id', 'rank', 'register']).agg(pl.max('rho'))
+
+def estimate_distinct_players(registers: pl.LazyFrame, by: list[str]):
+    # Registers are merged over everything not in by first, so a player seen with several characters or at several
+    # ranks is still counted once. Small counts with registers left empty are counted from how many are empty instead
+    alpha = 0.7213 / (1 + 1.079 / HLL_REGISTERS)
+    empty = (HLL_REGISTERS - pl.len()).cast(pl.Float64)
+    raw = alpha * HLL_REGISTERS ** 2 / (pl.lit(2.0).pow(-pl.col('rho').cast(pl.Float64)).sum() + empty)
+    return registers.group_by(by + ['register']).agg(pl.max('rho')).group_by(by).agg(
+        pl.when((raw <= 2.5 * HLL_REGISTERS) & (empty > 0))
+          .then(HLL_REGISTERS * (HLL_REGISTERS / empty).log())
+          .otherwise(raw)
+          .round()
+          .cast(pl.Int64)
+          .alias('Players')
+    )
+
+def sketch_powers(replay_df: pl.DataFrame | pl.LazyFrame, by: list[str]=[]):
+    # Games played at every power bucket by both players, powers of 1 or less all go in the first bucket
+    return pl.concat([
+        replay_df.select(by + [pl.col(f'p{side}_power').alias('power')]) for side in (1, 2)
+    ]).filter(pl.col('power').is_not_null()).select(by + [
+        pl.when(pl.col('power') > 1)
+          .then((pl.col('power').log() / math.log(_POWER_GAMMA)).ceil())
+          .otherwise(0)
+          .cast(pl.Int16)
+          .alias('bucket')
+    ]).group_by(by + ['bucket']).agg(pl.len().cast(pl.Int64).alias('games'))
+
+def merge_powers(buckets: list[pl.DataFrame] | pl.DataFrame | pl.LazyFrame, by: list[str]=[]):
+    if isinstance(buckets, list):
+        buckets = pl.concat(buckets)
+    return buckets.group_by(by + ['bucket']).agg(pl.sum('games'))
+
+def estimate_power_percentiles(buckets: pl.LazyFrame, percentiles: list[float]):
+    # The first bucket every percentile of games falls in, read as the middle of the bucket
+    cumulative = merge_powers(buckets).sort('bucket').select([
+        'bucket',
+        (pl.col('games').cum_sum() / pl.col('games').sum()).alias('share')
+    ])
+    return pl.LazyFrame({'Percentile': percentiles}).sort('Percentile').join_asof(
+        cumulative, left_on='Percentile', right_on='share', strategy='forward'
+    ).select([
+        'Percentile',
+        (2 * pl.lit(_POWER_GAMMA).pow(pl.col('bucket')) / (_POWER_GAMMA + 1)).round().cast(pl.Int64).alias('Power')
+    ])
+
+def _group_all(frame: pl.DataFrame | pl.LazyFrame, by: list[str]):
+    # Top players are always worked out per group, a summary of everything is a single group of its own
+    return (frame, by) if by else (frame.with_columns(pl.lit(0).alias(_ALL)), [_ALL])
+
+def sketch_top_players(player_counts: pl.DataFrame | pl.LazyFrame, by: list[str]=[]):
+    # Takes the counts from count_players. Every kept player's games are exact here, the cutoff is the most games of
+    # any player that wasn't kept
+    player_counts, groups = _group_all(player_counts, by)
+    place = pl.col('games').rank('ordinal', descending=True).over(groups)
+    return player_counts.group_by(groups + ['polaris_id']).agg([
+        pl.sum('games').cast(pl.Int64),
+        pl.col('name').get(pl.col('battle_at').arg_max()),
+        pl.max('battle_at')
+    ]).with_columns([
+        place.alias('place'),
+        pl.col('games').filter(place > TOP_PLAYERS).max().over(groups).fill_null(0).alias('cutoff')
+    ]).filter(pl.col('place') <= TOP_PLAYERS).select(by + [
+        'polaris_id',
+        'name',
+        'battle_at',
+        pl.col('games').alias('games_lower'),
+        pl.col('games').alias('games_upper'),
+        'cutoff'
+    ])
+
+def merge_top_players(summaries: pl.DataFrame | pl.LazyFrame, by: list[str], units: list[str]):
+    # Every summary is told apart by its units, a player missing from one could have played up to its cutoff there.
+    # The merged summary is one more of the same kind, its cutoff bounds every player it no longer holds
+    summaries, groups = _group_all(summaries, by)
+    total_cutoff = summaries.group_by(groups + units).agg(pl.first('cutoff')).group_by(groups).agg(
+        pl.sum('cutoff').alias('total_cutoff')
+    )
+    place = pl.col('games_lower').rank('ordinal', descending=True).over(groups)
+    return summaries.group_by(groups + ['polaris_id']).agg([
+        pl.col('name').get(pl.col('battle_at').arg_max()),
+        pl.max('battle_at'),
+        pl.sum('games_lower'),
+        pl.sum('games_upper'),
+        pl.sum('cutoff').alias('present_cutoff')
+    ]).join(total_cutoff, on=groups).with_columns(
+        (pl.col('games_upper') + pl.col('total_cutoff') - pl.col('present_cutoff')).alias('games_upper')
+    ).with_columns([
+        place.alias('place'),
+        pl.col('games_upper').filter(place > TOP_PLAYERS).max().over(groups).fill_null(0).alias('dropped_upper')
+    ]).filter(pl.col('place') <= TOP_PLAYERS).select(by + [
+        'polaris_id',
+        'name',
+        'battle_at',
+        'games_lower',
+        'games_upper',
+        pl.max_horizontal('total_cutoff', 'dropped_upper').alias('cutoff')
+    ])
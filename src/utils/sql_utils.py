@@ -1,12 +1,26 @@
 import sqlite3, src.config as config, src.enums as enums, polars as pl
 from src.utils.file_utils import create_replay_dir, ensure_file_exists
+from contextlib import contextmanager
+from typing import Iterator
+from src.utils.tracing import span
 from enum import Enum
 
+@contextmanager
+def connect(database_file: str):
+    # sqlite3's own context manager only commits, the connection has to be closed too or it keeps holding its lock on
+    # the WAL and the checkpoint after a bulk load fails
+    connection = sqlite3.connect(database_file)
+    try:
+        with connection:
+            yield connection
+    finally:
+        connection.close()
+
 def create_tables(database_file: str):
     create_replay_dir()
     ensure_file_exists(database_file)
     try:
-        with sqlite3.connect(database_file) as connection:
+        with connect(database_file) as connection:
             cursor = connection.cursor()
             # Create main table
             cursor.execute(f'''
@@ -67,58 +81,171 @@ CREATE TABLE IF NOT EXISTS {table} (
         return e
     return None
 
-def _create_index(cursor: sqlite3.Cursor, index_name, table, column):
-    cursor.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {table}({column});')
+# The character indexes also hold rank and winner so counting matches per character and rank is read straight off
+# the index in order, without touching the table or sorting
+INDEXES = [
+    {
+        'name': f'idx_{config.Tables.ReplayData.lower()}_p1_chara_id_rank_winner',
+        'table': config.Tables.ReplayData,
+        'columns': ['p1_chara_id', 'p1_rank', 'winner']
+    },
+    {
+        'name': f'idx_{config.Tables.ReplayData.lower()}_p2_chara_id_rank_winner',
+        'table': config.Tables.ReplayData,
+        'columns': ['p2_chara_id', 'p2_rank', 'winner']
+    },
+    {
+        'name': f'idx_{config.Tables.ReplayData.lower()}_winner',
+        'table': config.Tables.ReplayData,
+        'columns': ['winner']
+    },
+    {
+        'name': f'idx_{config.Tables.ReplayData.lower()}_battle_at',
+        'table': config.Tables.ReplayData,
+        'columns': ['battle_at']
+    }
+]
+# Replaced by the indexes above, dropped so databases from older versions don't keep both
+OLD_INDEXES = [
+    f'idx_{config.Tables.ReplayData.lower()}_p1_chara_id',
+    f'idx_{config.Tables.ReplayData.lower()}_p2_chara_id'
+]
+
+# Only for the duration of a bulk load, WAL with synchronous NORMAL can lose the last transaction on a power cut but
+# never corrupts the database, and the journal records which saves made it so nothing is silently lost
+LOAD_PRAGMAS = [
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    f'PRAGMA cache_size=-{config.SQLITE_CACHE_KIB}',
+]
+
+def _create_index(cursor: sqlite3.Cursor, index_name, table, columns):
+    cursor.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {table}({", ".join(columns)});')
 
 def create_indexes(database_file: str):
     create_replay_dir()
     ensure_file_exists(database_file)
     try:
-        with sqlite3.connect(database_file) as connection:
+        with connect(database_file) as connection:
             cursor = connection.cursor()
-            indexes = [
-                {
-                    'name': f'idx_{config.Tables.ReplayData.lower()}_p1_chara_id',
-                    'table': config.Tables.ReplayData,
-                    'column': 'p1_chara_id'
-                },
-                {
-                    'name': f'idx_{config.Tables.ReplayData.lower()}_p2_chara_id',
-                    'table': config.Tables.ReplayData,
-                    'column': 'p2_chara_id'
-                },
-                {
-                    'name': f'idx_{config.Tables.ReplayData.lower()}_winner',
-                    'table': config.Tables.ReplayData,
-                    'column': 'winner'
-                }
-            ]
-            for index in indexes:
-                _create_index(cursor, index['name'], index['table'], index['column'])
+            # A bigger cache lets every index be built in one sort instead of spilling to disk
+            cursor.execute(f'PRAGMA cache_size=-{config.SQLITE_CACHE_KIB}')
+            cursor.execute('PRAGMA temp_store=MEMORY')
+            for index in OLD_INDEXES:
+                cursor.execute(f'DROP INDEX IF EXISTS {index};')
+            for index in INDEXES:
+                _create_index(cursor, index['name'], index['table'], index['columns'])
+    except Exception as e:
+        return e
+    return None
+
+def drop_indexes(database_file: str):
+    # Appending to indexed tables updates every index for every row, so they are dropped and rebuilt once at the end
+    try:
+        with connect(database_file) as connection:
+            for index in [index['name'] for index in INDEXES] + OLD_INDEXES:
+                connection.execute(f'DROP INDEX IF EXISTS {index};')
+    except Exception as e:
+        return e
+    return None
+
+def bulk_insert(database_file: str, replays_df: pl.DataFrame, table: str=config.Tables.ReplayData):
+    # One prepared insert run through executemany in a single transaction, rows with a battle id that is already
+    # saved are skipped instead of failing the whole save
+    columns = replays_df.columns
+    statement = f'INSERT OR IGNORE INTO {table} ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})'
+    connection = sqlite3.connect(database_file, isolation_level=None)
+    try:
+        for pragma in LOAD_PRAGMAS:
+            connection.execute(pragma)
+        connection.execute('BEGIN')
+        inserted = 0
+        for batch_df in replays_df.iter_slices(config.SQLITE_BATCH_SIZE):
+            with span('insert batch', 'save', rows=batch_df.height):
+                inserted += connection.executemany(statement, batch_df.iter_rows()).rowcount
+        with span('commit', 'save'):
+            connection.execute('COMMIT')
+    except Exception as e:
+        if connection.in_transaction:
+            connection.execute('ROLLBACK')
+        return 0, e
+    finally:
+        connection.close()
+    return inserted, None
+
+def finish_bulk_load(database_file: str):
+    # Folds the WAL back into the database so it is a single file again that any tool can open
+    try:
+        connection = sqlite3.connect(database_file, isolation_level=None)
+        try:
+            connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            connection.execute('PRAGMA journal_mode=DELETE')
+        finally:
+            connection.close()
     except Exception as e:
         return e
     return None
 
-def _enum_to_dict(enum: type[Enum]):
-    return [{'Id': member.value, 'Name': member.name} for member in enum]
+def get_max_battle_at(database_file: str) -> int | None:
+    with connect(database_file) as connection:
+        return connection.execute(f'SELECT MAX(battle_at) FROM {config.Tables.ReplayData}').fetchone()[0]
 
-def _write_enum_to_table(enum, table, connection):
-    pl.DataFrame(_enum_to_dict(enum)).write_database(
-        table_name=table,
-        connection=connection,
-        if_table_exists='append'
-    )
+def get_max_rowid(database_file: str) -> int:
+    with connect(database_file) as connection:
+        return connection.execute(f'SELECT COALESCE(MAX(rowid), 0) FROM {config.Tables.ReplayData}').fetchone()[0]
+
+def delete_rows_after(database_file: str, rowid: int):
+    # Rows are only ever appended so everything past rowid was written after that point
+    try:
+        with connect(database_file) as connection:
+            deleted = connection.execute(f'DELETE FROM {config.Tables.ReplayData} WHERE rowid > ?', (rowid,)).rowcount
+    except Exception as e:
+        return 0, e
+    return deleted, None
+
+def _enum_to_rows(enum: type[Enum]):
+    return [(member.value, member.name) for member in enum]
+
+def _write_enum_to_table(enum, table, connection: sqlite3.Connection):
+    connection.executemany(f'INSERT OR IGNORE INTO {table} (Id, Name) VALUES (?, ?)', _enum_to_rows(enum))
 
 def populate_lookup_tables(database_file: str): 
     create_replay_dir()
     ensure_file_exists(database_file)
     try:
-        connection = config.SQLITE_URI + database_file
-        _write_enum_to_table(enums.Characters, config.Tables.Characters, connection)
-        _write_enum_to_table(enums.Ranks, config.Tables.Ranks, connection)
-        _write_enum_to_table(enums.BattleTypes, config.Tables.BattleTypes, connection)
-        _write_enum_to_table(enums.Regions, config.Tables.Regions, connection)
-        _write_enum_to_table(enums.Stages, config.Tables.Stages, connection)
+        with connect(database_file) as connection:
+            _write_enum_to_table(enums.Characters, config.Tables.Characters, connection)
+            _write_enum_to_table(enums.Ranks, config.Tables.Ranks, connection)
+            _write_enum_to_table(enums.BattleTypes, config.Tables.BattleTypes, connection)
+            _write_enum_to_table(enums.Regions, config.Tables.Regions, connection)
+            _write_enum_to_table(enums.Stages, config.Tables.Stages, connection)
     except Exception as e:
         return e
-    return None
\ No newline at end of file
+    return None
+
+def _set_query_pragmas(connection: sqlite3.Connection):
+    # Grouping sorts in temporary b-trees, keeping them in memory stops them spilling to a temp file
+    connection.execute('PRAGMA temp_store=MEMORY')
+    connection.execute(f'PRAGMA cache_size=-{config.SQLITE_CACHE_KIB}')
+
+def get_chara_counts(database_file: str) -> pl.DataFrame:
+    # Matches per side, character, rank and winner, every character stat can be worked out from these few thousand rows
+    with connect(database_file) as connection:
+        _set_query_pragmas(connection)
+        return pl.read_database(f'''
+            SELECT 1 AS side, p1_chara_id AS chara_id, p1_rank AS rank, winner, COUNT(*) AS games
+            FROM {config.Tables.ReplayData}
+            GROUP BY p1_chara_id, p1_rank, winner
+            UNION ALL
+            SELECT 2 AS side, p2_chara_id AS chara_id, p2_rank AS rank, winner, COUNT(*) AS games
+            FROM {config.Tables.ReplayData}
+            GROUP BY p2_chara_id, p2_rank, winner
+        ''', connection)
+
+def iter_replays(database_file: str, columns: list[str], schema: pl.Schema, batch_size: int=config.SQLITE_BATCH_SIZE) -> Iterator[pl.DataFrame]:
+    # Reads the table a batch at a time so only one batch of matches is ever held in memory
+    with connect(database_file) as connection:
+        cursor = connection.execute(f'SELECT {", ".join(columns)} FROM {config.Tables.ReplayData}')
+        while rows := cursor.fetchmany(batch_size):
+            yield pl.DataFrame(rows, schema={column: schema[column] for column in columns}, orient='row')
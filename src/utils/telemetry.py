@@ -0,0 +1,115 @@
+import bisect, threading, src.utils.logger as logger
+
+# Upper bounds of each bucket, anything over the last bound goes into an overflow bucket
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1_024, 4_096, 16_384, 65_536, 262_144, 1_048_576, 4_194_304, 16_777_216)
+
+class Histogram:
+    def __init__(self, bounds: tuple[float, ...]) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min: float | None = None
+        self.max: float | None = None
+
+    def add(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def mean(self) -> float | None:
+        return self.total / self.count if self.count else None
+
+    def percentile(self, percentile: float) -> float | None:
+        # Interpolated within the bucket the percentile falls in, so it is only as exact as the buckets are narrow
+        if not self.count:
+            return None
+        target = percentile * self.count
+        seen = 0
+        lower = self.min
+        for bound, count in zip(list(self.bounds) + [self.max], self.counts):
+            if count and seen + count >= target:
+                upper = min(bound, self.max)
+                lower = max(lower, self.min)
+                return lower + (upper - lower) * (target - seen) / count
+            seen += count
+            lower = bound
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.mean(),
+            'min': self.min,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+            'buckets': [
+                {'le': bound, 'count': count}
+                for bound, count in zip(list(self.bounds) + [None], self.counts)
+            ]
+        }
+
+class DownloadTelemetry:
+    PHASES = ('connect', 'ttfb', 'body', 'decode', 'total')
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.latency = {phase: Histogram(LATENCY_BUCKETS) for phase in self.PHASES}
+        self.wire_bytes = Histogram(SIZE_BUCKETS)
+        self.body_bytes = Histogram(SIZE_BUCKETS)
+        self.failures = 0
+        self.new_connections = 0
+
+    def record(self, connect: float, ttfb: float, body: float, decode: float, wire_bytes: int, body_bytes: int):
+        with self._lock:
+            # Connect is only timed for requests that had to open a new connection, reused ones skip it entirely
+            if connect:
+                self.new_connections += 1
+                self.latency['connect'].add(connect)
+            for phase, value in zip(self.PHASES[1:], (ttfb, body, decode, connect + ttfb + body + decode)):
+                self.latency[phase].add(value)
+            self.wire_bytes.add(wire_bytes)
+            self.body_bytes.add(body_bytes)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            wire_total = self.wire_bytes.total
+            body_total = self.body_bytes.total
+            return {
+                'requests': self.latency['total'].count,
+                'failures': self.failures,
+                'new_connections': self.new_connections,
+                'latency_seconds': {phase: histogram.to_dict() for phase, histogram in self.latency.items()},
+                'wire_bytes': self.wire_bytes.to_dict(),
+                'body_bytes': self.body_bytes.to_dict(),
+                'compression_ratio': body_total / wire_total if wire_total else None
+            }
+
+    def report(self, use_tqdm: bool=False):
+        summary = self.summary()
+        if not summary['requests']:
+            return
+        logger.download(
+            f'{summary["requests"]:,} requests over {summary["new_connections"]:,} connection(s), {summary["failures"]:,} failed, '
+            f'{summary["wire_bytes"]["total"] / 1_048_576:,.1f} MiB transferred '
+            f'({summary["body_bytes"]["total"] / 1_048_576:,.1f} MiB decoded)',
+            use_tqdm=use_tqdm
+        )
+        for phase, histogram in summary['latency_seconds'].items():
+            if not histogram['count']:
+                continue
+            logger.download(
+                f'{phase:>7} mean {histogram["mean"] * 1000:8.1f}ms, p50 {histogram["p50"] * 1000:8.1f}ms, '
+                f'p95 {histogram["p95"] * 1000:8.1f}ms, max {histogram["max"] * 1000:8.1f}ms',
+                use_tqdm=use_tqdm
+            )
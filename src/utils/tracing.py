@@ -0,0 +1,195 @@
+import contextlib, contextvars, datetime, functools, json, os, threading, time, tracemalloc, polars as pl, src.config as config
+from typing import Callable, Iterable, Iterator, TypeVar
+from src.utils.memory import get_peak_memory
+
+# Spans are only recorded while TRACE is on, otherwise every span is the same one that records nothing
+class Span:
+    def __init__(self, name: str, category: str, parent: 'Span | None', args: dict) -> None:
+        self.name = name
+        self.category = category
+        self.parent = parent
+        self.args = args
+        self.thread = threading.current_thread()
+        self.children: list[Span] = []
+        self.start = time.perf_counter()
+        self.end: float | None = None
+        self.python_memory_peak = 0
+
+    def set(self, **args):
+        # Rows and bytes are often only known once the work is done
+        self.args.update(args)
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'category': self.category,
+            'thread': self.thread.name,
+            'start': self.start - _trace.start,
+            'duration': (self.end or time.perf_counter()) - self.start,
+            'args': self.args,
+            'children': [child.to_dict() for child in self.children]
+        }
+
+class _NoSpan(Span):
+    def __init__(self) -> None:
+        pass
+
+    def set(self, **args):
+        pass
+
+class _Trace:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.start = time.perf_counter()
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+        self.spans: list[Span] = []
+        self.open: set[Span] = set()
+
+_NO_SPAN = _NoSpan()
+_END = object()
+T = TypeVar('T')
+_trace = _Trace()
+_current: contextvars.ContextVar[Span | None] = contextvars.ContextVar('span', default=None)
+
+def _fold_python_memory():
+    # Python memory is traced for the whole process, so its peak so far is added to every span that is open right now
+    # before it is reset. Every span ends up with the peak while it was open, whatever thread the memory was used on
+    if not tracemalloc.is_tracing():
+        return
+    peak = tracemalloc.get_traced_memory()[1]
+    for span in _trace.open:
+        span.python_memory_peak = max(span.python_memory_peak, peak)
+    tracemalloc.reset_peak()
+
+@contextlib.contextmanager
+def span(name: str, category: str, **args) -> Iterator[Span]:
+    # Spans opened inside this one on the same thread are nested under it, ones opened on other threads start a tree of
+    # their own
+    if not config.TRACE:
+        yield _NO_SPAN
+        return
+    if config.TRACE_PYTHON_MEMORY and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    parent = _current.get()
+    new_span = Span(name, category, parent, args)
+    peak_before = get_peak_memory()
+    with _trace.lock:
+        _fold_python_memory()
+        _trace.open.add(new_span)
+        (parent.children if parent else _trace.spans).append(new_span)
+    token = _current.set(new_span)
+    try:
+        yield new_span
+    finally:
+        _current.reset(token)
+        new_span.end = time.perf_counter()
+        with _trace.lock:
+            _fold_python_memory()
+            _trace.open.discard(new_span)
+        _finish(new_span, peak_before)
+
+def traced(name: str, category: str) -> Callable:
+    # Every call of the function is a span
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name, category):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def iter_spans(items: Iterable[T], name: str, category: str) -> Iterator[T]:
+    # Taking every item is a span, for batches that are only read from the file when they are asked for
+    iterator = iter(items)
+    while True:
+        with span(name, category) as item_span:
+            item = next(iterator, _END)
+            if isinstance(item, pl.DataFrame):
+                item_span.set(rows=item.height, bytes=item.estimated_size())
+        if item is _END:
+            return
+        yield item
+
+def _finish(span: Span, peak_before: int | None):
+    seconds = span.end - span.start
+    for unit in ('rows', 'bytes'):
+        if span.args.get(unit) and seconds:
+            span.args[f'{unit}_per_second'] = span.args[unit] / seconds
+    # The peak resident memory only ever goes up, how much it went up while the span was open is what it added
+    if (peak_after := get_peak_memory()) is not None:
+        span.args['peak_rss'] = peak_after
+        span.args['peak_rss_increase'] = peak_after - (peak_before or 0)
+    if tracemalloc.is_tracing():
+        span.args['python_memory_peak'] = span.python_memory_peak
+
+def collect_all(queries: list[pl.LazyFrame], name: str) -> list[pl.DataFrame]:
+    # With TRACE_QUERY_PLANS every query is profiled on its own and every node of its plan becomes a span. Parts the
+    # queries share are worked out again for each of them, so it is only for finding out where the time goes
+    with span(name, 'polars', queries=len(queries)) as query_span:
+        if not (config.TRACE and config.TRACE_QUERY_PLANS):
+            results = pl.collect_all(queries)
+        else:
+            results = []
+            for query in queries:
+                started = time.perf_counter()
+                try:
+                    result, timings = query.profile()
+                except pl.exceptions.PanicException:
+                    # Plans that end in a cache can't be collected on their own, only together with other plans
+                    result, timings = pl.collect_all([query])[0], None
+                results.append(result)
+                # Node times are microseconds from when the query started
+                for node, start, end in timings.iter_rows() if timings is not None else []:
+                    node_span = Span(node, 'polars plan', query_span, {})
+                    node_span.start, node_span.end = started + start / 1e6, started + end / 1e6
+                    query_span.children.append(node_span)
+        query_span.set(rows=sum(result.height for result in results))
+        return results
+
+def _chrome_events(spans: list[Span]) -> Iterator[dict]:
+    for span in spans:
+        yield {
+            'name': span.name,
+            'cat': span.category,
+            'ph': 'X',
+            'ts': (span.start - _trace.start) * 1e6,
+            'dur': ((span.end or time.perf_counter()) - span.start) * 1e6,
+            'pid': os.getpid(),
+            'tid': span.thread.ident,
+            'args': span.args
+        }
+        yield from _chrome_events(span.children)
+
+def _threads(spans: list[Span]) -> dict[int, str]:
+    threads = {}
+    for span in spans:
+        threads[span.thread.ident] = span.thread.name
+        threads.update(_threads(span.children))
+    return threads
+
+def write_trace() -> str | None:
+    # Saves every span recorded since the last trace was written and starts a new trace. Chrome trace event files open
+    # in chrome://tracing or https://ui.perfetto.dev, JSON traces are the same spans as nested objects
+    with _trace.lock:
+        spans, started_at = _trace.spans, _trace.started_at
+        if not config.TRACE or not spans:
+            return None
+        os.makedirs(config.TRACE_DIR, exist_ok=True)
+        trace_file = os.path.join(config.TRACE_DIR, f'trace_{started_at:%Y%m%dT%H%M%S}.json')
+        if config.TRACE_FORMAT == 'chrome':
+            trace = {
+                'traceEvents': [
+                    {'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': thread, 'args': {'name': name}}
+                    for thread, name in _threads(spans).items()
+                ] + list(_chrome_events(spans)),
+                'displayTimeUnit': 'ms'
+            }
+        else:
+            trace = {'started': started_at.isoformat(), 'spans': [span.to_dict() for span in spans]}
+        with open(trace_file, 'w', encoding='utf8') as file:
+            json.dump(trace, file)
+        _trace.reset()
+    return trace_file